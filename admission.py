@@ -0,0 +1,94 @@
+"""EXPLAIN based estimates of how many rows an alias examines, to hold back aliases that became expensive"""
+import collections
+import json
+import logging
+import os
+import threading
+import time
+
+import mysql.connector
+
+
+# Estimates are kept between warm invocations, keyed by alias, host, database and schema version
+explain_cache = {}
+# The schema version of each (mysql_host, mysql_database), checked at most every SCHEMA_VERSION_TTL seconds
+schema_versions = {}
+explain_lock = threading.Lock()
+
+
+def get_schema_version(query, cnx):
+    """Returns when the newest table of the alias's database was created, which changes with most schema changes"""
+
+    key = (query['mysql_host'], query['mysql_database'])
+    with explain_lock:
+        cached = schema_versions.get(key)
+    if cached is not None and time.time() - cached[1] < float(os.environ.get('SCHEMA_VERSION_TTL', 300)):
+        return cached[0]
+    cur = cnx.cursor()
+    cur.execute("SELECT MAX(CREATE_TIME) FROM information_schema.TABLES WHERE TABLE_SCHEMA = DATABASE()")
+    row = cur.fetchone()
+    cur.close()
+    version = str(row[0]) if row else None
+    with explain_lock:
+        schema_versions[key] = (version, time.time())
+    return version
+
+
+def estimate_rows(plan, columns):
+    """Estimates rows examined from an EXPLAIN plan: the product of the rows of each joined table, summed over the selects"""
+
+    rows_index = columns.index('rows')
+    id_index = columns.index('id')
+    selects = collections.OrderedDict()
+    for row in plan:
+        selects[row[id_index]] = selects.get(row[id_index], 1) * int(row[rows_index] or 1)
+    return sum(selects.values())
+
+
+def explain(query, cnx):
+    if query.get('params'):
+        # The placeholders of parameterized aliases are only understood by prepared statements
+        cur = cnx.cursor(prepared=True)
+        cur.execute("EXPLAIN " + query['sql'].strip().rstrip(';'), tuple(query.get('arguments', [])))
+    else:
+        cur = cnx.cursor()
+        cur.execute("EXPLAIN " + query['sql'].strip().rstrip(';'))
+    plan = cur.fetchall()
+    columns = list(cur.column_names)
+    cur.close()
+    return estimate_rows(plan, columns)
+
+
+def get_estimate(query, cnx):
+    """Returns the estimated rows examined by an alias and whether it came from the cache
+
+    Estimates are reused while the schema is unchanged and for EXPLAIN_CACHE_TTL seconds. The estimate is
+    None when the alias can't be explained, such as when it runs several statements.
+    """
+
+    if ';' in query['sql'].strip().rstrip(';'):
+        return None, False
+    key = (query['alias'], query['sql'], json.dumps(query.get('arguments')), query['mysql_host'], query['mysql_database'], get_schema_version(query, cnx))
+    with explain_lock:
+        cached = explain_cache.get(key)
+    if cached is not None and time.time() - cached[1] < float(os.environ.get('EXPLAIN_CACHE_TTL', 3600)):
+        return cached[0], True
+    estimate = explain(query, cnx)
+    with explain_lock:
+        explain_cache[key] = (estimate, time.time())
+    return estimate, False
+
+
+def check_admission(query, cnx):
+    """Returns the estimated rows examined by an alias and the on_expensive action to take, None if it may run as is"""
+
+    try:
+        estimate, cached = get_estimate(query, cnx)
+    except mysql.connector.errors.Error:
+        logging.exception({'action': 'explain query', 'status': 'failed', 'alias': query['alias']})
+        return None, None
+    decision = None
+    if estimate is not None and estimate > query['max_rows_examined']:
+        decision = query.get('on_expensive', 'reject')
+    logging.info({'action': 'explain query', 'status': 'success', 'alias': query['alias'], 'host': query['mysql_host'], 'estimate': estimate, 'max_rows_examined': query['max_rows_examined'], 'cached': cached, 'decision': decision})
+    return estimate, decision
@@ -0,0 +1,278 @@
+"""Loading, validation and build-time compilation of the alias configuration"""
+import datetime
+import hashlib
+import json
+import logging
+import os
+import re
+import sys
+
+
+# Parsed alias configuration, kept between warm invocations and reloaded only when the file changes
+alias_config = {}
+
+
+REQUIRED_ALIAS_KEYS = ('sql', 'mysql_host', 'mysql_database')
+REQUIRED_TARGET_KEYS = ('mysql_host', 'mysql_database')
+MERGE_MODES = ('concat', 'sum', 'top')
+ADMISSION_ACTIONS = ('reject', 'replica', 'limit')
+DURATION_UNITS = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}
+PARAM_TYPES = ('int', 'float', 'str', 'date')
+# Pipelined aliases run once on their own host and stream their result straight to Slack
+PIPELINE_EXCLUSIVE_KEYS = ('parallel', 'targets', 'replicas', 'cache_ttl', 'refresh', 'max_rows_examined')
+
+
+def get_compiled_config_filename(filename):
+    return os.path.splitext(filename)[0] + '.json'
+
+
+def parse_duration(duration):
+    """Returns the seconds of a duration such as 30s, 5m or 1h, or of a plain number of seconds, None if it is invalid"""
+
+    if isinstance(duration, (int, float)) and not isinstance(duration, bool):
+        return duration if duration > 0 else None
+    match = re.match(r'^(\d+)([smhd])$', str(duration).strip())
+    if not match or int(match.group(1)) == 0:
+        return None
+    return int(match.group(1)) * DURATION_UNITS[match.group(2)]
+
+
+def convert_argument(param, word):
+    """Converts a word of the command to the type of a parameter, raising ValueError if it doesn't fit"""
+
+    kind = param.get('type', 'str')
+    if kind == 'int':
+        return int(word)
+    if kind == 'float':
+        return float(word)
+    if kind == 'date':
+        # Sent as text, which MySQL compares to DATE columns
+        return datetime.datetime.strptime(str(word), '%Y-%m-%d').strftime('%Y-%m-%d')
+    return str(word)
+
+
+def get_usage(alias, params):
+    return "/sql {} {}".format(alias, ' '.join(
+        ('<{}:{}>' if 'default' not in param else '[{}:{}]').format(param['name'], param.get('type', 'str')) for param in params
+    ))
+
+
+def bind_params(alias, params, words):
+    """Converts the words following a parameterized alias to its arguments, returning (arguments, error)"""
+
+    required = len([param for param in params if 'default' not in param])
+    if not required <= len(words) <= len(params):
+        return None, "The alias {} takes {} to {} parameters, usage: `{}`".format(alias, required, len(params), get_usage(alias, params))
+    arguments = []
+    for i, param in enumerate(params):
+        word = words[i] if i < len(words) else param['default']
+        try:
+            arguments.append(convert_argument(param, word))
+        except ValueError:
+            return None, "The parameter {} of {} must be of type {}, not `{}`, usage: `{}`".format(param['name'], alias, param.get('type', 'str'), word, get_usage(alias, params))
+    return arguments, None
+
+
+def validate_params(query):
+    """Returns the reason the parameters of an alias are unusable, or None if they are valid"""
+
+    params = query['params']
+    if not isinstance(params, list) or not params:
+        return "params must be a list of parameters with a name and type"
+    optional = False
+    for param in params:
+        if not isinstance(param, dict) or not param.get('name'):
+            return "every parameter needs a name"
+        if param.get('type', 'str') not in PARAM_TYPES:
+            return "the type of parameter {} must be one of {}".format(param['name'], ', '.join(PARAM_TYPES))
+        if 'default' in param:
+            optional = True
+            try:
+                convert_argument(param, param['default'])
+            except ValueError:
+                return "the default of parameter {} isn't of type {}".format(param['name'], param.get('type', 'str'))
+        elif optional:
+            return "parameter {} without a default follows one with a default".format(param['name'])
+    if query['sql'].count('%s') != len(params):
+        return "sql must have one %s placeholder per parameter"
+    if ';' in query['sql'].strip().rstrip(';'):
+        return "aliases with params run a single statement"
+    if 'refresh' in query:
+        return "aliases with params can't be refreshed"
+    return None
+
+
+def validate_alias(alias, query):
+    """Returns the reason an alias is unusable, or None if it is valid"""
+
+    if not isinstance(query, dict):
+        return "expected a mapping of settings"
+    if 'targets' in query:
+        # Sharded aliases run against every target instead of a single host
+        error = validate_targets(query)
+        if error:
+            return error
+        missing = [key for key in REQUIRED_ALIAS_KEYS if key not in REQUIRED_TARGET_KEYS and not query.get(key)]
+    else:
+        missing = [key for key in REQUIRED_ALIAS_KEYS if not query.get(key)]
+    if missing:
+        return "missing {}".format(', '.join(missing))
+    if 'cache_ttl' in query and (not isinstance(query['cache_ttl'], (int, float)) or query['cache_ttl'] <= 0):
+        return "cache_ttl must be a positive number of seconds"
+    if not isinstance(query.get('fast', False), bool):
+        return "fast must be true or false"
+    if 'replicas' in query and (not isinstance(query['replicas'], list) or not all(isinstance(host, str) and host for host in query['replicas'])):
+        return "replicas must be a list of hosts"
+    if 'replicas' in query and 'targets' in query:
+        return "replicas can't be combined with targets"
+    if 'max_execution_time' in query and (not isinstance(query['max_execution_time'], (int, float)) or query['max_execution_time'] <= 0):
+        return "max_execution_time must be a positive number of seconds"
+    if 'max_rows_examined' in query and (not isinstance(query['max_rows_examined'], int) or query['max_rows_examined'] <= 0):
+        return "max_rows_examined must be a positive number of rows"
+    if query.get('on_expensive', 'reject') not in ADMISSION_ACTIONS:
+        return "on_expensive must be one of {}".format(', '.join(ADMISSION_ACTIONS))
+    if query.get('on_expensive') == 'replica' and not query.get('replicas'):
+        return "on_expensive replica needs replicas"
+    if 'expensive_limit' in query and (not isinstance(query['expensive_limit'], int) or query['expensive_limit'] <= 0):
+        return "expensive_limit must be a positive number of rows"
+    if 'targets' in query and any(key in query for key in ('max_rows_examined', 'on_expensive', 'expensive_limit')):
+        # Shards run without the EXPLAIN check, the settings would be ignored
+        return "max_rows_examined and on_expensive can't be combined with targets"
+    if query.get('parallel'):
+        statements = query['sql']
+        if not isinstance(statements, list) or len(statements) < 2 or not all(isinstance(statement, str) and statement.strip() for statement in statements):
+            return "parallel aliases need sql to be a list of at least two statements"
+        if 'targets' in query or 'params' in query:
+            return "parallel can't be combined with targets or params"
+    elif not isinstance(query['sql'], str):
+        return "sql must be a statement, a list of statements needs parallel"
+    if 'params' in query:
+        error = validate_params(query)
+        if error:
+            return error
+    if 'refresh' in query and parse_duration(query['refresh']) is None:
+        return "refresh must be a duration such as 30s, 5m or 1h"
+    if not isinstance(query.get('pipeline', False), bool):
+        return "pipeline must be true or false"
+    if query.get('pipeline') and any(query.get(key) for key in PIPELINE_EXCLUSIVE_KEYS):
+        return "pipeline can't be combined with {}".format(', '.join(PIPELINE_EXCLUSIVE_KEYS))
+    if 'max_lag' in query and (not isinstance(query['max_lag'], (int, float)) or query['max_lag'] < 0):
+        return "max_lag must be a number of seconds"
+    return None
+
+
+def validate_targets(query):
+    """Returns the reason the targets and merge settings of a sharded alias are unusable, or None if they are valid"""
+
+    targets = query['targets']
+    if not isinstance(targets, list) or not targets:
+        return "targets must be a list of mysql_host and mysql_database"
+    for target in targets:
+        if not isinstance(target, dict) or any(not target.get(key) for key in REQUIRED_TARGET_KEYS):
+            return "every target needs a mysql_host and mysql_database"
+    merge = query.get('merge', 'concat')
+    if merge not in MERGE_MODES:
+        return "merge must be one of {}".format(', '.join(MERGE_MODES))
+    if merge == 'sum' and not isinstance(query.get('group_by', []), list):
+        return "group_by must be a list of columns"
+    if merge == 'top' and not query.get('order_by'):
+        return "merge top needs an order_by column"
+    if 'limit' in query and (not isinstance(query['limit'], int) or query['limit'] <= 0):
+        return "limit must be a positive number of rows"
+    return None
+
+
+def encode_date(value):
+    """Encodes the dates YAML parses unquoted values such as 2020-01-31 into, as the ISO strings they were written as"""
+
+    if isinstance(value, datetime.date):
+        return value.isoformat()
+    raise TypeError("{!r} is not JSON serializable".format(value))
+
+
+def parse_config(source):
+    """Parses the YAML alias configuration and checks its structure"""
+
+    # Only needed when the compiled configuration is missing or stale
+    import ruamel.yaml as yaml
+    try:
+        config = yaml.safe_load(source)
+    except yaml.YAMLError as error:
+        raise ValueError("Failed to parse the alias configuration: {}".format(error))
+    if not isinstance(config, dict) or not isinstance(config.get('queries'), dict):
+        raise ValueError("The alias configuration must contain a mapping of queries")
+    # Dates become strings, as in the compiled JSON, so the queries can be sent to the query function as JSON
+    return json.loads(json.dumps(config, default=encode_date))
+
+
+def compile_config(filename, destination=None):
+    """Compiles the YAML alias configuration into JSON at build time, failing on invalid aliases"""
+
+    with open(filename, 'rb') as stream:
+        source = stream.read()
+    config = parse_config(source)
+    invalid = {alias: validate_alias(alias, query) for alias, query in config['queries'].items() if validate_alias(alias, query)}
+    if invalid:
+        raise ValueError("Invalid aliases in {}: {}".format(filename, json.dumps(invalid)))
+    compiled = {'source_sha256': hashlib.sha256(source).hexdigest(), 'queries': config['queries']}
+    with open(destination or get_compiled_config_filename(filename), 'w') as stream:
+        json.dump(compiled, stream)
+    logging.info({'action': 'compile yaml', 'status': 'success', 'filename': filename, 'aliases': len(config['queries'])})
+
+
+def load_config(filename, source):
+    """Loads the alias configuration, preferring the compiled JSON if it was built from the same source"""
+
+    digest = hashlib.sha256(source).hexdigest()
+    try:
+        with open(get_compiled_config_filename(filename)) as stream:
+            compiled = json.load(stream)
+    except (OSError, ValueError):
+        compiled = {}
+
+    if compiled.get('source_sha256') == digest:
+        queries = compiled['queries']
+        logging.debug({'action': 'load yaml', 'status': 'compiled'})
+    else:
+        queries = parse_config(source)['queries']
+
+    # Structurally invalid aliases are dropped, aliases without credentials are still listed but refuse to run
+    config = {'queries': {}, 'invalid': {}}
+    for alias, query in queries.items():
+        reason = validate_alias(alias, query)
+        if reason is None:
+            config['queries'][alias] = query
+            if not all('SQL_{}_{}'.format(alias.upper(), suffix) in os.environ for suffix in ('USERNAME', 'PASSWORD')):
+                reason = "missing credentials SQL_{0}_USERNAME and SQL_{0}_PASSWORD".format(alias.upper())
+        if reason is not None:
+            logging.warning({'action': 'validate alias', 'status': 'failed', 'alias': alias, 'reason': reason})
+            config['invalid'][alias] = reason
+    return digest, config
+
+
+def get_config():
+    filename = os.environ.get('ALIAS_YAML_FILENAME', 'example.yml')
+    try:
+        mtime = os.stat(filename).st_mtime
+        if alias_config.get('filename') == filename and alias_config.get('mtime') == mtime:
+            return alias_config['config']
+
+        with open(filename, 'rb') as stream:
+            source = stream.read()
+        if alias_config.get('filename') == filename and alias_config.get('sha256') == hashlib.sha256(source).hexdigest():
+            alias_config['mtime'] = mtime
+            return alias_config['config']
+
+        digest, config = load_config(filename, source)
+    except (ValueError, KeyError, TypeError):
+        logging.exception({'action': 'load yaml', 'status': 'failed'})
+        raise
+    else:
+        logging.debug({'action': 'load yaml', 'status': 'success', 'config': config})
+    alias_config.update({'filename': filename, 'mtime': mtime, 'sha256': digest, 'config': config})
+    return config
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    compile_config(*sys.argv[1:3])
@@ -0,0 +1,50 @@
+"""Clients of the AWS services that stores shared between functions are kept in"""
+import os
+
+
+def get_client(service, endpoint_variable):
+    """Returns a boto3 client of service, at the endpoint in the environment variable endpoint_variable if it is set"""
+
+    # Only loaded when a store is configured, the query function otherwise never needs boto3
+    import boto3
+    return boto3.client(service, endpoint_url=os.environ.get(endpoint_variable))
+
+
+class S3Objects(object):
+    """Objects under a prefix of an S3 bucket, each with the time it was created in its metadata"""
+
+    def __init__(self, bucket, prefix):
+        import botocore.exceptions
+        self.client = get_client('s3', 'S3_ENDPOINT_URL')
+        self.client_error = botocore.exceptions.ClientError
+        self.bucket = bucket
+        self.prefix = prefix
+
+    def put(self, name, body, created):
+        self.client.put_object(Bucket=self.bucket, Key=self.prefix + name, Body=body, Metadata={'created': repr(created)})
+
+    def call(self, method, name):
+        """Returns the response of a head_object or get_object call for an object, or None if it doesn't exist"""
+
+        try:
+            return method(Bucket=self.bucket, Key=self.prefix + name)
+        except self.client_error as error:
+            if error.response.get('Error', {}).get('Code') not in ('404', 'NoSuchKey'):
+                raise
+            return None
+
+    def stat(self, name):
+        """Returns the creation time and size of an object, or None if it doesn't exist"""
+
+        head = self.call(self.client.head_object, name)
+        if head is None:
+            return None
+        return float(head['Metadata']['created']), head['ContentLength']
+
+    def open(self, name):
+        """Returns the creation time and a stream of the body of an object, or None if it doesn't exist"""
+
+        response = self.call(self.client.get_object, name)
+        if response is None:
+            return None
+        return float(response['Metadata']['created']), response['Body']
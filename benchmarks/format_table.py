@@ -0,0 +1,87 @@
+#!/usr/bin/env python3.6
+"""Compares formatting a large result from dictionary rows against the typed row pipeline
+
+The previous format_table built the table by repeated string concatenation, so its time grows
+quadratically with the number of rows; set BENCHMARK_ROWS=100000 to compare at that size.
+"""
+import datetime
+import decimal
+import io
+import os
+import sys
+from timeit import default_timer as timer
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import formatting  # noqa: E402
+from mysql.connector.constants import FieldType  # noqa: E402
+
+ROWS = int(os.environ.get('BENCHMARK_ROWS', 20000))
+DESCRIPTION = [
+    ('address_id', FieldType.LONG),
+    ('address', FieldType.VAR_STRING),
+    ('district', FieldType.VAR_STRING),
+    ('postal_code', FieldType.VAR_STRING),
+    ('amount', FieldType.NEWDECIMAL),
+    ('last_update', FieldType.TIMESTAMP),
+]
+
+
+def make_rows():
+    return [
+        (i, '{} Nagasaki Drive'.format(i), 'Kyushu', None if i % 7 else '{:05}'.format(i), decimal.Decimal(i) / 100, datetime.datetime(2017, 9, 10, 8, i % 60))
+        for i in range(ROWS)
+    ]
+
+
+def format_dictionaries(rows):
+    """The previous implementation: a dictionary per row and a str() per cell"""
+
+    names = [column[0] for column in DESCRIPTION]
+    myDict = [dict(zip(names, row)) for row in rows]
+    table = ""
+    colList = list(myDict[0].keys() if myDict else [])
+    myList = [colList]  # 1st row = header
+    for item in myDict:
+        myList.append([str(item[col] or '') for col in colList])
+    colSize = [max(map(len, col)) for col in zip(*myList)]
+    formatStr = ' | '.join(["{{:<{}}}".format(i) for i in colSize])
+    myList.insert(1, ['-' * i for i in colSize])  # Seperating line
+    for item in myList:
+        table = table + formatStr.format(*item) + "\n"
+    return table
+
+
+def format_tuples(rows):
+    """The typed pipeline used by run_query"""
+
+    names = [column[0] for column in DESCRIPTION]
+    widths = [len(name) for name in names]
+    converters = formatting.get_converters(DESCRIPTION)
+    batch_size = 500
+    converted = []
+    for i in range(0, len(rows), batch_size):
+        converted += formatting.convert_batch(converters, rows[i:i + batch_size], widths)
+    table = io.StringIO()
+    formatting.write_table(converted, names, table, widths)
+    return table.getvalue()
+
+
+def measure(function, rows, repeat=3):
+    best = None
+    for _ in range(repeat):
+        start = timer()
+        function(rows)
+        elapsed = timer() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main():
+    rows = make_rows()
+    dictionaries = measure(format_dictionaries, rows)
+    tuples = measure(format_tuples, rows)
+    print("{} rows: dictionaries {:.3f}s, tuples {:.3f}s, {:.1f}x faster".format(ROWS, dictionaries, tuples, dictionaries / tuples))
+
+
+if __name__ == '__main__':
+    main()
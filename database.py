@@ -0,0 +1,522 @@
+"""Pooled MySQL connections and streaming execution of alias queries"""
+import collections
+import json
+import logging
+import os
+import random
+import tempfile
+import threading
+import time
+from timeit import default_timer as timer
+
+import mysql.connector
+
+from formatting import convert_batch, get_converters, write_table
+from limiter import HostSlot
+from metrics import phase
+from snapshot import write_snapshot
+
+
+# Connections are kept between warm invocations, keyed by (mysql_host, mysql_database, mysql_username)
+connection_pool = {}
+# Queries of a multi-alias command run on threads, which share the pool
+pool_lock = threading.Lock()
+
+
+def get_pool_key(query):
+    return (query['mysql_host'], query['mysql_database'], query['mysql_username'])
+
+
+class CircuitOpenError(mysql.connector.errors.InterfaceError):
+    """Raised instead of connecting to a host whose circuit breaker is open"""
+
+    def __init__(self, host, retry_in):
+        super(CircuitOpenError, self).__init__("Circuit breaker for {} is open".format(host))
+        self.host = host
+        self.retry_in = retry_in
+
+
+class CircuitBreaker(object):
+    """Stops connecting to a host after MYSQL_BREAKER_FAILURES failures in a row
+
+    After MYSQL_BREAKER_RESET seconds a single half-open probe is let through, closing the breaker if it connects.
+    """
+
+    def __init__(self):
+        self.state = 'closed'
+        self.failures = 0
+        self.opened_at = None
+        self.lock = threading.Lock()
+
+    def get_retry_in(self):
+        return max(0, float(os.environ.get('MYSQL_BREAKER_RESET', 30)) - (time.time() - self.opened_at))
+
+    def allow(self):
+        with self.lock:
+            if self.state == 'closed':
+                return True
+            if self.state == 'open' and self.get_retry_in() <= 0:
+                self.state = 'half-open'
+                return True
+            return False
+
+    def record_success(self):
+        with self.lock:
+            self.state = 'closed'
+            self.failures = 0
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.state == 'half-open' or self.failures >= int(os.environ.get('MYSQL_BREAKER_FAILURES', 5)):
+                self.state = 'open'
+                self.opened_at = time.time()
+
+
+# Breakers are kept between warm invocations, keyed by mysql_host
+circuit_breakers = {}
+
+
+def get_circuit_breaker(host):
+    with pool_lock:
+        return circuit_breakers.setdefault(host, CircuitBreaker())
+
+
+def connect(query):
+    """Opens a new connection to the database of a query
+
+    Failed attempts, each waiting at most MYSQL_CONNECT_TIMEOUT seconds, are retried with jittered exponential
+    backoff for MYSQL_CONNECT_BUDGET seconds or until the query's deadline, unless the host's circuit breaker opens.
+    """
+
+    host = query['mysql_host']
+    # Read before the breaker lets an attempt through, so missing credentials can't leave it half-open
+    credentials = {'user': query['mysql_username'], 'password': query['mysql_password'], 'database': query['mysql_database']}
+    breaker = get_circuit_breaker(host)
+    if not breaker.allow():
+        logging.info({"action": "connect to mysql", "status": "circuit open", "host": host})
+        raise CircuitOpenError(host, breaker.get_retry_in())
+    # A host dropping packets fails as slowly as the timeouts allow, so the query's deadline alone is too long to wait
+    deadline = time.time() + float(os.environ.get('MYSQL_CONNECT_BUDGET', 10))
+    if query.get('deadline'):
+        deadline = min(deadline, query['deadline'])
+    timeout = int(os.environ.get('MYSQL_CONNECT_TIMEOUT', 5))
+    start = timer()
+    attempts = 0
+    while True:
+        attempts += 1
+        try:
+            cnx = mysql.connector.connect(
+                charset='utf8',
+                connect_timeout=max(1, min(timeout, int(deadline - time.time()))),
+                host=host,
+                port=query.get('mysql_port', 3306),
+                **credentials
+            )
+        except mysql.connector.errors.ProgrammingError:
+            # The server is up but refused the credentials or database, retrying won't help
+            breaker.record_success()
+            logging.info({"action": "connect to mysql", "status": "rejected", "attempts": attempts, "elapsed": timer() - start, "host": host})
+            raise
+        except (mysql.connector.errors.InterfaceError, mysql.connector.errors.OperationalError):
+            # Unreachable, or up but refusing connections, e.g. errno 1040 too many connections
+            breaker.record_failure()
+            delay = random.uniform(0, min(float(os.environ.get('MYSQL_CONNECT_BACKOFF_MAX', 4)), float(os.environ.get('MYSQL_CONNECT_BACKOFF_BASE', 0.2)) * 2 ** attempts))
+            logging.info({"action": "connect to mysql", "status": "failed", "attempts": attempts, "elapsed": timer() - start, "host": host, "breaker": breaker.state})
+            if breaker.state == 'open':
+                raise CircuitOpenError(host, breaker.get_retry_in())
+            if time.time() + delay >= deadline:
+                raise
+            time.sleep(delay)
+        except mysql.connector.errors.Error:
+            # Anything else still settles a half-open probe, or the breaker would never let another attempt through
+            breaker.record_failure()
+            logging.info({"action": "connect to mysql", "status": "error", "attempts": attempts, "elapsed": timer() - start, "host": host, "breaker": breaker.state})
+            raise
+        else:
+            breaker.record_success()
+            logging.info({"action": "connect to mysql", "status": "success", "attempts": attempts, "elapsed": timer() - start, "host": host})
+            return cnx
+
+
+def discard_connection(cnx):
+    """Closes a connection without raising, it may already be broken"""
+
+    try:
+        cnx.close()
+    except Exception:
+        logging.debug({"action": "discard connection", "status": "failed"})
+
+
+def get_connection(query):
+    """Returns a validated connection from the pool, or a new one if none are available"""
+
+    with phase('connect', query):
+        key = get_pool_key(query)
+        ttl = float(os.environ.get('MYSQL_POOL_TTL', 300))
+        while True:
+            with pool_lock:
+                idle = connection_pool.get(key)
+                if not idle:
+                    break
+                cnx, last_used = idle.pop()
+            if time.time() - last_used > ttl:
+                logging.info({"action": "get connection", "status": "expired", "host": key[0]})
+                discard_connection(cnx)
+                continue
+            start = timer()
+            try:
+                cnx.ping()
+            except mysql.connector.errors.Error:
+                logging.info({"action": "get connection", "status": "broken", "host": key[0]})
+                discard_connection(cnx)
+                continue
+            logging.info({"action": "get connection", "status": "hit", "host": key[0], "elapsed": timer() - start})
+            return cnx
+
+        logging.info({"action": "get connection", "status": "miss", "host": key[0]})
+        return connect(query)
+
+
+def release_connection(query, cnx):
+    """Returns a healthy connection to the pool so the next warm invocation can reuse it"""
+
+    key = get_pool_key(query)
+    ttl = float(os.environ.get('MYSQL_POOL_TTL', 300))
+    size = int(os.environ.get('MYSQL_POOL_SIZE', 2))
+    now = time.time()
+    with pool_lock:
+        for pool_key in list(connection_pool):
+            idle = []
+            for idle_cnx, last_used in connection_pool[pool_key]:
+                if now - last_used > ttl:
+                    discard_connection(idle_cnx)
+                else:
+                    idle.append((idle_cnx, last_used))
+            connection_pool[pool_key] = idle
+
+        pooled = sum(len(idle) for pool_key, idle in connection_pool.items() if pool_key[0] == key[0])
+        if pooled < size:
+            connection_pool.setdefault(key, []).append((cnx, now))
+            return
+    logging.info({"action": "release connection", "status": "pool full", "host": key[0], "pooled": pooled})
+    discard_connection(cnx)
+
+
+# Errors of statements stopped by KILL QUERY, MAX_EXECUTION_TIME and MariaDB's max_statement_time
+INTERRUPTED_ERRNOS = (1317, 3024, 1969)
+
+
+def set_execution_time_limit(cnx, seconds):
+    """Limits how long the server runs each statement of a connection, 0 removes the limit"""
+
+    cur = cnx.cursor()
+    try:
+        if 'MariaDB' in cnx.get_server_info():
+            cur.execute("SET SESSION max_statement_time = {:f}".format(seconds))
+        else:
+            cur.execute("SET SESSION MAX_EXECUTION_TIME = {:d}".format(int(seconds * 1000)))
+    except mysql.connector.errors.ProgrammingError:
+        # Servers older than MySQL 5.7.8 have no limit, the watchdog still applies
+        logging.warning({'action': 'set execution time limit', 'status': 'unsupported', 'server': cnx.get_server_info()})
+    else:
+        cnx.execution_time_limit = seconds
+    finally:
+        cur.close()
+
+
+def set_select_limit(cnx, rows):
+    """Limits the rows returned by each SELECT of a connection, None removes the limit"""
+
+    cur = cnx.cursor()
+    cur.execute("SET SESSION sql_select_limit = {}".format('DEFAULT' if rows is None else int(rows)))
+    cur.close()
+    cnx.select_limit = rows
+
+
+def kill_query(query, connection_id):
+    """Stops the running statement of a connection from a separate connection"""
+
+    logging.warning({'action': 'kill query', 'alias': query['alias'], 'connection_id': connection_id})
+    try:
+        side = connect(dict(query, deadline=time.time() + 5))
+        try:
+            cur = side.cursor()
+            cur.execute("KILL QUERY {:d}".format(connection_id))
+            cur.close()
+        finally:
+            discard_connection(side)
+    except mysql.connector.errors.Error:
+        logging.exception({'action': 'kill query', 'status': 'failed', 'alias': query['alias']})
+
+
+def start_watchdog(query, cnx):
+    """Kills the statement running on a connection if it's still running at the query's deadline"""
+
+    if query.get('deadline') is None:
+        return None
+    watchdog = threading.Timer(max(0, query['deadline'] - time.time()), kill_query, (query, cnx.connection_id))
+    watchdog.daemon = True
+    watchdog.start()
+    return watchdog
+
+
+def execute_prepared(cnx, sql, arguments):
+    """Executes a statement with arguments as a server-side prepared statement, returning its cursor
+
+    Prepared cursors are kept on the connection, so pooled connections skip parsing and planning on later runs.
+    The connector only reuses a prepared statement when it's passed the same string object, so that is kept too.
+    """
+
+    cursors = getattr(cnx, 'prepared_cursors', None)
+    if cursors is None:
+        cursors = cnx.prepared_cursors = collections.OrderedDict()
+    if sql in cursors:
+        cursors.move_to_end(sql)
+        cur, statement = cursors[sql]
+        logging.debug({'action': 'prepare statement', 'status': 'cached', 'statements': len(cursors)})
+    else:
+        cur, statement = cursors[sql] = (cnx.cursor(prepared=True), sql)
+        while len(cursors) > int(os.environ.get('PREPARED_STATEMENT_CACHE_SIZE', 16)):
+            evicted_sql, (evicted_cur, evicted_statement) = cursors.popitem(last=False)
+            evicted_cur.close()
+        logging.debug({'action': 'prepare statement', 'status': 'new', 'statements': len(cursors)})
+    try:
+        cur.execute(statement, tuple(arguments))
+    except:
+        # A statement that failed to prepare or run isn't kept
+        cursors.pop(sql, None)
+        raise
+    return cur
+
+
+def connect_for_query(query):
+    """Returns a connection for a query and None, or None and the message to post when it can't connect"""
+
+    logging.debug({'action': 'dumping query info', 'user': query['mysql_username'], 'password': query['mysql_password']})
+    try:
+        return get_connection(query), None
+    except CircuitOpenError as error:
+        return None, "Not connecting to {} after repeated connection failures, trying again in {:.0f} seconds.".format(error.host, error.retry_in)
+    except (mysql.connector.errors.InterfaceError, mysql.connector.errors.DatabaseError):
+        logging.exception({'action': 'connect to mysql', 'status': 'failed', 'host': query['mysql_host']})
+        return None, "Could not connect to {}.".format(query['mysql_host'])
+    except KeyError:
+        logging.exception({'action': 'connect to mysql', 'status': 'failed', 'credentials': 'absent'})
+        return None, "The SQL query (alias: {}) failed, are the credentials for this query configured?".format(query['alias'])
+
+
+def run_query(query, raw=None, on_queued=None):
+    """Takes a query from the configuration file, executes it and returns the result
+
+    The rows are also written to the binary file raw as a snapshot when one is given, see snapshot.write_snapshot.
+    Queries wait for a slot on the host they end up running on, after routing and per shard, see limiter.HostSlot.
+    """
+
+    if query.get('targets'):
+        from shards import run_sharded_query
+        return run_sharded_query(query, raw, on_queued)
+    if query.get('replicas') and query.get('on_expensive') != 'replica':
+        from router import run_routed_query
+        return run_routed_query(query, raw, on_queued)
+    if query.get('parallel'):
+        from parallel import run_parallel_query
+        return run_parallel_query(query, raw, on_queued)
+
+    slot = HostSlot(query, on_queued)
+    refusal = slot.acquire()
+    if refusal is not None:
+        return refusal
+    try:
+        return run_on_host(query, raw, slot, on_queued)
+    finally:
+        slot.release()
+
+
+def run_on_host(query, raw, slot, on_queued):
+    """Runs a query on its mysql_host while holding slot, see run_query"""
+
+    cnx, failure = connect_for_query(query)
+    if cnx is None:
+        return failure
+
+    notes = []
+    select_limit = None
+    if query.get('max_rows_examined'):
+        from admission import check_admission
+        estimate, decision = check_admission(query, cnx)
+        if decision == 'reject':
+            release_connection(query, cnx)
+            return "The alias {} would examine about {} rows, more than its max_rows_examined of {}, so it wasn't run.".format(query['alias'], estimate, query['max_rows_examined'])
+        if decision == 'replica':
+            # Expensive runs of aliases that otherwise stay on the writer go to a replica
+            release_connection(query, cnx)
+            # The replica takes a slot of its own
+            slot.release()
+            from router import run_routed_query
+            return run_routed_query(dict(query, max_rows_examined=None, on_expensive=None), raw, on_queued)
+        if decision == 'limit':
+            select_limit = int(query.get('expensive_limit', 1000))
+            notes.append("Limited to {} rows because alias {} would examine about {} rows.".format(select_limit, query['alias'], estimate))
+
+    max_rows = int(query.get('max_rows') or os.environ.get('MAX_RESULT_ROWS', 50000))
+    max_bytes = int(query.get('max_bytes') or os.environ.get('MAX_RESULT_BYTES', 20 * 1024 * 1024))
+    batch_size = int(os.environ.get('FETCH_BATCH_SIZE', 500))
+    result = ResultBuffer(int(os.environ.get('RESULT_SPILL_BYTES', 1024 * 1024)))
+    columns = []
+    widths = []
+    timed_out = False
+    watchdog = start_watchdog(query, cnx)
+    try:
+        start = timer()
+        limit = query.get('max_execution_time')
+        if limit or getattr(cnx, 'execution_time_limit', None):
+            # Pooled connections keep the limit of the alias that last used them until it's reset
+            set_execution_time_limit(cnx, limit or 0)
+        if select_limit or getattr(cnx, 'select_limit', None):
+            set_select_limit(cnx, select_limit)
+        with phase('execute', query):
+            if query.get('params'):
+                # Parameterized aliases run a single prepared statement, whose cursor stays with the connection
+                cur = None
+                items = [execute_prepared(cnx, query['sql'], query.get('arguments', []))]
+            else:
+                cur = cnx.cursor()
+                items = cur.execute(query['sql'], multi=True)
+        with phase('fetch', query):
+            for item in items:
+                if not item.with_rows:
+                    continue
+                converters = get_converters(item.description)
+                if len(converters) > len(columns):
+                    # Later result sets may be wider than the first, widen the table to fit them
+                    columns += [''] * (len(converters) - len(columns))
+                    widths += [0] * (len(converters) - len(widths))
+                for i, name in enumerate(item.column_names):
+                    if not columns[i]:
+                        columns[i] = name
+                        widths[i] = max(widths[i], len(name))
+                for batch in iter(lambda: item.fetchmany(batch_size), []):
+                    for row in convert_batch(converters, batch, widths):
+                        if result.count >= max_rows or result.size >= max_bytes:
+                            result.truncated = True
+                            break
+                        result.append(row, sum(map(len, row)))
+                    if result.truncated:
+                        break
+                if result.truncated:
+                    break
+    except Exception as error:
+        elapsed = timer() - start
+        discard_connection(cnx)
+        if getattr(error, 'errno', None) not in INTERRUPTED_ERRNOS:
+            logging.exception({'action': 'running query', 'status': 'failed', "elapsed": elapsed, 'query': query['sql']})
+            result.close()
+            return "The SQL query (alias: {}) failed, please check the logs for more information".format(query['alias'])
+        # The rows streamed before the server stopped the statement are still worth posting
+        logging.warning({'action': 'running query', 'status': 'timed out', "elapsed": elapsed, 'query': query['sql'], 'rows': result.count, 'errno': error.errno})
+        timed_out = True
+    else:
+        elapsed = timer() - start
+        logging.info({'action': 'running query', 'status': 'success', "elapsed": elapsed, 'query': query['sql'], 'rows': result.count, 'bytes': result.size, 'spilled': result.spill is not None, 'truncated': result.truncated})
+        if result.truncated:
+            # The rest of the result is still unread, so the connection can't be reused
+            discard_connection(cnx)
+        else:
+            if cur is not None:
+                cur.close()
+            release_connection(query, cnx)
+    finally:
+        if watchdog is not None:
+            watchdog.cancel()
+
+    partial = timed_out or result.truncated or select_limit is not None
+    if timed_out:
+        notes.append("Result truncated after {} rows because the query ran past its time limit.".format(result.count))
+    elif result.truncated:
+        notes.append("Result truncated after {} rows, raise max_rows or max_bytes for alias {} to see more.".format(result.count, query['alias']))
+    try:
+        with phase('format', query):
+            return write_snippet(result, columns, widths, notes, raw, partial)
+    finally:
+        result.close()
+
+
+def write_snippet(rows, columns, widths, notes=(), raw=None, partial=False):
+    """Formats converted rows as a table followed by notes, returning the UTF-8 snippet seeked to the start
+
+    The snippet's partial attribute tells whether rows were left out, by truncation, a time limit or failed shards.
+    """
+
+    # Kept as UTF-8 bytes so it can be uploaded from disk with a known length
+    snippet = tempfile.SpooledTemporaryFile(max_size=int(os.environ.get('RESULT_SPILL_BYTES', 1024 * 1024)), mode='w+b')
+    snippet.partial = partial
+    try:
+        if raw is not None:
+            write_snapshot(rows, columns, widths, notes, raw)
+        out = Utf8Writer(snippet)
+        write_table(rows, columns, out, widths)
+        if notes:
+            out.write("\n" + "".join(note + "\n" for note in notes))
+    except:
+        logging.exception({"action": "formatting as table", "status": "failed"})
+        snippet.close()
+        return "Formatting the query results failed."
+    snippet.seek(0)
+    return snippet
+
+
+class Utf8Writer(object):
+    """Writes text to a binary file object as UTF-8"""
+
+    def __init__(self, raw):
+        self.raw = raw
+
+    def write(self, text):
+        self.raw.write(text.encode('utf-8'))
+
+
+class ResultBuffer(object):
+    """Collects result rows in memory, spilling them to a temporary file once they pass spill_bytes"""
+
+    def __init__(self, spill_bytes):
+        self.spill_bytes = spill_bytes
+        self.rows = []
+        self.spill = None
+        self.count = 0
+        self.size = 0
+        self.truncated = False
+
+    def append(self, row, size):
+        self.count += 1
+        self.size += size
+        if self.spill is not None:
+            self.write_row(row)
+            return
+        self.rows.append(row)
+        if self.size > self.spill_bytes:
+            self.spill = self.open_spill()
+            for spilled in self.rows:
+                self.write_row(spilled)
+            self.rows = []
+            logging.info({'action': 'spill result', 'rows': self.count, 'bytes': self.size})
+
+    def open_spill(self):
+        return tempfile.TemporaryFile(mode='w+')
+
+    def write_row(self, row):
+        self.spill.write(json.dumps(row, default=str) + "\n")
+
+    def read_rows(self):
+        return (json.loads(line) for line in self.spill)
+
+    def __iter__(self):
+        if self.spill is None:
+            return iter(self.rows)
+        self.spill.seek(0)
+        return self.read_rows()
+
+    def close(self):
+        if self.spill is not None:
+            self.spill.close()
+        self.rows = []
@@ -0,0 +1,115 @@
+"""Queued delivery of snippets to Slack, retrying rate limited and failed uploads"""
+import collections
+import logging
+import os
+import random
+import shutil
+import tempfile
+import time
+from timeit import default_timer as timer
+
+import slack
+
+
+def get_deadline(context):
+    """Returns the time after which there isn't enough of the invocation left to try another upload"""
+
+    margin = float(os.environ.get('DELIVERY_MARGIN', 1.0))
+    try:
+        remaining = context.get_remaining_time_in_millis() / 1000.0
+    except AttributeError:
+        remaining = float(os.environ.get('DELIVERY_BUDGET', 30))
+    return timer() + remaining - margin
+
+
+def get_backoff(attempt):
+    """Returns a jittered exponential delay before retrying the given attempt"""
+
+    base = float(os.environ.get('DELIVERY_BACKOFF_BASE', 0.5))
+    cap = float(os.environ.get('DELIVERY_BACKOFF_MAX', 8))
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+def combine(posts):
+    """Joins the snippets of several posts into one file, each under its title"""
+
+    combined = tempfile.SpooledTemporaryFile(mode='w+b')
+    for post in posts:
+        if post['title']:
+            combined.write('{}\n'.format(post['title']).encode('utf-8'))
+        snippet = post['snippet']
+        if hasattr(snippet, 'read'):
+            snippet.seek(0)
+            shutil.copyfileobj(snippet, combined)
+        else:
+            combined.write(snippet.encode('utf-8'))
+        combined.write(b'\n')
+    combined.seek(0)
+    return combined
+
+
+class DeliveryQueue(object):
+    """Holds snippets until flushed, then uploads them with one post per channel
+
+    Transient failures are retried with backoff, or after Retry-After when Slack rate limits us,
+    for as long as the invocation has time left.
+    """
+
+    def __init__(self, context=None, correlation_id=None):
+        self.deadline = get_deadline(context)
+        self.correlation_id = correlation_id
+        self.pending = collections.OrderedDict()
+
+    def put(self, snippet, location, title=None):
+        self.pending.setdefault(location, []).append({'snippet': snippet, 'title': title, 'enqueued': timer()})
+
+    def flush(self):
+        """Delivers every pending post, returning a report per post and raising the first failure once all were tried"""
+
+        reports, failure = [], None
+        while self.pending:
+            location, posts = self.pending.popitem(last=False)
+            snippet = posts[0]['snippet'] if len(posts) == 1 else combine(posts)
+            try:
+                attempts = self.deliver(snippet, location)
+            except Exception as error:
+                failure = failure or error
+                status, attempts = 'failed', getattr(error, 'attempts', 1)
+            else:
+                status = 'success'
+            finally:
+                if len(posts) > 1:
+                    snippet.close()
+            for post in posts:
+                report = {'location': location, 'title': post['title'], 'status': status, 'latency': timer() - post['enqueued'], 'retries': attempts - 1, 'coalesced': len(posts)}
+                logging.info(dict(report, action='deliver snippet'))
+                reports.append(report)
+        if failure is not None:
+            raise failure
+        return reports
+
+    def deliver(self, snippet, location):
+        """Posts a snippet until it succeeds, returning the number of attempts"""
+
+        return self.retry('deliver snippet', location, lambda: slack.post_snippet(snippet, location, self.correlation_id))
+
+    def deliver_message(self, text, location, attachments=None):
+        """Posts a message right away, retried like snippets, returning the number of attempts"""
+
+        return self.retry('deliver message', location, lambda: slack.post_message(text, location, self.correlation_id, attachments))
+
+    def retry(self, action, location, post):
+        attempt = 0
+        while True:
+            attempt += 1
+            try:
+                post()
+            except slack.SlackError as error:
+                delay = error.retry_after if error.retry_after is not None else get_backoff(attempt)
+                if not error.transient or timer() + delay > self.deadline:
+                    error.attempts = attempt
+                    raise
+                logging.warning({'action': action, 'status': 'retrying', 'location': location, 'error': error.error, 'attempt': attempt, 'delay': delay})
+                time.sleep(delay)
+            else:
+                return attempt
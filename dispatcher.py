@@ -0,0 +1,99 @@
+"""Invocation of the query function from the command and button functions"""
+import json
+import logging
+import os
+import time
+from timeit import default_timer as timer
+
+import boto3
+import botocore.config
+from botocore.exceptions import ReadTimeoutError  # noqa: F401, raised to callers of invoke_query_handler_inline
+
+from metrics import phase
+
+
+# Created on first use and reused across warm invocations, one per read timeout
+lambda_clients = {}
+
+
+def get_lambda_client(read_timeout):
+    """Returns a Lambda client that doesn't retry, an invoke may already have run when it fails"""
+
+    client = lambda_clients.get(read_timeout)
+    if client is None:
+        config = botocore.config.Config(
+            connect_timeout=min(read_timeout, 10),
+            read_timeout=read_timeout,
+            retries={'max_attempts': 0}
+        )
+        client = boto3.client('lambda', config=config, endpoint_url=os.environ.get('LAMBDA_ENDPOINT_URL'))
+        lambda_clients[read_timeout] = client
+        logging.debug({'action': 'create lambda client', 'read_timeout': read_timeout})
+    return client
+
+
+def make_job(query, location, correlation_id, **kwargs):
+    """Returns the event for the query function, a list of queries is run by one invocation as a multi-alias job"""
+
+    job = {
+        'queries' if isinstance(query, list) else 'query': query,
+        'location': location,
+        'correlation_id': correlation_id
+    }
+    job.update(kwargs)
+    return job
+
+
+def invoke(client, job, invocation_type):
+    start = timer()
+    with phase('dispatch'):
+        resp = client.invoke(
+            FunctionName=os.environ['QUERY_HANDLER'],
+            InvocationType=invocation_type,
+            Payload=json.dumps(job)
+        )
+    logging.info({'action': 'invoke query_handler', 'status': 'success', 'invocation_type': invocation_type, 'elapsed': timer() - start, 'status_code': resp['StatusCode']})
+    return resp
+
+
+def dispatch(job):
+    """Asynchronously invokes the query function with a job, the aliases of one command go in a single job"""
+
+    return invoke(get_lambda_client(300), job, 'Event')
+
+
+def invoke_query_handler(query, location, correlation_id):
+    try:
+        dispatch(make_job(query, location, correlation_id))
+    except:
+        logging.exception({'action': 'invoke query_handler', 'status': 'failed', 'handler': os.environ.get('QUERY_HANDLER')})
+        raise
+
+
+class QueryHandlerError(Exception):
+    """Raised when a synchronous invocation of the query handler failed after it started running
+
+    It may already have posted, so it isn't invoked again.
+    """
+
+
+def invoke_query_handler_inline(query, location, correlation_id):
+    """Invokes the query handler synchronously, returning its result if it finished within the fast path budget
+
+    Returns None if the query handler posts the result itself, and raises ReadTimeoutError if it is still running.
+    The query handler only answers inline until FAST_PATH_MARGIN seconds before the client stops waiting, once
+    its answer is ready, so an answer sent in time arrives before the timeout and a late one is posted instead.
+    """
+
+    budget = float(os.environ.get('FAST_PATH_BUDGET', 2.0))
+    # Measured from before the request is sent, while the client's read timeout starts once it's sent
+    margin = float(os.environ.get('FAST_PATH_MARGIN', 0.5))
+    if not 0 < margin < budget:
+        raise ValueError("FAST_PATH_MARGIN must be between 0 and FAST_PATH_BUDGET")
+    job = make_job(query, location, correlation_id, respond_by=time.time() + budget - margin)
+    resp = invoke(get_lambda_client(budget), job, 'RequestResponse')
+    if resp.get('FunctionError'):
+        raise QueryHandlerError("Query handler failed: {}".format(resp['Payload'].read()))
+    payload = json.loads(resp['Payload'].read())
+    logging.info({'action': 'invoke query_handler inline', 'status': 'success', 'inline': 'snippet' in payload})
+    return payload.get('snippet')
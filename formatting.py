@@ -0,0 +1,81 @@
+"""Conversion of MySQL result rows to text and rendering them as a table"""
+import io
+
+
+# Not defined by mysql-connector 2.1
+FIELD_TYPE_JSON = 245
+
+
+def decode_text(value):
+    return value.decode('utf-8', 'replace') if isinstance(value, (bytes, bytearray)) else str(value)
+
+
+def decode_hex(value):
+    return '0x' + bytes(value).hex()
+
+
+def get_converter(field_type):
+    """Returns the function rendering values of a MySQL column type as text"""
+
+    # Imported here so the button function can render tables without loading the MySQL connector
+    from mysql.connector.constants import FieldType
+    if field_type in (FieldType.DECIMAL, FieldType.NEWDECIMAL):
+        return '{:f}'.format
+    if field_type == FieldType.GEOMETRY:
+        return decode_hex
+    if field_type in FieldType.get_string_types() or field_type in FieldType.get_binary_types() or field_type == FIELD_TYPE_JSON:
+        return decode_text
+    return str
+
+
+def get_converters(description):
+    """Builds one converter per column from a cursor's description"""
+
+    return [get_converter(column[1]) for column in description]
+
+
+def convert_column(convert, column):
+    """Converts the values of a column to text, NULL becomes an empty cell"""
+
+    types = set(map(type, column))
+    if types == {str}:
+        return list(column)
+    if type(None) in types:
+        return ['' if value is None else convert(value) for value in column]
+    return list(map(convert, column))
+
+
+def convert_batch(converters, batch, widths):
+    """Converts a batch of row tuples to text column by column, widening widths to fit"""
+
+    converted = [convert_column(convert, column) for convert, column in zip(converters, zip(*batch))]
+    for i, column in enumerate(converted):
+        widths[i] = max(widths[i], max(map(len, column)))
+    padding = [[''] * len(batch)] * (len(widths) - len(converted))
+    return list(zip(*(converted + padding)))
+
+
+def format_table(myDict, colList=None):
+    """ Pretty print a list of dictionaries (myDict) as a dynamically sized table.
+    If column names (colList) aren't specified, they will show in random order.
+    Author: Thierry Husson - Use it as you want but don't blame me.
+    """
+    if not colList:
+        colList = list(myDict[0].keys() if myDict else [])
+    widths = [len(col) for col in colList]
+    rows = []
+    if myDict:
+        rows = convert_batch([str] * len(colList), [[item[col] for col in colList] for item in myDict], widths)
+    table = io.StringIO()
+    write_table(rows, colList, table, widths)
+    return table.getvalue()
+
+
+def write_table(rows, colList, out, widths):
+    """Writes rows of text to a file object as a table with the given column widths"""
+
+    formatStr = ' | '.join(["{{:<{}}}".format(i) for i in widths])
+    out.write(formatStr.format(*colList) + "\n")
+    out.write(formatStr.format(*['-' * i for i in widths]) + "\n")  # Seperating line
+    for item in rows:
+        out.write(formatStr.format(*item) + "\n")
@@ -0,0 +1,129 @@
+"""Per-host limit on concurrent queries, shared between query functions through a semaphore backend
+
+Each host has a state of holders, mapping tokens to the time their lease expires, and waiters queued in
+arrival order, kept in a state store that updates it atomically.
+"""
+import logging
+import os
+import threading
+import time
+import uuid
+from timeit import default_timer as timer
+
+from state_store import get_state_store
+
+
+def new_state():
+    return {'holders': {}, 'waiters': [], 'avg_hold': None}
+
+
+def expire(state, now):
+    """Drops holders and waiters whose function died without releasing its slot"""
+
+    state['holders'] = {token: expires for token, expires in state['holders'].items() if expires > now}
+    state['waiters'] = [waiter for waiter in state['waiters'] if waiter[1] > now]
+
+
+def acquire_slot(state, token, limit, lease, now):
+    """Takes a slot if there's one free for everyone queued ahead, returning the queue position (0 once held) and average hold time"""
+
+    expire(state, now)
+    waiters = state['waiters']
+    tokens = [waiter[0] for waiter in waiters]
+    if token in tokens:
+        position = tokens.index(token)
+    else:
+        position = len(waiters)
+        waiters.append([token, 0])
+    if len(state['holders']) + position < limit:
+        waiters.pop(position)
+        state['holders'][token] = now + lease
+        return 0, state['avg_hold']
+    # Waiters keep their place as long as they keep polling
+    waiters[position][1] = now + float(os.environ.get('QUEUE_WAITER_TTL', 30))
+    return len(state['holders']) + position - limit + 1, state['avg_hold']
+
+
+def release_slot(state, token, held=None):
+    """Frees the slot or place in the queue of a token, folding how long it was held into the average"""
+
+    state['holders'].pop(token, None)
+    state['waiters'] = [waiter for waiter in state['waiters'] if waiter[0] != token]
+    if held is not None:
+        state['avg_hold'] = held if state['avg_hold'] is None else 0.3 * held + 0.7 * state['avg_hold']
+
+
+# Created on first use, HOST_CONCURRENCY_BACKEND selects between 'sqlite' and 'dynamodb', hosts aren't limited without one
+semaphore_backend = None
+semaphore_backend_lock = threading.Lock()
+
+
+def get_semaphore_backend():
+    global semaphore_backend
+    with semaphore_backend_lock:
+        if semaphore_backend is None:
+            semaphore_backend = get_state_store('HOST_CONCURRENCY', 'semaphores', '/tmp/host-semaphores.sqlite3')
+        return semaphore_backend
+
+
+class HostSlot(object):
+    """One of the HOST_CONCURRENCY slots of an alias's database host, waited for in a queue for up to QUEUE_WAIT_BUDGET seconds
+
+    on_queued is called with a message for the user once the query has to wait.
+    """
+
+    def __init__(self, query, on_queued=None):
+        self.query = query
+        self.on_queued = on_queued
+        self.backend = get_semaphore_backend()
+        self.host = query.get('mysql_host')
+        self.token = uuid.uuid4().hex
+        self.acquired = None
+
+    def acquire(self):
+        """Waits for a slot, returning None once held or a message for the user when the wait budget runs out"""
+
+        if self.backend is None or self.host is None:
+            return None
+        limit = int(self.query.get('host_concurrency') or os.environ.get('HOST_CONCURRENCY', 4))
+        lease = float(os.environ.get('HOST_CONCURRENCY_LEASE', 330))
+        poll = float(os.environ.get('QUEUE_POLL_INTERVAL', 1))
+        start = time.time()
+        deadline = start + float(self.query.get('queue_wait') or os.environ.get('QUEUE_WAIT_BUDGET', 60))
+        if self.query.get('deadline'):
+            deadline = min(deadline, self.query['deadline'])
+        notified = False
+        while True:
+            position, avg_hold = self.backend.update(self.host, new_state, lambda state: acquire_slot(state, self.token, limit, lease, time.time()))
+            if position == 0:
+                break
+            if not notified:
+                notified = True
+                self.notify(position, avg_hold, limit)
+            if time.time() + poll > deadline:
+                self.backend.update(self.host, new_state, lambda state: release_slot(state, self.token))
+                logging.warning({'action': 'acquire host slot', 'status': 'gave up', 'alias': self.query['alias'], 'host': self.host, 'position': position, 'waited': time.time() - start})
+                return "{} is busy with other queries, {} wasn't run after waiting {:.0f} seconds. Please try again later.".format(self.host, self.query['alias'], time.time() - start)
+            time.sleep(poll)
+        logging.info({'action': 'acquire host slot', 'status': 'success', 'alias': self.query['alias'], 'host': self.host, 'waited': time.time() - start})
+        self.acquired = timer()
+        return None
+
+    def notify(self, position, avg_hold, limit):
+        message = "{} is queued behind other queries on {}, at position {}".format(self.query['alias'], self.host, position)
+        if avg_hold is not None:
+            message += ", expect to wait about {:.0f} seconds".format(avg_hold * position / limit)
+        logging.info({'action': 'acquire host slot', 'status': 'queued', 'alias': self.query['alias'], 'host': self.host, 'position': position})
+        if self.on_queued is None:
+            return
+        try:
+            self.on_queued(message + ".")
+        except Exception:
+            logging.exception({'action': 'notify queued', 'status': 'failed', 'alias': self.query['alias']})
+
+    def release(self):
+        if self.acquired is None:
+            return
+        held = timer() - self.acquired
+        self.acquired = None
+        self.backend.update(self.host, new_state, lambda state: release_slot(state, self.token, held))
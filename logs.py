@@ -0,0 +1,95 @@
+"""Structured JSON logging shared by every function, set up once per container
+
+Messages are logged as dicts and only encoded by the formatter, so records below LOGLEVEL cost no more than
+building the dict. While a record is encoded, values under secret keys are redacted and large values are cut to
+a byte budget, without copying the events and configuration being logged.
+"""
+import json
+import logging
+import os
+
+
+# Values under these keys, at any depth, never reach the logs
+REDACTED_KEYS = frozenset(('password', 'mysql_password', 'token', 'secret', 'authorization'))
+
+
+def cut(text, budget):
+    if len(text) <= budget:
+        return text
+    return "{}... ({} characters)".format(text[:budget], len(text))
+
+
+def prepare(value, budget, max_items):
+    """Returns a value ready to encode, redacting secrets and cutting strings to budget and containers to max_items"""
+
+    if isinstance(value, dict):
+        prepared = {}
+        for i, (key, item) in enumerate(value.items()):
+            if i == max_items:
+                prepared['...'] = "{} more keys".format(len(value) - max_items)
+                break
+            prepared[key] = '********' if isinstance(key, str) and key.lower() in REDACTED_KEYS else prepare(item, budget, max_items)
+        return prepared
+    if isinstance(value, (list, tuple)):
+        prepared = [prepare(item, budget, max_items) for item in value[:max_items]]
+        if len(value) > max_items:
+            prepared.append("... {} more items".format(len(value) - max_items))
+        return prepared
+    if isinstance(value, str):
+        return cut(value, budget)
+    return value
+
+
+class Formatter(logging.Formatter):
+    """Encodes records as JSON lines, preparing dict messages first, tagged with the correlation id of the current request
+
+    Records are encoded here rather than by aws_lambda_logging, whose releases differ in how they treat dict messages.
+    """
+
+    def __init__(self, **fields):
+        super().__init__()
+        self.budget = int(os.environ.get('LOG_VALUE_BYTES', 1024))
+        self.max_items = int(os.environ.get('LOG_MAX_ITEMS', 50))
+        self.fields = {name: value for name, value in fields.items() if value}
+
+    def format(self, record):
+        entry = {
+            'timestamp': self.formatTime(record),
+            'level': record.levelname,
+            'location': '{}.{}:{}'.format(record.name, record.funcName, record.lineno)
+        }
+        entry.update(self.fields)
+        if isinstance(record.msg, dict):
+            entry['message'] = prepare(record.msg, self.budget, self.max_items)
+        else:
+            entry['message'] = cut(record.getMessage(), self.budget)
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry['exception'] = record.exc_text
+        return json.dumps(entry, default=lambda value: cut(str(value), self.budget))
+
+
+# Created on first use and kept across warm invocations, requests only change its correlation id
+formatter = None
+
+
+def setup():
+    """Installs the formatter on the handlers of the root logger and sets LOGLEVEL, once per container"""
+
+    global formatter
+    if formatter is None:
+        formatter = Formatter(env=os.environ.get('ENV'))
+        for handler in logging.root.handlers:
+            handler.setFormatter(formatter)
+        level = os.environ.get('LOGLEVEL', 'INFO')
+        for name in ('', 'boto', 'boto3', 'botocore'):
+            logging.getLogger(name).setLevel(level)
+        logging.debug({'action': 'set up logging', 'status': 'success'})
+
+
+def set_correlation_id(correlation_id):
+    """Tags the records that follow with the correlation id of a request"""
+
+    setup()
+    formatter.fields['correlation_id'] = correlation_id
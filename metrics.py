@@ -0,0 +1,124 @@
+"""Latency of each phase of an invocation, written as CloudWatch Embedded Metric Format records
+
+Handlers wrapped with traced time their whole invocation and, once it returns, write one record per alias and
+database host it touched to stdout, where CloudWatch turns them into metrics without any calls to its API. The
+code they run times its phases with `with phase('connect', query):`, so p50 and p95 of each phase can be graphed
+per function, alias and host, and looked up by correlation id in the logs.
+"""
+import contextlib
+import functools
+import json
+import logging
+import os
+import sys
+import threading
+import time
+from timeit import default_timer as timer
+
+
+# Taken when the container loads this module, the first invocation records the time since as its init phase
+loaded_at = timer()
+cold_start = True
+# The trace of the running invocation, a container runs one invocation at a time
+current = None
+
+
+class Trace(object):
+    """Total time spent in each phase of one invocation, kept apart per alias and host"""
+
+    def __init__(self, function, cold_start):
+        self.function = function
+        self.cold_start = cold_start
+        self.started = timer()
+        self.tags = {}
+        self.phases = {}
+        self.lock = threading.Lock()
+
+    def record(self, name, elapsed, query=None):
+        if query is not None:
+            labels = (query.get('alias'), query.get('mysql_host'))
+        else:
+            labels = (self.tags.get('alias'), self.tags.get('host'))
+        with self.lock:
+            phases = self.phases.setdefault(labels, {})
+            phases[name] = phases.get(name, 0) + elapsed * 1000
+
+    def get_records(self, namespace):
+        """Returns one Embedded Metric Format record per alias and host, timings in milliseconds"""
+
+        records = []
+        for (alias, host), phases in sorted(self.phases.items(), key=lambda item: [label or '' for label in item[0]]):
+            dimensions = [['function', 'start']]
+            record = {'function': self.function, 'start': 'cold' if self.cold_start else 'warm'}
+            if alias:
+                dimensions.append(['function', 'alias'])
+                record['alias'] = alias
+                if host:
+                    dimensions.append(['function', 'alias', 'host'])
+                    record['host'] = host
+            record['correlation_id'] = self.tags.get('correlation_id')
+            record['_aws'] = {
+                'Timestamp': int(time.time() * 1000),
+                'CloudWatchMetrics': [{
+                    'Namespace': namespace,
+                    'Dimensions': dimensions,
+                    'Metrics': [{'Name': name, 'Unit': 'Milliseconds'} for name in sorted(phases)]
+                }]
+            }
+            record.update(phases)
+            records.append(record)
+        return records
+
+
+def tag(**tags):
+    """Labels the phases that follow in the running invocation, with alias and host unless their query is given"""
+
+    if current is not None:
+        current.tags.update(tags)
+
+
+@contextlib.contextmanager
+def phase(name, query=None):
+    """Adds the time spent in the block to a phase of the running invocation, labelled with the alias and host of query"""
+
+    start = timer()
+    try:
+        yield
+    finally:
+        trace = current
+        if trace is not None:
+            trace.record(name, timer() - start, query)
+
+
+def emit(trace):
+    namespace = os.environ.get('METRICS_NAMESPACE', 'serverless-slack-curated-sql')
+    if not namespace:
+        return
+    try:
+        # Written around the logging formatter, CloudWatch only reads records that are whole lines of JSON
+        sys.stdout.write(''.join(json.dumps(record) + "\n" for record in trace.get_records(namespace)))
+        sys.stdout.flush()
+    except Exception:
+        logging.exception({'action': 'emit metrics', 'status': 'failed'})
+
+
+def traced(function):
+    """Wraps a handler so each of its invocations is traced under the name of its function"""
+
+    def decorator(handler):
+        @functools.wraps(handler)
+        def wrapper(event, context):
+            global cold_start, current
+            previous = current
+            trace = current = Trace(function, cold_start)
+            if cold_start:
+                trace.record('init', trace.started - loaded_at)
+                cold_start = False
+            try:
+                return handler(event, context)
+            finally:
+                trace.record('total', timer() - trace.started)
+                current = previous
+                emit(trace)
+        return wrapper
+    return decorator
@@ -0,0 +1,146 @@
+"""Results posted a page at a time with buttons, browsed and downloaded by the button function from their snapshot"""
+import csv
+import io
+import json
+import logging
+import os
+import tempfile
+
+import slack
+from formatting import write_table
+from snapshot import Snapshot, get_snapshot_store, save_snapshot
+
+
+# Identifies the buttons of paged results to the button function
+SNAPSHOT_CALLBACK_ID = 'snapshot'
+
+
+def get_page_rows():
+    return int(os.environ.get('PAGE_ROWS', 25))
+
+
+def render_page(snapshot, page, page_rows):
+    """Formats one page of a snapshot as a table, sized to the rows on the page"""
+
+    rows = snapshot.read_rows(page * page_rows, (page + 1) * page_rows)
+    widths = [max([len(column)] + [len(row[i]) for row in rows]) for i, column in enumerate(snapshot.columns)]
+    table = io.StringIO()
+    write_table(rows, snapshot.columns, table, widths)
+    return table.getvalue()
+
+
+def get_page_message(snapshot, snapshot_id, page, title):
+    """Returns the text and buttons of a page of a snapshot"""
+
+    page_rows = get_page_rows()
+    last_page = max(0, (snapshot.rows - 1) // page_rows)
+    page = min(max(0, page), last_page)
+    text = "{}: rows {}-{} of {}\n```{}```".format(title, page * page_rows + 1, min((page + 1) * page_rows, snapshot.rows), snapshot.rows, render_page(snapshot, page, page_rows))
+    if snapshot.notes:
+        text += "\n" + "\n".join(snapshot.notes)
+
+    def button(name, text, page):
+        return {"name": name, "text": text, "type": "button", "value": json.dumps({'snapshot': snapshot_id, 'page': page, 'title': title})}
+
+    actions = []
+    if page > 0:
+        actions.append(button('page', 'Previous page', page - 1))
+    if page < last_page:
+        actions.append(button('page', 'Next page', page + 1))
+    actions.append(button('csv', 'Download as CSV', page))
+    return {
+        "text": text,
+        "attachments": [{
+            "callback_id": SNAPSHOT_CALLBACK_ID,
+            "fallback": "Page {} of {} of {}".format(page + 1, last_page + 1, title),
+            "actions": actions
+        }]
+    }
+
+
+def post_first_page(raw, title, locations, queue):
+    """Stores the snapshot written to raw and posts its first page to each location through a DeliveryQueue
+
+    Returns the locations the page was posted to, none when there is nowhere to post, no snapshot or the result
+    fits on one page. The others still need the whole result.
+    """
+
+    if not locations or raw is None or raw.tell() == 0:
+        return []
+    raw.flush()
+    snapshot = Snapshot(raw)
+    try:
+        if snapshot.rows <= get_page_rows():
+            return []
+        snapshot_id = save_snapshot(raw)
+        message = get_page_message(snapshot, snapshot_id, 0, title)
+    finally:
+        snapshot.close()
+    posted = []
+    for location in locations:
+        try:
+            queue.deliver_message(message['text'], location, message['attachments'])
+        except Exception:
+            logging.exception({'action': 'post first page', 'status': 'failed', 'location': location})
+        else:
+            posted.append(location)
+    return posted
+
+
+def write_csv(snapshot):
+    """Writes every row of a snapshot as CSV to a binary file seeked to the start"""
+
+    out = tempfile.SpooledTemporaryFile(max_size=int(os.environ.get('RESULT_SPILL_BYTES', 1024 * 1024)), mode='w+b')
+    text = io.TextIOWrapper(out, encoding='utf-8', newline='')
+    writer = csv.writer(text)
+    writer.writerow(snapshot.columns)
+    batch = int(os.environ.get('FETCH_BATCH_SIZE', 500))
+    for start in range(0, snapshot.rows, batch):
+        writer.writerows(snapshot.read_rows(start, start + batch))
+    text.flush()
+    text.detach()
+    out.seek(0)
+    return out
+
+
+def export_csv(export, location, correlation_id):
+    """Uploads every row of a snapshot as CSV, run by the query function when the CSV button is pressed"""
+
+    store = get_snapshot_store()
+    snapshot = store.open(export['snapshot']) if store is not None else None
+    if snapshot is None:
+        logging.info({'action': 'export snapshot', 'status': 'expired', 'snapshot': export['snapshot']})
+        slack.post_message("This result of {} has expired, please run it again.".format(export['title']), location, correlation_id)
+        return
+    try:
+        with write_csv(snapshot) as result:
+            slack.post_snippet(result, location, correlation_id, '{}.csv'.format(export['title']))
+        logging.info({'action': 'export snapshot', 'status': 'success', 'snapshot': export['snapshot'], 'rows': snapshot.rows})
+    finally:
+        snapshot.close()
+
+
+def browse(payload, correlation_id):
+    """Answers a page or CSV button of a paged result, returning the body of the response
+
+    CSV downloads can take longer than Slack waits for an answer, so they are handed to the query function.
+    """
+
+    action = payload['actions'][0]
+    value = json.loads(action['value'])
+    store = get_snapshot_store()
+    snapshot = store.open(value['snapshot']) if store is not None else None
+    if snapshot is None:
+        logging.info({'action': 'browse snapshot', 'status': 'expired', 'snapshot': value['snapshot']})
+        return {"response_type": "ephemeral", "replace_original": False, "text": "This result of {} has expired, please run it again.".format(value['title'])}
+
+    try:
+        if action['name'] == 'csv':
+            from dispatcher import dispatch
+            dispatch({'export': {'snapshot': value['snapshot'], 'title': value['title']}, 'location': payload['channel']['id'], 'correlation_id': correlation_id})
+            logging.info({'action': 'browse snapshot', 'status': 'csv', 'snapshot': value['snapshot'], 'rows': snapshot.rows})
+            return {"response_type": "ephemeral", "replace_original": False, "text": "Uploading {} rows of {} as CSV...".format(snapshot.rows, value['title'])}
+        logging.info({'action': 'browse snapshot', 'status': 'page', 'snapshot': value['snapshot'], 'page': value['page']})
+        return dict(get_page_message(snapshot, value['snapshot'], value['page'], value['title']), response_type='in_channel', replace_original=True)
+    finally:
+        snapshot.close()
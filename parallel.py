@@ -0,0 +1,54 @@
+"""Concurrent execution of the independent statements of an alias, each posted as its own section"""
+import logging
+import os
+import shutil
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from timeit import default_timer as timer
+
+from database import run_query
+
+
+def run_statement(query, statement, on_queued=None):
+    """Runs one statement of an alias on its own pooled connection, returning its snippet and elapsed seconds"""
+
+    start = timer()
+    snippet = run_query(dict(query, sql=statement, parallel=False), on_queued=on_queued)
+    return snippet, timer() - start
+
+
+def get_section_title(i, statement, elapsed):
+    first_line = statement.strip().splitlines()[0]
+    if len(first_line) > 80:
+        first_line = first_line[:77] + '...'
+    return "Statement {} ({:.2f}s): {}".format(i + 1, elapsed, first_line)
+
+
+def run_parallel_query(query, raw=None, on_queued=None):
+    """Runs the statements of an alias concurrently on at most STATEMENT_CONCURRENCY connections
+
+    Every statement is formatted as its own table under a title with its timing. No snapshot is written to raw,
+    so these results are always uploaded whole.
+    """
+
+    statements = query['sql']
+    start = timer()
+    with ThreadPoolExecutor(max_workers=min(len(statements), int(os.environ.get('STATEMENT_CONCURRENCY', 4)))) as executor:
+        results = list(executor.map(lambda statement: run_statement(query, statement, on_queued), statements))
+    elapsed = timer() - start
+    timings = [statement_elapsed for snippet, statement_elapsed in results]
+    logging.info({'action': 'run parallel query', 'status': 'success', 'alias': query['alias'], 'elapsed': elapsed, 'statements': timings})
+
+    combined = tempfile.SpooledTemporaryFile(max_size=int(os.environ.get('RESULT_SPILL_BYTES', 1024 * 1024)), mode='w+b')
+    combined.partial = any(not hasattr(snippet, 'read') or getattr(snippet, 'partial', False) for snippet, statement_elapsed in results)
+    for i, (statement, (snippet, statement_elapsed)) in enumerate(zip(statements, results)):
+        combined.write("{}\n".format(get_section_title(i, statement, statement_elapsed)).encode('utf-8'))
+        if hasattr(snippet, 'read'):
+            with snippet:
+                shutil.copyfileobj(snippet, combined)
+        else:
+            combined.write("{}\n".format(snippet).encode('utf-8'))
+        combined.write(b'\n')
+    combined.write("Ran {} statements in {:.2f}s, the slowest took {:.2f}s\n".format(len(statements), elapsed, max(timings)).encode('utf-8'))
+    combined.seek(0)
+    return combined
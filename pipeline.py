@@ -0,0 +1,275 @@
+"""Pipelined execution of aliases, streaming rows from MySQL through formatting into a chunked upload to Slack
+
+The fetch and the upload block, so they run on threads, while an asyncio event loop formats the batches passed
+between them. The queues between the stages are bounded, a slow upload holds back the fetch instead of the result
+piling up in memory, and time to result approaches the slower of the query and the upload instead of their sum.
+"""
+import asyncio
+import concurrent.futures
+import logging
+import os
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from timeit import default_timer as timer
+
+import slack
+from database import (INTERRUPTED_ERRNOS, connect_for_query, discard_connection, execute_prepared, release_connection,
+                      set_execution_time_limit, set_select_limit, start_watchdog)
+from formatting import convert_batch, get_converters
+from limiter import HostSlot
+from metrics import phase
+
+
+# Ends the items of the queues between the stages
+END = None
+
+
+class PipelineStopped(Exception):
+    """Raised on the fetch and upload threads when another stage failed and the pipeline was stopped"""
+
+
+def start_table(columns, rows, tables):
+    """Returns the format string of a result set sized to its first rows, and the text of its header"""
+
+    widths = [max([len(column)] + [len(row[i]) for row in rows]) for i, column in enumerate(columns)]
+    formatStr = ' | '.join(["{{:<{}}}".format(i) for i in widths])
+    header = "\n" if tables else ""
+    header += formatStr.format(*columns) + "\n" + formatStr.format(*['-' * i for i in widths]) + "\n"
+    return formatStr, header
+
+
+class Pipeline(object):
+    """Moves the result of one query from a connection to Slack through fetch, format and upload stages
+
+    Everything uploaded is also written to a copy, which is complete even if the upload fails.
+    """
+
+    def __init__(self, query, cnx, locations, correlation_id=None):
+        self.query = query
+        self.cnx = cnx
+        self.locations = locations
+        self.correlation_id = correlation_id
+        self.copy = tempfile.SpooledTemporaryFile(max_size=int(os.environ.get('RESULT_SPILL_BYTES', 1024 * 1024)), mode='w+b')
+        self.count = 0
+        self.size = 0
+        self.truncated = False
+        self.upload_error = None
+        self.stopped = threading.Event()
+
+    def run(self):
+        """Runs the stages to completion, returning the copy seeked to the start and whether the upload succeeded"""
+
+        loop = asyncio.new_event_loop()
+        executor = ThreadPoolExecutor(max_workers=2)
+        start = timer()
+        try:
+            loop.run_until_complete(self.run_stages(loop, executor))
+        finally:
+            executor.shutdown()
+            loop.close()
+        logging.info({'action': 'run pipeline', 'status': 'success' if self.upload_error is None else 'upload failed', 'alias': self.query['alias'], 'elapsed': timer() - start, 'rows': self.count, 'bytes': self.copy.tell()})
+        self.copy.seek(0)
+        return self.copy, self.upload_error is None
+
+    async def run_stages(self, loop, executor):
+        self.loop = loop
+        maxsize = int(os.environ.get('PIPELINE_QUEUE_BATCHES', 4))
+        self.batches = asyncio.Queue(maxsize=maxsize)
+        self.chunks = asyncio.Queue(maxsize=maxsize)
+        fetching = loop.run_in_executor(executor, self.fetch)
+        self.uploading = loop.run_in_executor(executor, self.upload)
+        self.uploading.add_done_callback(self.on_upload_done)
+        try:
+            await self.format()
+        except Exception:
+            # The threads may be waiting on the formatter, which is gone, run() waits for them to notice
+            self.stopped.set()
+            raise
+        await fetching
+        try:
+            await self.uploading
+        except Exception as error:
+            # Logged by the upload, the caller posts the copy instead
+            self.upload_error = error
+
+    def wait(self, coroutine):
+        """Runs a coroutine on the event loop from a thread and returns its result, unless the pipeline is stopped first"""
+
+        future = asyncio.run_coroutine_threadsafe(coroutine, self.loop)
+        while True:
+            try:
+                return future.result(timeout=0.1)
+            except concurrent.futures.TimeoutError:
+                if self.stopped.is_set():
+                    future.cancel()
+                    raise PipelineStopped()
+
+    def put(self, item):
+        """Passes an item from the fetch thread to the formatter, waiting while the queue is full"""
+
+        self.wait(self.batches.put(item))
+
+    def fetch_batch(self, cursor, batch_size):
+        # Only the fetch itself, the stages overlap and time spent waiting on the formatter isn't fetching
+        with phase('fetch', self.query):
+            return cursor.fetchmany(batch_size)
+
+    def fetch(self):
+        """Runs the query on a thread, passing the column names of each result set and batches of its converted rows"""
+
+        query = self.query
+        cnx = self.cnx
+        max_rows = int(query.get('max_rows') or os.environ.get('MAX_RESULT_ROWS', 50000))
+        max_bytes = int(query.get('max_bytes') or os.environ.get('MAX_RESULT_BYTES', 20 * 1024 * 1024))
+        batch_size = int(os.environ.get('FETCH_BATCH_SIZE', 500))
+        notes = []
+        cur = None
+        watchdog = start_watchdog(query, cnx)
+        start = timer()
+        try:
+            limit = query.get('max_execution_time')
+            if limit or getattr(cnx, 'execution_time_limit', None):
+                set_execution_time_limit(cnx, limit or 0)
+            if getattr(cnx, 'select_limit', None):
+                set_select_limit(cnx, None)
+            with phase('execute', query):
+                if query.get('params'):
+                    items = [execute_prepared(cnx, query['sql'], query.get('arguments', []))]
+                else:
+                    cur = cnx.cursor()
+                    items = cur.execute(query['sql'], multi=True)
+            for item in items:
+                if not item.with_rows:
+                    continue
+                converters = get_converters(item.description)
+                self.put(('columns', list(item.column_names)))
+                for batch in iter(lambda: self.fetch_batch(item, batch_size), []):
+                    rows = []
+                    for row in convert_batch(converters, batch, [0] * len(converters)):
+                        if self.count >= max_rows or self.size >= max_bytes:
+                            self.truncated = True
+                            break
+                        self.count += 1
+                        self.size += sum(map(len, row))
+                        rows.append(row)
+                    if rows:
+                        self.put(('rows', rows))
+                    if self.truncated:
+                        break
+                if self.truncated:
+                    break
+        except PipelineStopped:
+            logging.warning({'action': 'running query', 'status': 'stopped', "elapsed": timer() - start, 'query': query['sql'], 'rows': self.count})
+            discard_connection(cnx)
+        except Exception as error:
+            elapsed = timer() - start
+            discard_connection(cnx)
+            if getattr(error, 'errno', None) not in INTERRUPTED_ERRNOS:
+                logging.exception({'action': 'running query', 'status': 'failed', "elapsed": elapsed, 'query': query['sql'], 'rows': self.count})
+                if self.count:
+                    notes.append("The SQL query (alias: {}) failed after {} rows, please check the logs for more information".format(query['alias'], self.count))
+                else:
+                    notes.append("The SQL query (alias: {}) failed, please check the logs for more information".format(query['alias']))
+            else:
+                logging.warning({'action': 'running query', 'status': 'timed out', "elapsed": elapsed, 'query': query['sql'], 'rows': self.count, 'errno': error.errno})
+                notes.append("Result truncated after {} rows because the query ran past its time limit.".format(self.count))
+        else:
+            logging.info({'action': 'running query', 'status': 'success', "elapsed": timer() - start, 'query': query['sql'], 'rows': self.count, 'bytes': self.size, 'truncated': self.truncated})
+            if self.truncated:
+                discard_connection(cnx)
+                notes.append("Result truncated after {} rows, raise max_rows or max_bytes for alias {} to see more.".format(self.count, query['alias']))
+            else:
+                if cur is not None:
+                    cur.close()
+                release_connection(query, cnx)
+        finally:
+            if watchdog is not None:
+                watchdog.cancel()
+            try:
+                self.put(('notes', notes))
+                self.put(END)
+            except PipelineStopped:
+                pass
+
+    async def format(self):
+        """Formats batches as they arrive, each result set as a table sized to its first batch
+
+        Later rows with wider cells than the first batch push the columns after them out of line.
+        """
+
+        columns = None
+        formatStr = None
+        tables = 0
+        while True:
+            item = await self.batches.get()
+            if item is END:
+                break
+            kind, value = item
+            text = ""
+            if kind != 'rows' and columns is not None:
+                # A result set without rows still gets its header
+                formatStr, text = start_table(columns, [], tables)
+                tables += 1
+                columns = None
+            if kind == 'columns':
+                columns = value
+            elif kind == 'rows':
+                if columns is not None:
+                    formatStr, text = start_table(columns, value, tables)
+                    tables += 1
+                    columns = None
+                text += "".join(formatStr.format(*row) + "\n" for row in value)
+            elif value:
+                text += ("\n" if tables else "") + "".join(note + "\n" for note in value)
+            await self.send(text.encode('utf-8'))
+        if self.copy.tell() == 0:
+            # Slack refuses empty files
+            await self.send(b"\n")
+        if not self.uploading.done():
+            await self.chunks.put(END)
+
+    async def send(self, chunk):
+        if not chunk:
+            return
+        self.copy.write(chunk)
+        if not self.uploading.done():
+            await self.chunks.put(chunk)
+
+    def upload(self):
+        """Uploads the chunks on a thread as the formatter passes them"""
+
+        def chunks():
+            while True:
+                # Raising aborts the upload, so a stopped pipeline never posts part of a result
+                chunk = self.wait(self.chunks.get())
+                if chunk is END:
+                    return
+                yield chunk
+
+        slack.post_stream(chunks(), self.locations, self.correlation_id)
+
+    def on_upload_done(self, future):
+        # Frees a formatter waiting on a full queue after a failed upload, the rest only goes to the copy
+        while not self.chunks.empty():
+            self.chunks.get_nowait()
+
+
+def run_pipelined_query(query, locations, correlation_id=None, on_queued=None):
+    """Runs a query once its host has a free slot, uploading its result to locations while it streams in
+
+    Returns the result and whether it was uploaded. A failed upload still returns the whole result for the caller
+    to post, as do messages about why the query couldn't run, which are never uploaded here.
+    """
+
+    slot = HostSlot(query, on_queued)
+    refusal = slot.acquire()
+    if refusal is not None:
+        return refusal, False
+    try:
+        cnx, failure = connect_for_query(query)
+        if cnx is None:
+            return failure, False
+        return Pipeline(query, cnx, locations, correlation_id).run()
+    finally:
+        slot.release()
@@ -0,0 +1,189 @@
+"""Caching of formatted results for aliases with a cache_ttl, concurrent execution of several aliases and refreshing materialized aliases"""
+import collections
+import hashlib
+import io
+import json
+import logging
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from timeit import default_timer as timer
+
+from database import run_query
+from result_store import get_materialization_key, get_result_store, open_materialization
+
+
+class MemoryResultCache(object):
+    """Formatted results kept in memory between warm invocations, evicting the least recently used past max_bytes"""
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.entries = collections.OrderedDict()
+        self.size = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+            return entry
+
+    def set(self, key, created, content):
+        with self.lock:
+            if key in self.entries:
+                self.size -= len(self.entries.pop(key)[1])
+            self.entries[key] = (created, content)
+            self.size += len(content)
+            while self.size > self.max_bytes:
+                evicted_key, (evicted_created, evicted_content) = self.entries.popitem(last=False)
+                self.size -= len(evicted_content)
+                logging.debug({'action': 'evict cached result', 'key': evicted_key})
+
+
+class SqliteResultCache(object):
+    """Formatted results kept in a local SQLite database, evicting the least recently used past max_bytes"""
+
+    def __init__(self, max_bytes, path):
+        self.max_bytes = max_bytes
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.lock = threading.Lock()
+        self.db.execute("CREATE TABLE IF NOT EXISTS results (key TEXT PRIMARY KEY, created REAL, used REAL, size INTEGER, content TEXT)")
+        self.db.commit()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.db.execute("SELECT created, content FROM results WHERE key = ?", (key,)).fetchone()
+            if entry is not None:
+                self.db.execute("UPDATE results SET used = ? WHERE key = ?", (time.time(), key))
+                self.db.commit()
+            return entry
+
+    def set(self, key, created, content):
+        with self.lock, self.db:
+            self.db.execute("INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?)", (key, created, time.time(), len(content), content))
+            size = self.db.execute("SELECT COALESCE(SUM(size), 0) FROM results").fetchone()[0]
+            for evicted_key, evicted_size in self.db.execute("SELECT key, size FROM results ORDER BY used").fetchall():
+                if size <= self.max_bytes:
+                    break
+                self.db.execute("DELETE FROM results WHERE key = ?", (evicted_key,))
+                size -= evicted_size
+                logging.debug({'action': 'evict cached result', 'key': evicted_key})
+
+
+# Created on first use, RESULT_CACHE_BACKEND selects between 'memory' and 'sqlite'
+result_cache = None
+result_cache_lock = threading.Lock()
+
+
+def get_result_cache():
+    global result_cache
+    with result_cache_lock:
+        if result_cache is None:
+            max_bytes = int(os.environ.get('RESULT_CACHE_MAX_BYTES', 10 * 1024 * 1024))
+            if os.environ.get('RESULT_CACHE_BACKEND', 'memory') == 'sqlite':
+                result_cache = SqliteResultCache(max_bytes, os.environ.get('RESULT_CACHE_PATH', '/tmp/result-cache.sqlite3'))
+            else:
+                result_cache = MemoryResultCache(max_bytes)
+        return result_cache
+
+
+def get_cache_key(query):
+    return hashlib.sha256(json.dumps([query['alias'], query['sql'], query.get('mysql_host'), query.get('mysql_database'), query.get('targets'), query.get('arguments'), query['mysql_username']]).encode('utf-8')).hexdigest()
+
+
+def run_limited_query(query, on_queued=None, raw=None):
+    """Runs a query once the hosts it runs on have free slots, returning its snippet and whether the result is complete
+
+    Refusals, errors and results missing rows, from truncation, time limits, on_expensive: limit or failed shards,
+    aren't complete.
+    """
+
+    snippet = run_query(query, raw, on_queued)
+    return snippet, hasattr(snippet, 'read') and not getattr(snippet, 'partial', False)
+
+
+def run_cached_query(query, on_queued=None, raw=None):
+    """Runs a query, serving it from the result cache instead if its alias has a cache_ttl and a fresh result exists
+
+    Aliases with a refresh interval are served from their latest materialization while it is fresh. A snapshot
+    of the rows is written to raw when one is given, except for results served from the cache.
+    """
+
+    if query.get('refresh'):
+        snippet = open_materialization(query, raw)
+        if snippet is not None:
+            return snippet
+
+    if not query.get('cache_ttl'):
+        return run_limited_query(query, on_queued, raw)[0]
+
+    cache = get_result_cache()
+    key = get_cache_key(query)
+    entry = cache.get(key)
+    if entry is not None and time.time() - entry[0] <= query['cache_ttl']:
+        age = int(time.time() - entry[0])
+        logging.info({'action': 'get cached result', 'status': 'hit', 'alias': query['alias'], 'age': age})
+        return "Cached result from {} seconds ago\n{}".format(age, entry[1])
+    logging.info({'action': 'get cached result', 'status': 'miss', 'alias': query['alias']})
+
+    created = time.time()
+    snippet, complete = run_limited_query(query, on_queued, raw)
+    if complete:
+        # Results too large for the cache are streamed as they are
+        snippet.seek(0, io.SEEK_END)
+        size = snippet.tell()
+        snippet.seek(0)
+        if size <= cache.max_bytes:
+            cache.set(key, created, snippet.read().decode('utf-8'))
+            snippet.seek(0)
+    return snippet
+
+
+def run_timed_query(query, on_queued=None):
+    start = timer()
+    snippet = run_cached_query(query, on_queued)
+    return snippet, timer() - start
+
+
+def run_cached_queries(queries, on_queued=None):
+    """Runs several queries concurrently on at most QUERY_CONCURRENCY threads, returning (snippet, elapsed) for each in order"""
+
+    start = timer()
+    with ThreadPoolExecutor(max_workers=min(len(queries), int(os.environ.get('QUERY_CONCURRENCY', 4)))) as executor:
+        results = list(executor.map(lambda query: run_timed_query(query, on_queued), queries))
+    logging.info({'action': 'run queries', 'status': 'success', 'aliases': [query['alias'] for query in queries], 'elapsed': timer() - start, 'slowest': max(elapsed for snippet, elapsed in results)})
+    return results
+
+
+def materialize(query):
+    """Runs the query of an alias and stores its snippet and raw rows, returning whether it succeeded"""
+
+    created = time.time()
+    spill_bytes = int(os.environ.get('RESULT_SPILL_BYTES', 1024 * 1024))
+    with tempfile.SpooledTemporaryFile(max_size=spill_bytes, mode='w+b') as raw:
+        snippet, complete = run_limited_query(query, raw=raw)
+        if not hasattr(snippet, 'read'):
+            # Errors and refusals keep the previous materialization
+            logging.error({'action': 'materialize', 'status': 'failed', 'alias': query['alias'], 'error': snippet})
+            return False
+        raw.seek(0)
+        with snippet:
+            try:
+                get_result_store().put(get_materialization_key(query), created, snippet, raw)
+            except Exception:
+                logging.exception({'action': 'store materialization', 'status': 'failed', 'alias': query['alias']})
+                return False
+    logging.info({'action': 'materialize', 'status': 'success', 'alias': query['alias'], 'elapsed': time.time() - created})
+    return True
+
+
+def materialize_queries(queries):
+    """Materializes several aliases concurrently on at most QUERY_CONCURRENCY threads, returning the aliases that failed"""
+
+    with ThreadPoolExecutor(max_workers=min(len(queries), int(os.environ.get('QUERY_CONCURRENCY', 4)))) as executor:
+        succeeded = list(executor.map(materialize, queries))
+    return [query['alias'] for query, success in zip(queries, succeeded) if not success]
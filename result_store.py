@@ -0,0 +1,213 @@
+"""Materialized results of aliases with a refresh interval, written by the refresh function and read by the others
+
+Each materialization holds the formatted snippet and a snapshot of the rows, see snapshot.write_snapshot.
+"""
+import hashlib
+import io
+import json
+import logging
+import os
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
+
+from aliases import parse_duration
+from aws import S3Objects
+from state_store import get_state_store
+
+
+class SqliteResultStore(object):
+    """Materializations in a SQLite database, which only serves functions sharing its file"""
+
+    def __init__(self, path):
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.lock = threading.Lock()
+        self.db.execute("CREATE TABLE IF NOT EXISTS materializations (key TEXT, suffix TEXT, created REAL, content BLOB, PRIMARY KEY (key, suffix))")
+        self.db.commit()
+
+    def put(self, key, created, snippet, raw):
+        with self.lock, self.db:
+            for suffix, content in (('.snapshot', raw), ('.txt', snippet)):
+                self.db.execute("INSERT OR REPLACE INTO materializations VALUES (?, ?, ?, ?)", (key, suffix, created, content.read()))
+
+    def stat(self, key):
+        """Returns the creation time and size of the snippet of a materialization, or None if there is none"""
+
+        with self.lock:
+            return self.db.execute("SELECT created, LENGTH(content) FROM materializations WHERE key = ? AND suffix = '.txt'", (key,)).fetchone()
+
+    def open(self, key, suffix='.txt'):
+        with self.lock:
+            return io.BytesIO(self.db.execute("SELECT content FROM materializations WHERE key = ? AND suffix = ?", (key, suffix)).fetchone()[0])
+
+
+class S3ResultStore(object):
+    """Materializations stored as objects under a prefix of an S3 bucket, with their creation time in the object metadata"""
+
+    def __init__(self, bucket, prefix):
+        self.objects = S3Objects(bucket, prefix)
+
+    def put(self, key, created, snippet, raw):
+        # The snippet is written last, a materialization isn't served before its raw rows exist
+        for suffix, content in (('.snapshot', raw), ('.txt', snippet)):
+            self.objects.put(key + suffix, content, created)
+
+    def stat(self, key):
+        return self.objects.stat(key + '.txt')
+
+    def open(self, key, suffix='.txt'):
+        created, body = self.objects.open(key + suffix)
+        return body
+
+
+# Created on first use, RESULT_STORE_BACKEND selects between 's3' and 'sqlite', aliases aren't materialized without one
+result_store = None
+result_store_lock = threading.Lock()
+
+
+def get_result_store():
+    global result_store
+    with result_store_lock:
+        if result_store is None:
+            backend = os.environ.get('RESULT_STORE_BACKEND')
+            if backend == 's3':
+                result_store = S3ResultStore(os.environ['RESULT_STORE_BUCKET'], os.environ.get('RESULT_STORE_PREFIX') or 'materializations/')
+            elif backend == 'sqlite':
+                result_store = SqliteResultStore(os.environ.get('RESULT_STORE_PATH', '/tmp/result-store.sqlite3'))
+        return result_store
+
+
+def get_materialization_key(query):
+    """Names the materialization of an alias, changing its query or database starts a new one"""
+
+    digest = hashlib.sha256(json.dumps([query['sql'], query.get('mysql_host'), query.get('mysql_database'), query.get('targets')]).encode('utf-8')).hexdigest()
+    return '{}-{}'.format(query['alias'], digest[:16])
+
+
+def describe_materialization(created):
+    return "Materialized at {}, {} seconds ago\n".format(time.strftime('%Y-%m-%d %H:%M:%S UTC', time.gmtime(created)), int(time.time() - created))
+
+
+def find_materialization(query):
+    """Returns the key, creation time and size of the materialization of an alias if it is fresh, otherwise None
+
+    A materialization stays fresh for two refresh intervals, so one failed refresh doesn't send users to the database.
+    """
+
+    store = get_result_store()
+    if store is None or not query.get('refresh'):
+        return None
+    key = get_materialization_key(query)
+    found = store.stat(key)
+    if found is None:
+        logging.info({'action': 'get materialization', 'status': 'miss', 'alias': query['alias']})
+        return None
+    created, size = found
+    age = time.time() - created
+    if age > 2 * parse_duration(query['refresh']):
+        logging.info({'action': 'get materialization', 'status': 'stale', 'alias': query['alias'], 'age': age})
+        return None
+    logging.info({'action': 'get materialization', 'status': 'hit', 'alias': query['alias'], 'age': age, 'size': size})
+    return key, created, size
+
+
+def read_small_materialization(query, max_bytes):
+    """Returns the text of a fresh materialization of an alias, or None if there is none or it is larger than max_bytes"""
+
+    found = find_materialization(query)
+    if found is None or found[2] > max_bytes:
+        return None
+    key, created, size = found
+    return describe_materialization(created) + get_result_store().open(key).read().decode('utf-8')
+
+
+def open_materialization(query, raw=None):
+    """Returns a fresh materialization of an alias as a snippet seeked to the start, or None if there is none
+
+    Its snapshot is copied to the binary file raw when one is given.
+    """
+
+    found = find_materialization(query)
+    if found is None:
+        return None
+    key, created, size = found
+    snippet = tempfile.SpooledTemporaryFile(max_size=int(os.environ.get('RESULT_SPILL_BYTES', 1024 * 1024)), mode='w+b')
+    snippet.write(describe_materialization(created).encode('utf-8'))
+    shutil.copyfileobj(get_result_store().open(key), snippet)
+    snippet.seek(0)
+    if raw is not None:
+        shutil.copyfileobj(get_result_store().open(key, '.snapshot'), raw)
+    return snippet
+
+
+def is_due(query, now):
+    """Returns True if the materialization of an alias is missing or will be older than its refresh interval by the next run"""
+
+    store = get_result_store()
+    found = store.stat(get_materialization_key(query))
+    # Refreshing up to one schedule interval early keeps the age of a materialization below its refresh interval
+    early = float(os.environ.get('REFRESH_SCHEDULE_INTERVAL', 60))
+    return found is None or now - found[0] >= parse_duration(query['refresh']) - early
+
+
+def new_lease():
+    return {'holder': None, 'expires': 0}
+
+
+def take_lease(state, token, ttl, now):
+    """Takes the lease to refresh an alias, returning False if another run holds it"""
+
+    if state['holder'] is not None and state['expires'] > now:
+        return False
+    state.update(holder=token, expires=now + ttl)
+    return True
+
+
+def end_lease(state, token):
+    if state['holder'] == token:
+        state.update(new_lease())
+
+
+# Created on first use, REFRESH_LEASE_BACKEND selects between 'sqlite' and 'dynamodb', refreshes may overlap without one
+lease_store = None
+lease_store_lock = threading.Lock()
+
+
+def get_lease_store():
+    global lease_store
+    with lease_store_lock:
+        if lease_store is None:
+            lease_store = get_state_store('REFRESH_LEASE', 'leases', '/tmp/refresh-leases.sqlite3')
+        return lease_store
+
+
+def claim_refresh(query, token, now):
+    """Returns True if an alias is due and token took the lease to refresh it, False if it isn't due or is being refreshed
+
+    Runs of the refresh function overlap when a refresh takes longer than the schedule interval. The lease
+    outlives the function's timeout, REFRESH_LEASE_TTL, so a run that died doesn't hold up the alias for long.
+    """
+
+    if not is_due(query, now):
+        return False
+    store = get_lease_store()
+    if store is None:
+        return True
+    key = get_materialization_key(query)
+    ttl = float(os.environ.get('REFRESH_LEASE_TTL', 330))
+    if not store.update(key, new_lease, lambda state: take_lease(state, token, ttl, time.time())):
+        logging.info({'action': 'claim refresh', 'status': 'leased', 'alias': query['alias']})
+        return False
+    if not is_due(query, time.time()):
+        # Refreshed by a run that finished between the check and the lease
+        release_refresh(query, token)
+        return False
+    return True
+
+
+def release_refresh(query, token):
+    store = get_lease_store()
+    if store is not None:
+        store.update(get_materialization_key(query), new_lease, lambda state: end_lease(state, token))
@@ -0,0 +1,114 @@
+"""Routing of aliases with replicas to the fastest healthy host"""
+import logging
+import os
+import threading
+import time
+from timeit import default_timer as timer
+
+import mysql.connector
+
+from database import discard_connection, get_connection, release_connection, run_query
+
+
+# Latency and failures of each host, kept between warm invocations
+host_stats = {}
+host_stats_lock = threading.Lock()
+
+
+def get_host_stats(host):
+    return host_stats.setdefault(host, {'connect': None, 'query': None, 'failed_at': None})
+
+
+def record_latency(host, kind, elapsed):
+    """Folds a latency sample into the exponentially weighted moving average of a host"""
+
+    alpha = float(os.environ.get('ROUTER_EWMA_ALPHA', 0.3))
+    with host_stats_lock:
+        stats = get_host_stats(host)
+        stats[kind] = elapsed if stats[kind] is None else alpha * elapsed + (1 - alpha) * stats[kind]
+        if kind == 'connect':
+            stats['failed_at'] = None
+
+
+def record_failure(host):
+    with host_stats_lock:
+        get_host_stats(host)['failed_at'] = time.time()
+
+
+def get_candidates(query):
+    """Orders the replicas of an alias by expected latency, leaving out recently failed ones, with the writer last"""
+
+    cooldown = float(os.environ.get('ROUTER_COOLDOWN', 30))
+    healthy, skipped = [], {}
+    with host_stats_lock:
+        for host in query['replicas']:
+            stats = get_host_stats(host)
+            if stats['failed_at'] is not None and time.time() - stats['failed_at'] < cooldown:
+                skipped[host] = 'failed {:.0f}s ago'.format(time.time() - stats['failed_at'])
+                continue
+            # Hosts without samples yet are tried first so every replica gets measured
+            healthy.append((sum(stats[kind] or 0 for kind in ('connect', 'query')), host))
+    return [host for latency, host in sorted(healthy)] + [query['mysql_host']], skipped
+
+
+def get_lag(cnx, lag_check):
+    """Runs the lag check of an alias, either SHOW SLAVE STATUS or a query returning seconds behind the writer"""
+
+    cur = cnx.cursor()
+    cur.execute(lag_check)
+    row = cur.fetchone()
+    columns = cur.column_names
+    cur.close()
+    if row is None:
+        return None
+    if 'Seconds_Behind_Master' in columns:
+        return row[columns.index('Seconds_Behind_Master')]
+    return row[0]
+
+
+def run_routed_query(query, raw=None, on_queued=None):
+    """Runs an alias on the lowest latency healthy replica, falling back to other replicas and then the writer"""
+
+    candidates, skipped = get_candidates(query)
+    writer = query['mysql_host']
+    routed = dict(query)
+    del routed['replicas']
+    for host in candidates:
+        routed['mysql_host'] = host
+        start = timer()
+        try:
+            cnx = get_connection(routed)
+        except (mysql.connector.errors.InterfaceError, mysql.connector.errors.DatabaseError):
+            record_failure(host)
+            skipped[host] = 'connect failed'
+            logging.warning({'action': 'route query', 'status': 'connect failed', 'alias': query['alias'], 'host': host})
+            continue
+        record_latency(host, 'connect', timer() - start)
+
+        lag = None
+        if host != writer and query.get('lag_check'):
+            try:
+                lag = get_lag(cnx, query['lag_check'])
+            except mysql.connector.errors.Error:
+                logging.exception({'action': 'check replica lag', 'status': 'failed', 'alias': query['alias'], 'host': host})
+                discard_connection(cnx)
+                record_failure(host)
+                skipped[host] = 'lag check failed'
+                continue
+            logging.info({'action': 'check replica lag', 'status': 'success', 'alias': query['alias'], 'host': host, 'lag': lag})
+            if query.get('max_lag') is not None and (lag is None or lag > query['max_lag']):
+                release_connection(routed, cnx)
+                skipped[host] = 'lagging {} seconds'.format(lag)
+                continue
+        # run_query picks the validated connection back up from the pool
+        release_connection(routed, cnx)
+        break
+    else:
+        logging.error({'action': 'route query', 'status': 'no host', 'alias': query['alias'], 'skipped': skipped})
+        return "Could not connect to {} or any of its replicas.".format(writer)
+
+    logging.info({'action': 'route query', 'status': 'success', 'alias': query['alias'], 'host': host, 'writer': host == writer, 'lag': lag, 'skipped': skipped, 'latency': host_stats[host]})
+    start = timer()
+    snippet = run_query(routed, raw, on_queued)
+    record_latency(host, 'query', timer() - start)
+    return snippet
@@ -0,0 +1,291 @@
+"""Fan-out of sharded aliases to every target and merging of their rows"""
+import collections
+import decimal
+import heapq
+import itertools
+import logging
+import os
+import pickle
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait
+from timeit import default_timer as timer
+
+from database import (INTERRUPTED_ERRNOS, ResultBuffer, discard_connection, execute_prepared, get_connection, kill_query,
+                      release_connection, set_execution_time_limit, set_select_limit, start_watchdog, write_snippet)
+from formatting import convert_batch, get_converters
+from limiter import HostSlot
+from metrics import phase
+
+
+class RawResultBuffer(ResultBuffer):
+    """Collects rows as the connector returned them, for merging, spilling them to a temporary file with pickle"""
+
+    def open_spill(self):
+        return tempfile.TemporaryFile()
+
+    def write_row(self, row):
+        pickle.dump(row, self.spill, pickle.HIGHEST_PROTOCOL)
+
+    def read_rows(self):
+        while True:
+            try:
+                yield pickle.load(self.spill)
+            except EOFError:
+                return
+
+
+def get_shard_name(target):
+    return target.get('name') or '{}/{}'.format(target['mysql_host'], target['mysql_database'])
+
+
+class HostBusyError(Exception):
+    """Raised for a shard whose host had no free slot within the queue wait budget"""
+
+
+def fetch_shard(query, max_rows, name, running, abandoned, on_queued=None):
+    """Runs a query against one shard, returning its description and up to max_rows raw rows in a RawResultBuffer
+
+    Each shard waits for a slot on its own host. The query and connection are kept in running under the shard's
+    name while it runs, so the query can be killed once the abandoned event is set. Rows streamed before the server
+    stopped a statement at its time limit are kept, with interrupted set.
+    """
+
+    slot = HostSlot(query, on_queued)
+    refusal = slot.acquire()
+    if refusal is not None:
+        raise HostBusyError(refusal)
+    try:
+        return fetch_shard_rows(query, max_rows, name, running, abandoned)
+    finally:
+        slot.release()
+
+
+def fetch_shard_rows(query, max_rows, name, running, abandoned):
+    start = timer()
+    batch_size = int(os.environ.get('FETCH_BATCH_SIZE', 500))
+    rows = RawResultBuffer(int(os.environ.get('RESULT_SPILL_BYTES', 1024 * 1024)))
+    description = []
+    interrupted = False
+    cnx = get_connection(query)
+    running[name] = (query, cnx)
+    if abandoned.is_set():
+        # Connected after the shard was given up on, too late for its query to be killed
+        running.pop(name, None)
+        release_connection(query, cnx)
+        return None
+    watchdog = start_watchdog(query, cnx)
+    try:
+        limit = query.get('max_execution_time')
+        if limit or getattr(cnx, 'execution_time_limit', None):
+            set_execution_time_limit(cnx, limit or 0)
+        if getattr(cnx, 'select_limit', None):
+            # Left on pooled connections by aliases with on_expensive: limit
+            set_select_limit(cnx, None)
+        with phase('execute', query):
+            if query.get('params'):
+                cur = None
+                items = [execute_prepared(cnx, query['sql'], query.get('arguments', []))]
+            else:
+                cur = cnx.cursor()
+                items = cur.execute(query['sql'], multi=True)
+        with phase('fetch', query):
+            for item in items:
+                if not item.with_rows:
+                    continue
+                if len(item.description) > len(description):
+                    description = item.description
+                for batch in iter(lambda: item.fetchmany(batch_size), []):
+                    if abandoned.is_set():
+                        rows.truncated = True
+                        break
+                    for row in batch:
+                        if rows.count >= max_rows:
+                            rows.truncated = True
+                            break
+                        rows.append(row, sum(len(str(value)) for value in row))
+                    if rows.truncated:
+                        break
+                if rows.truncated:
+                    break
+    except Exception as error:
+        discard_connection(cnx)
+        if getattr(error, 'errno', None) not in INTERRUPTED_ERRNOS:
+            rows.close()
+            raise
+        logging.warning({'action': 'run shard', 'status': 'timed out', 'alias': query['alias'], 'shard': name, 'rows': rows.count, 'errno': error.errno})
+        interrupted = True
+    else:
+        if rows.truncated:
+            # The rest of the result is still unread, so the connection can't be reused
+            discard_connection(cnx)
+        else:
+            if cur is not None:
+                cur.close()
+            release_connection(query, cnx)
+    finally:
+        running.pop(name, None)
+        if watchdog is not None:
+            watchdog.cancel()
+    return {'description': description, 'rows': rows, 'truncated': rows.truncated, 'interrupted': interrupted, 'elapsed': timer() - start}
+
+
+def kill_abandoned(running):
+    """Kills the queries of shards that are still running, so they don't keep their servers busy"""
+
+    abandoned = list(running.values())
+    if not abandoned:
+        return
+    with ThreadPoolExecutor(max_workers=len(abandoned)) as executor:
+        for query, cnx in abandoned:
+            executor.submit(kill_query, query, cnx.connection_id)
+
+
+def is_number(value):
+    return isinstance(value, (int, float, decimal.Decimal)) and not isinstance(value, bool)
+
+
+def merge_sum(rows, columns, group_by):
+    """Re-aggregates rows by the group_by columns, adding up the numeric columns of each group"""
+
+    keys = [columns.index(column) for column in group_by]
+    groups = collections.OrderedDict()
+    for row in rows:
+        key = tuple(row[i] for i in keys)
+        merged = groups.get(key)
+        if merged is None:
+            groups[key] = list(row)
+            continue
+        for i, value in enumerate(row):
+            if i in keys:
+                continue
+            if is_number(merged[i]) and is_number(value):
+                merged[i] += value
+            elif merged[i] is None:
+                merged[i] = value
+    return [tuple(row) for row in groups.values()]
+
+
+def merge_top(rows, columns, order_by, descending, limit):
+    """Returns the first limit rows ordered by a column, NULLs last, keeping only limit rows in memory"""
+
+    i = columns.index(order_by)
+    nulls = []
+
+    def not_null():
+        for row in rows:
+            if row[i] is not None:
+                yield row
+            elif len(nulls) < limit:
+                nulls.append(row)
+
+    ordered = (heapq.nlargest if descending else heapq.nsmallest)(limit, not_null(), key=lambda row: row[i])
+    return (ordered + nulls)[:limit]
+
+
+def merge_rows(query, rows, columns):
+    """Merges an iterator of the rows of every shard according to the merge mode of an alias"""
+
+    merge = query.get('merge', 'concat')
+    if merge == 'sum':
+        return iter(merge_sum(rows, columns, query.get('group_by', [])))
+    if merge == 'top':
+        return iter(merge_top(rows, columns, query['order_by'], query.get('descending', True), query.get('limit', 10)))
+    return itertools.islice(rows, query['limit']) if query.get('limit') else rows
+
+
+def run_sharded_query(query, raw=None, on_queued=None):
+    """Runs an alias against all of its targets concurrently and returns the merged result
+
+    Shards that fail or don't answer within shard_timeout seconds are left out and noted below the result, the
+    queries of those still running are killed.
+    """
+
+    max_rows = int(query.get('max_rows') or os.environ.get('MAX_RESULT_ROWS', 50000))
+    timeout = float(query.get('shard_timeout') or os.environ.get('SHARD_TIMEOUT', 60))
+    targets = query['targets']
+    start = timer()
+    executor = ThreadPoolExecutor(max_workers=min(len(targets), int(os.environ.get('SHARD_CONCURRENCY', 8))))
+    futures = collections.OrderedDict()
+    running = {}
+    abandoned = threading.Event()
+    for target in targets:
+        name = get_shard_name(target)
+        shard_query = dict(query, mysql_host=target['mysql_host'], mysql_database=target['mysql_database'])
+        del shard_query['targets']
+        futures[name] = executor.submit(fetch_shard, shard_query, max_rows, name, running, abandoned, on_queued)
+    done, late = wait(futures.values(), timeout=timeout)
+    abandoned.set()
+    for future in futures.values():
+        # Shards that haven't started won't be waited for
+        future.cancel()
+    kill_abandoned(running)
+    # Killed shards finish on their own, discarding their connections
+    executor.shutdown(wait=False)
+
+    shards, notes = [], []
+    for name, future in futures.items():
+        if future in late:
+            logging.warning({'action': 'run shard', 'status': 'timed out', 'alias': query['alias'], 'shard': name, 'timeout': timeout})
+            notes.append("Shard {} did not answer within {:g}s and was left out.".format(name, timeout))
+        elif future.exception() is not None:
+            logging.error({'action': 'run shard', 'status': 'failed', 'alias': query['alias'], 'shard': name, 'error': str(future.exception())})
+            notes.append("Shard {} failed and was left out: {}".format(name, future.exception()))
+        else:
+            shard = dict(future.result(), name=name)
+            logging.info({'action': 'run shard', 'status': 'success', 'alias': query['alias'], 'shard': name, 'elapsed': shard['elapsed'], 'rows': shard['rows'].count})
+            if shard['interrupted']:
+                notes.append("Shard {} was truncated after {} rows because its query ran past its time limit.".format(name, shard['rows'].count))
+            elif shard['truncated']:
+                notes.append("Shard {} was truncated after {} rows.".format(name, max_rows))
+            shards.append(shard)
+
+    try:
+        return merge_shards(query, shards, notes, max_rows, raw, start, len(targets))
+    finally:
+        for shard in shards:
+            shard['rows'].close()
+
+
+def merge_shards(query, shards, notes, max_rows, raw, start, targets):
+    """Merges the rows of the shards that answered into one snippet, converted in batches and spilled past RESULT_SPILL_BYTES"""
+
+    if not shards:
+        return "The SQL query (alias: {}) failed on every shard, please check the logs for more information".format(query['alias'])
+
+    description = max((shard['description'] for shard in shards), key=len)
+    columns = [column[0] for column in description]
+    converters = get_converters(description)
+    shard_column = query.get('shard_column') if query.get('merge', 'concat') != 'sum' else None
+    if shard_column:
+        columns = [shard_column] + columns
+        converters = [str] + converters
+    rows = ((shard['name'],) + tuple(row) if shard_column else row for shard in shards for row in shard['rows'])
+
+    widths = [len(column) for column in columns]
+    result = ResultBuffer(int(os.environ.get('RESULT_SPILL_BYTES', 1024 * 1024)))
+    batch_size = int(os.environ.get('FETCH_BATCH_SIZE', 500))
+    try:
+        merged = merge_rows(query, rows, columns)
+        for batch in iter(lambda: list(itertools.islice(merged, batch_size)), []):
+            for row in convert_batch(converters, batch, widths):
+                if result.count >= max_rows:
+                    result.truncated = True
+                    break
+                result.append(row, sum(map(len, row)))
+            if result.truncated:
+                break
+    except (KeyError, ValueError, TypeError):
+        logging.exception({'action': 'merge shards', 'status': 'failed', 'alias': query['alias']})
+        result.close()
+        return "Merging the shards of alias {} failed, check its merge settings.".format(query['alias'])
+    if result.truncated:
+        notes.append("Result truncated after {} rows, raise max_rows for alias {} to see more.".format(max_rows, query['alias']))
+
+    logging.info({'action': 'run sharded query', 'status': 'success', 'alias': query['alias'], 'elapsed': timer() - start, 'shards': len(shards), 'failed': targets - len(shards), 'rows': result.count})
+    try:
+        with phase('format', query):
+            # Every note is about rows left out, by a missing shard or truncation
+            return write_snippet(result, columns, widths, notes, raw, partial=bool(notes))
+    finally:
+        result.close()
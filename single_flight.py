@@ -0,0 +1,86 @@
+"""Coalescing of identical alias requests, so a query already running for someone else isn't run again
+
+The first request for a key becomes the flight's leader and runs the query. Identical requests arriving while
+it runs join as followers and end straight away, and the leader delivers its result to their channels too.
+"""
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+
+from state_store import get_state_store
+
+
+def new_flight():
+    return {'leader': None, 'expires': 0, 'followers': []}
+
+
+def get_flight_key(query):
+    return hashlib.sha256(json.dumps([query['alias'], query['sql'], query.get('mysql_host'), query.get('mysql_database'), query.get('targets'), query.get('arguments')]).encode('utf-8')).hexdigest()
+
+
+def board(state, token, follower, ttl, now):
+    """Joins a running flight as a follower, returning False, or takes off as its leader, returning True"""
+
+    if state['leader'] is not None and state['expires'] > now:
+        state['followers'].append(follower)
+        return False
+    state.update(new_flight(), leader=token, expires=now + ttl)
+    return True
+
+
+def land(state, token):
+    """Ends the flight of a leader, returning the followers to deliver to"""
+
+    if state['leader'] != token:
+        # The flight outlived its ttl and was taken over, its followers belong to the new leader
+        return []
+    followers = state['followers']
+    state.update(new_flight())
+    return followers
+
+
+# Created on first use, SINGLE_FLIGHT_BACKEND selects between 'sqlite' and 'dynamodb', requests aren't coalesced without one
+flight_store = None
+flight_store_lock = threading.Lock()
+
+
+def get_flight_store():
+    global flight_store
+    with flight_store_lock:
+        if flight_store is None:
+            flight_store = get_state_store('SINGLE_FLIGHT', 'flights', '/tmp/flights.sqlite3')
+        return flight_store
+
+
+class Flight(object):
+    """A request to run a query, coalesced with identical requests running at the same time"""
+
+    def __init__(self, query, location, correlation_id):
+        self.query = query
+        self.follower = {'location': location, 'correlation_id': correlation_id}
+        self.store = get_flight_store()
+        self.key = get_flight_key(query) if self.store is not None else None
+        self.token = uuid.uuid4().hex
+
+    def take_off(self):
+        """Returns True if this request should run the query, False if it joined a flight already running it"""
+
+        if self.store is None:
+            return True
+        ttl = float(os.environ.get('SINGLE_FLIGHT_TTL', 330))
+        leader = self.store.update(self.key, new_flight, lambda state: board(state, self.token, self.follower, ttl, time.time()))
+        logging.info({'action': 'take off', 'status': 'leader' if leader else 'follower', 'alias': self.query['alias'], 'key': self.key})
+        return leader
+
+    def land(self):
+        """Returns the channels and correlation ids of the requests that joined this flight"""
+
+        if self.store is None:
+            return []
+        followers = self.store.update(self.key, new_flight, lambda state: land(state, self.token))
+        logging.info({'action': 'land', 'alias': self.query['alias'], 'key': self.key, 'followers': len(followers)})
+        return followers
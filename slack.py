@@ -0,0 +1,221 @@
+"""Delivery of query results to Slack"""
+import gzip
+import io
+import itertools
+import json
+import logging
+import os
+import shutil
+import tempfile
+import uuid
+from timeit import default_timer as timer
+
+import requests
+import requests.adapters
+
+from metrics import phase
+
+# Created on first use and kept across warm invocations, so uploads reuse the connection to Slack
+session = None
+
+
+def get_session():
+    global session
+    if session is None:
+        session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=int(os.environ.get('SLACK_POOL_SIZE', 4)))
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+    return session
+
+
+class SlackError(Exception):
+    """A failed call to the Slack API, transient failures are worth retrying after retry_after seconds"""
+
+    def __init__(self, error, transient=False, retry_after=None):
+        super(SlackError, self).__init__(error)
+        self.error = error
+        self.transient = transient
+        self.retry_after = retry_after
+
+
+def get_api_url(method):
+    return '{}/{}'.format(os.environ.get('SLACK_API_URL', 'https://slack.com/api'), method)
+
+
+def get_multipart_envelope(boundary, fields, filename, content_type):
+    """Returns the encoded parts of a multipart/form-data body before and after the content of its file"""
+
+    head = ''.join(
+        '--{}\r\nContent-Disposition: form-data; name="{}"\r\n\r\n{}\r\n'.format(boundary, name, value)
+        for name, value in fields.items()
+    )
+    head += '--{}\r\nContent-Disposition: form-data; name="file"; filename="{}"\r\nContent-Type: {}\r\n\r\n'.format(boundary, filename, content_type)
+    tail = '\r\n--{}--\r\n'.format(boundary)
+    return head.encode('utf-8'), tail.encode('utf-8')
+
+
+class MultipartStream(object):
+    """A multipart/form-data body that reads its file part from disk as it is sent
+
+    The length is known up front, so requests streams it with a Content-Length instead of loading it into memory.
+    """
+
+    def __init__(self, fields, filename, stream, content_type='text/plain'):
+        self.boundary = uuid.uuid4().hex
+        head, tail = get_multipart_envelope(self.boundary, fields, filename, content_type)
+
+        stream.seek(0, io.SEEK_END)
+        size = stream.tell()
+        stream.seek(0)
+        self.parts = [io.BytesIO(head), stream, io.BytesIO(tail)]
+        self.len = len(head) + size + len(tail)
+        self.content_type = 'multipart/form-data; boundary={}'.format(self.boundary)
+
+    def read(self, size=-1):
+        chunks = []
+        while self.parts and size != 0:
+            chunk = self.parts[0].read(size)
+            if not chunk:
+                self.parts.pop(0)
+                continue
+            chunks.append(chunk)
+            if size > 0:
+                size -= len(chunk)
+        return b''.join(chunks)
+
+
+def compress(stream):
+    """Gzips a binary file object into a temporary file"""
+
+    compressed = tempfile.TemporaryFile()
+    with gzip.GzipFile(fileobj=compressed, mode='wb') as archive:
+        shutil.copyfileobj(stream, archive)
+    compressed.seek(0)
+    return compressed
+
+
+def check_upload(r):
+    """Returns the response of an upload or post, raising SlackError when Slack didn't accept it"""
+
+    if r.status_code == 429:
+        raise SlackError('ratelimited', transient=True, retry_after=float(r.headers.get('Retry-After', 1)))
+    if r.status_code >= 500:
+        raise SlackError('HTTP {}'.format(r.status_code), transient=True)
+    response = r.json()
+    if not response.get('ok'):
+        raise SlackError(response.get('error'), transient=response.get('error') == 'ratelimited')
+    return response
+
+
+def post_snippet(snippet, location, correlation_id=None, filename='result.txt'):
+    """Uploads a snippet to a channel, streaming it from disk when it is a file
+
+    Files of at least SLACK_GZIP_MIN_BYTES are uploaded gzipped, which Slack accepts as a gzip file.
+    """
+
+    url = get_api_url('files.upload')
+    data = {
+        'token': os.environ['SLACK_TOKEN'],
+        'channels': location
+    }
+    headers = {'Correlation-Id': correlation_id or ''}
+    timeout = (5, float(os.environ.get('SLACK_TIMEOUT', 60)))
+    compressed = None
+
+    start = timer()
+    try:
+        if hasattr(snippet, 'read'):
+            snippet.seek(0, io.SEEK_END)
+            size = snippet.tell()
+            snippet.seek(0)
+            gzip_min_bytes = int(os.environ.get('SLACK_GZIP_MIN_BYTES', 0))
+            if gzip_min_bytes and size >= gzip_min_bytes:
+                compressed = compress(snippet)
+                snippet, filename = compressed, filename + '.gz'
+                data['filetype'] = 'gzip'
+            body = MultipartStream(data, filename, snippet)
+            headers['Content-Type'] = body.content_type
+            with phase('upload'):
+                r = get_session().post(url, data=body, timeout=timeout, headers=headers)
+        else:
+            data['content'] = snippet
+            with phase('upload'):
+                r = get_session().post(url, data=data, timeout=timeout, headers=headers)
+        response = check_upload(r)
+    except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as error:
+        logging.exception({'action': 'post snippet', 'status': 'failed', 'location': location})
+        raise SlackError(str(error), transient=True)
+    except:
+        logging.exception({'action': 'post snippet', 'status': 'failed', 'location': location})
+        raise
+    else:
+        logging.info({'action': 'post snippet', 'status': 'success', 'elapsed': timer() - start, 'compressed': compressed is not None})
+        logging.debug({'action': 'post snippet', 'status': 'success', 'location': location, 'response': response})
+    finally:
+        if compressed is not None:
+            compressed.close()
+
+
+def post_stream(chunks, locations, correlation_id=None, filename='result.txt'):
+    """Uploads a snippet to several channels while it is still being written, from an iterator of UTF-8 chunks
+
+    Its length isn't known up front, so it is sent with chunked transfer encoding. The chunks can't be replayed,
+    so failed uploads aren't retried here and raise SlackError.
+    """
+
+    boundary = uuid.uuid4().hex
+    data = {
+        'token': os.environ['SLACK_TOKEN'],
+        'channels': ','.join(locations)
+    }
+    head, tail = get_multipart_envelope(boundary, data, filename, 'text/plain')
+    headers = {'Correlation-Id': correlation_id or '', 'Content-Type': 'multipart/form-data; boundary={}'.format(boundary)}
+    sent = 0
+
+    def body():
+        nonlocal sent
+        for chunk in itertools.chain([head], chunks, [tail]):
+            # An empty chunk would end a chunked body early
+            if chunk:
+                sent += len(chunk)
+                yield chunk
+
+    start = timer()
+    try:
+        with phase('upload'):
+            r = get_session().post(get_api_url('files.upload'), data=body(), timeout=(5, float(os.environ.get('SLACK_TIMEOUT', 60))), headers=headers)
+        response = check_upload(r)
+    except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as error:
+        logging.exception({'action': 'post stream', 'status': 'failed', 'locations': locations, 'bytes': sent})
+        raise SlackError(str(error), transient=True)
+    except:
+        logging.exception({'action': 'post stream', 'status': 'failed', 'locations': locations, 'bytes': sent})
+        raise
+    else:
+        logging.info({'action': 'post stream', 'status': 'success', 'elapsed': timer() - start, 'bytes': sent})
+        logging.debug({'action': 'post stream', 'status': 'success', 'locations': locations, 'response': response})
+
+
+def post_message(text, location, correlation_id=None, attachments=None):
+    """Posts a short text message to a channel, with attachments such as buttons"""
+
+    data = {
+        'token': os.environ['SLACK_TOKEN'],
+        'channel': location,
+        'text': text
+    }
+    if attachments:
+        data['attachments'] = json.dumps(attachments)
+    try:
+        with phase('upload'):
+            r = get_session().post(get_api_url('chat.postMessage'), data=data, timeout=(5, float(os.environ.get('SLACK_TIMEOUT', 60))), headers={'Correlation-Id': correlation_id or ''})
+        check_upload(r)
+    except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as error:
+        logging.exception({'action': 'post message', 'status': 'failed', 'location': location})
+        raise SlackError(str(error), transient=True)
+    except:
+        logging.exception({'action': 'post message', 'status': 'failed', 'location': location})
+        raise
+    else:
+        logging.info({'action': 'post message', 'status': 'success', 'location': location})
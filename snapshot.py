@@ -0,0 +1,211 @@
+"""Compact columnar snapshots of query results, written once by the query function and paged through by the button function
+
+A snapshot starts with MAGIC, the length of a JSON header and the header, holding the columns, widths, notes,
+number of rows and where each column starts after the header. Every column is an array of rows + 1 little-endian
+uint64 offsets followed by the UTF-8 text of its cells, so any slice of rows is read without decoding the rest.
+"""
+import array
+import json
+import logging
+import mmap
+import os
+import shutil
+import struct
+import sys
+import tempfile
+import threading
+import time
+import uuid
+
+from aws import S3Objects
+
+
+MAGIC = b'SNAP\x01'
+OFFSET = struct.Struct('<Q')
+
+
+def write_snapshot(rows, columns, widths, notes, out):
+    """Writes rows of text to a binary file object as a snapshot, one column at a time"""
+
+    offsets = [array.array('Q', [0]) for column in columns]
+    cells = [tempfile.TemporaryFile() for column in columns]
+    try:
+        count = 0
+        for row in rows:
+            count += 1
+            for i, value in enumerate(row):
+                encoded = value.encode('utf-8')
+                cells[i].write(encoded)
+                offsets[i].append(offsets[i][-1] + len(encoded))
+        starts, start = [], 0
+        for i in range(len(columns)):
+            starts.append(start)
+            start += OFFSET.size * (count + 1) + offsets[i][-1]
+        header = json.dumps({'columns': columns, 'widths': widths, 'notes': list(notes), 'rows': count, 'starts': starts}).encode('utf-8')
+        out.write(MAGIC + struct.pack('<I', len(header)) + header)
+        for i in range(len(columns)):
+            if sys.byteorder != 'little':
+                offsets[i].byteswap()
+            out.write(offsets[i].tobytes())
+            cells[i].seek(0)
+            shutil.copyfileobj(cells[i], out)
+    finally:
+        for column in cells:
+            column.close()
+
+
+class Snapshot(object):
+    """A snapshot file mapped into memory, reading only the rows asked for"""
+
+    def __init__(self, stream):
+        self.map = mmap.mmap(stream.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.map[:len(MAGIC)] != MAGIC:
+            self.map.close()
+            raise ValueError("Not a snapshot")
+        length = struct.unpack_from('<I', self.map, len(MAGIC))[0]
+        self.data = len(MAGIC) + 4 + length
+        header = json.loads(self.map[len(MAGIC) + 4:self.data].decode('utf-8'))
+        self.columns = header['columns']
+        self.widths = header['widths']
+        self.notes = header['notes']
+        self.rows = header['rows']
+        self.starts = header['starts']
+
+    def read_column(self, i, start, stop):
+        base = self.data + self.starts[i]
+        offsets = struct.unpack_from('<{}Q'.format(stop - start + 1), self.map, base + OFFSET.size * start)
+        cells = base + OFFSET.size * (self.rows + 1)
+        return [self.map[cells + offsets[j]:cells + offsets[j + 1]].decode('utf-8') for j in range(stop - start)]
+
+    def read_rows(self, start, stop):
+        """Returns the rows from start up to stop as tuples of text"""
+
+        start, stop = max(0, start), min(stop, self.rows)
+        if start >= stop:
+            return []
+        return list(zip(*(self.read_column(i, start, stop) for i in range(len(self.columns)))))
+
+    def close(self):
+        self.map.close()
+
+
+class SnapshotDirectory(object):
+    """Snapshot files in a local directory, removed once older than ttl or, least recently read first, past max_bytes"""
+
+    def __init__(self, path, max_bytes, ttl):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        os.makedirs(path, exist_ok=True)
+
+    def get_path(self, snapshot_id):
+        return os.path.join(self.path, snapshot_id + '.snapshot')
+
+    def add(self, snapshot_id, stream, created):
+        """Copies a snapshot from the position of stream into the directory, its modification time records when it was created"""
+
+        path = self.get_path(snapshot_id)
+        with open(path + '.partial', 'wb') as partial:
+            shutil.copyfileobj(stream, partial)
+        os.utime(path + '.partial', (time.time(), created))
+        os.rename(path + '.partial', path)
+        self.evict()
+
+    def open(self, snapshot_id):
+        """Returns a snapshot in the directory, or None if it isn't there or has expired"""
+
+        path = self.get_path(snapshot_id)
+        with self.lock:
+            try:
+                created = os.stat(path).st_mtime
+            except OSError:
+                return None
+            if time.time() - created > self.ttl:
+                os.remove(path)
+                return None
+            # The access time tracks reads for eviction, it isn't updated on every file system
+            os.utime(path, (time.time(), created))
+            with open(path, 'rb') as stream:
+                return Snapshot(stream)
+
+    def evict(self):
+        with self.lock:
+            now = time.time()
+            files = []
+            for name in os.listdir(self.path):
+                if not name.endswith('.snapshot'):
+                    continue
+                path = os.path.join(self.path, name)
+                stat = os.stat(path)
+                if now - stat.st_mtime > self.ttl:
+                    os.remove(path)
+                    logging.debug({'action': 'evict snapshot', 'reason': 'expired', 'snapshot': name})
+                else:
+                    files.append((stat.st_atime, stat.st_size, path))
+            size = sum(file_size for used, file_size, path in files)
+            for used, file_size, path in sorted(files):
+                if size <= self.max_bytes:
+                    break
+                os.remove(path)
+                size -= file_size
+                logging.debug({'action': 'evict snapshot', 'reason': 'size', 'snapshot': os.path.basename(path)})
+
+
+class S3SnapshotStore(object):
+    """Snapshots under a prefix of an S3 bucket, read through a local directory so pages are read from a mapped file
+
+    Expired snapshots are no longer served, a lifecycle rule on the prefix deletes them.
+    """
+
+    def __init__(self, bucket, prefix, directory):
+        self.objects = S3Objects(bucket, prefix)
+        self.directory = directory
+
+    def add(self, snapshot_id, stream, created):
+        self.objects.put(snapshot_id, stream, created)
+
+    def open(self, snapshot_id):
+        snapshot = self.directory.open(snapshot_id)
+        if snapshot is not None:
+            return snapshot
+        found = self.objects.open(snapshot_id)
+        if found is None:
+            return None
+        created, body = found
+        if time.time() - created > self.directory.ttl:
+            return None
+        self.directory.add(snapshot_id, body, created)
+        return self.directory.open(snapshot_id)
+
+
+# Created on first use, SNAPSHOT_BACKEND selects between 's3' and 'local', results aren't paged without one
+snapshot_store = None
+snapshot_store_lock = threading.Lock()
+
+
+def get_snapshot_store():
+    global snapshot_store
+    with snapshot_store_lock:
+        if snapshot_store is None:
+            backend = os.environ.get('SNAPSHOT_BACKEND')
+            if backend in ('s3', 'local'):
+                directory = SnapshotDirectory(
+                    os.environ.get('SNAPSHOT_PATH', '/tmp/snapshots'),
+                    int(os.environ.get('SNAPSHOT_MAX_BYTES', 256 * 1024 * 1024)),
+                    float(os.environ.get('SNAPSHOT_TTL', 86400))
+                )
+                snapshot_store = directory
+                if backend == 's3':
+                    snapshot_store = S3SnapshotStore(os.environ['SNAPSHOT_BUCKET'], os.environ.get('SNAPSHOT_PREFIX') or 'snapshots/', directory)
+        return snapshot_store
+
+
+def save_snapshot(stream):
+    """Stores a snapshot written to a binary file object, returning its id"""
+
+    snapshot_id = uuid.uuid4().hex
+    stream.seek(0)
+    get_snapshot_store().add(snapshot_id, stream, time.time())
+    logging.info({'action': 'save snapshot', 'status': 'success', 'snapshot': snapshot_id, 'bytes': stream.tell()})
+    return snapshot_id
@@ -0,0 +1,77 @@
+"""Small JSON states shared between functions and updated atomically, for coordinating query functions"""
+import json
+import logging
+import os
+import sqlite3
+import threading
+
+from aws import get_client
+
+
+class SqliteStateStore(object):
+    """States in a SQLite table, which only coordinates functions sharing its file"""
+
+    def __init__(self, path, table):
+        self.db = sqlite3.connect(path, timeout=30, isolation_level=None, check_same_thread=False)
+        self.table = table
+        self.db.execute("CREATE TABLE IF NOT EXISTS {} (key TEXT PRIMARY KEY, state TEXT)".format(table))
+        self.lock = threading.Lock()
+
+    def update(self, key, default, change):
+        """Applies change to the state of a key, or to default() if it has none, within one write transaction, returning its result"""
+
+        with self.lock:
+            self.db.execute("BEGIN IMMEDIATE")
+            try:
+                row = self.db.execute("SELECT state FROM {} WHERE key = ?".format(self.table), (key,)).fetchone()
+                state = json.loads(row[0]) if row else default()
+                result = change(state)
+                self.db.execute("INSERT OR REPLACE INTO {} VALUES (?, ?)".format(self.table), (key, json.dumps(state)))
+            except:
+                self.db.execute("ROLLBACK")
+                raise
+            self.db.execute("COMMIT")
+        return result
+
+
+class DynamoDBStateStore(object):
+    """States in a DynamoDB table keyed by the string attribute pk, shared by every function
+
+    Updates are optimistic, a write conditional on the version read is retried when another function got there first.
+    """
+
+    def __init__(self, table):
+        self.client = get_client('dynamodb', 'DYNAMODB_ENDPOINT_URL')
+        self.table = table
+
+    def update(self, key, default, change):
+        while True:
+            item = self.client.get_item(TableName=self.table, Key={'pk': {'S': key}}, ConsistentRead=True).get('Item')
+            state = json.loads(item['state']['S']) if item else default()
+            version = int(item['version']['N']) if item else 0
+            result = change(state)
+            condition = {'ConditionExpression': 'attribute_not_exists(pk)'} if item is None else {
+                'ConditionExpression': 'version = :version',
+                'ExpressionAttributeValues': {':version': {'N': str(version)}}
+            }
+            try:
+                self.client.put_item(
+                    TableName=self.table,
+                    Item={'pk': {'S': key}, 'state': {'S': json.dumps(state)}, 'version': {'N': str(version + 1)}},
+                    **condition
+                )
+            except self.client.exceptions.ConditionalCheckFailedException:
+                logging.debug({'action': 'update state', 'status': 'conflict', 'table': self.table, 'key': key})
+                continue
+            return result
+
+
+def get_state_store(prefix, table, path):
+    """Returns the store selected by <prefix>_BACKEND, 'sqlite' at <prefix>_PATH or 'dynamodb' in <prefix>_TABLE, None if unset"""
+
+    backend = os.environ.get(prefix + '_BACKEND')
+    if backend == 'sqlite':
+        return SqliteStateStore(os.environ.get(prefix + '_PATH', path), table)
+    if backend == 'dynamodb':
+        return DynamoDBStateStore(os.environ[prefix + '_TABLE'])
+    return None
@@ -0,0 +1,104 @@
+"""Local HTTP stand-ins for the AWS and Slack APIs"""
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class StubServer(object):
+    """Serves canned responses on localhost and records the requests it receives
+
+    respond is called with the request path, headers and body and returns (status, headers, body). The arrival
+    times of the chunks of chunked bodies are kept in chunk_times, each read chunk_delay seconds after the last,
+    like a slow upload.
+    """
+
+    def __init__(self, respond, chunk_delay=0):
+        self.requests = []
+        self.chunk_times = []
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_POST(self):
+                body = self.read_body()
+                stub.requests.append((self.path, dict(self.headers), body))
+                status, headers, content = respond(self.path, self.headers, body)
+                if not isinstance(content, bytes):
+                    content = json.dumps(content).encode('utf-8')
+                self.send_response(status)
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                self.send_header('Content-Length', str(len(content)))
+                self.end_headers()
+                self.wfile.write(content)
+
+            def read_body(self):
+                if self.headers.get('Transfer-Encoding') == 'chunked':
+                    chunks = []
+                    while True:
+                        time.sleep(chunk_delay)
+                        size = int(self.rfile.readline().strip(), 16)
+                        chunks.append(self.rfile.read(size))
+                        stub.chunk_times.append(time.time())
+                        self.rfile.readline()
+                        if size == 0:
+                            return b''.join(chunks)
+                return self.rfile.read(int(self.headers.get('Content-Length', 0)))
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.url = 'http://127.0.0.1:{}'.format(self.server.server_port)
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class DynamoDBTable(object):
+    """Answers GetItem and PutItem like DynamoDB, for tables keyed by a single attribute
+
+    Only the conditions attribute_not_exists(key) and attribute = :value are understood.
+    """
+
+    def __init__(self, key):
+        self.key = key
+        self.items = {}
+        self.lock = threading.Lock()
+
+    def __call__(self, path, headers, body):
+        request = json.loads(body.decode('utf-8'))
+        operation = headers['X-Amz-Target'].split('.')[1]
+        with self.lock:
+            if operation == 'GetItem':
+                item = self.items.get(request['Key'][self.key]['S'])
+                return 200, {}, {'Item': item} if item else {}
+            if operation == 'PutItem':
+                item = request['Item']
+                if not self.check(self.items.get(item[self.key]['S']), request):
+                    return 400, {}, {'__type': 'com.amazonaws.dynamodb.v20120810#ConditionalCheckFailedException', 'message': 'The conditional request failed'}
+                self.items[item[self.key]['S']] = item
+                return 200, {}, {}
+        return 400, {}, {'__type': 'com.amazon.coral.validate#ValidationException', 'message': operation}
+
+    def check(self, current, request):
+        condition = request.get('ConditionExpression')
+        if condition is None:
+            return True
+        if condition.startswith('attribute_not_exists'):
+            return current is None
+        name, value = [part.strip() for part in condition.split('=')]
+        return current is not None and current.get(name) == request['ExpressionAttributeValues'][value]
@@ -0,0 +1,98 @@
+import unittest
+from unittest.mock import patch
+
+from mysql.connector.constants import FieldType
+
+import admission
+from aliases import validate_alias
+from database import connection_pool, run_query
+from tests.test_database import FakeConnection, FakeCursor
+
+PLAN_COLUMNS = [('id', FieldType.LONGLONG), ('select_type', FieldType.VAR_STRING), ('table', FieldType.VAR_STRING), ('rows', FieldType.LONGLONG)]
+
+
+class ScriptedConnection(FakeConnection):
+    """Answers each statement with the rows of the first script entry its text starts with"""
+
+    def __init__(self, host, plan):
+        super(ScriptedConnection, self).__init__()
+        self.host = host
+        self.script = [
+            ('EXPLAIN', plan, PLAN_COLUMNS),
+            ('SELECT MAX(CREATE_TIME)', [('2018-06-01 00:00:00',)], [('version', FieldType.DATETIME)]),
+            ('SET', [], []),
+            ('SELECT', [(host,)], [('host', FieldType.VAR_STRING)]),
+        ]
+        self.executed = []
+
+    def cursor(self, **kwargs):
+        connection = self
+
+        class ScriptedCursor(FakeCursor):
+            def execute(self, operation, multi=False):
+                connection.executed.append(operation)
+                rows, description = next((rows, description) for prefix, rows, description in connection.script if operation.startswith(prefix))
+                FakeCursor.__init__(self, rows, description)
+                return iter([self])
+
+        return ScriptedCursor([], [])
+
+
+class AdmissionTest(unittest.TestCase):
+    def setUp(self):
+        connection_pool.clear()
+        admission.explain_cache.clear()
+        admission.schema_versions.clear()
+        self.query = {'alias': 'getstats', 'sql': 'SELECT host FROM stats JOIN hosts USING (host_id);', 'mysql_host': 'writer', 'mysql_database': 'sakila', 'mysql_username': 'user', 'mysql_password': 'password', 'max_rows_examined': 10000}
+        # A join of 200 by 100 rows, and a subquery of 50
+        self.plan = [(1, 'PRIMARY', 'stats', 200), (1, 'PRIMARY', 'hosts', 100), (2, 'SUBQUERY', 'users', 50)]
+        self.connections = {}
+
+    def tearDown(self):
+        connection_pool.clear()
+        admission.explain_cache.clear()
+        admission.schema_versions.clear()
+
+    def connect(self, query):
+        cnx = ScriptedConnection(query['mysql_host'], self.plan)
+        self.connections.setdefault(query['mysql_host'], []).append(cnx)
+        return cnx
+
+    def run_query(self, **settings):
+        with patch('database.connect', side_effect=self.connect):
+            snippet = run_query(dict(self.query, **settings))
+        if isinstance(snippet, str):
+            return snippet
+        with snippet:
+            return snippet.read().decode('utf-8')
+
+    def test_estimates_rows(self):
+        self.assertEqual(admission.estimate_rows(self.plan, ['id', 'select_type', 'table', 'rows']), 20050)
+
+    def test_rejects_expensive_alias(self):
+        self.assertEqual(self.run_query(), "The alias getstats would examine about 20050 rows, more than its max_rows_examined of 10000, so it wasn't run.")
+
+    def test_runs_cheap_alias(self):
+        self.assertEqual(self.run_query(max_rows_examined=100000), 'host  \n------\nwriter\n')
+
+    def test_caches_estimate(self):
+        self.run_query()
+        self.run_query()
+        executed = self.connections['writer'][0].executed
+        self.assertEqual(sum(operation.startswith('EXPLAIN') for operation in executed), 1)
+        self.assertEqual(sum(operation.startswith('SELECT MAX(CREATE_TIME)') for operation in executed), 1)
+
+    def test_routes_to_replica(self):
+        self.assertEqual(self.run_query(on_expensive='replica', replicas=['replica-1']), 'host     \n---------\nreplica-1\n')
+
+    def test_limits_rows(self):
+        result = self.run_query(on_expensive='limit', expensive_limit=5)
+        self.assertIn('Limited to 5 rows because alias getstats would examine about 20050 rows.', result)
+        self.run_query(max_rows_examined=100000)
+        executed = self.connections['writer'][0].executed
+        self.assertEqual([operation for operation in executed if operation.startswith('SET')], ['SET SESSION sql_select_limit = 5', 'SET SESSION sql_select_limit = DEFAULT'])
+
+    def test_validates_action(self):
+        self.assertEqual(validate_alias('getstats', dict(self.query, sql='SELECT 1', on_expensive='replica')), 'on_expensive replica needs replicas')
+        sharded = dict(self.query, sql='SELECT 1', targets=[{'mysql_host': 'db-1', 'mysql_database': 'shop'}])
+        self.assertEqual(validate_alias('getstats', sharded), "max_rows_examined and on_expensive can't be combined with targets")
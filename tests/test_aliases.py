@@ -0,0 +1,99 @@
+import json
+import os
+import shutil
+import tempfile
+import time
+import unittest
+from unittest.mock import patch
+
+from aliases import alias_config, bind_params, compile_config, get_config, parse_duration, validate_alias
+from dispatcher import dispatch, make_job
+
+
+class AliasConfigTest(unittest.TestCase):
+    def setUp(self):
+        alias_config.clear()
+        self.directory = tempfile.mkdtemp()
+        self.filename = os.path.join(self.directory, 'aliases.yml')
+        self.write("queries:\n  getstats:\n    sql: SELECT 1\n    mysql_host: db\n    mysql_database: sakila\n  broken:\n    sql: SELECT 1\n")
+
+    def tearDown(self):
+        alias_config.clear()
+        shutil.rmtree(self.directory)
+
+    def write(self, content, mtime=None):
+        with open(self.filename, 'w') as stream:
+            stream.write(content)
+        if mtime is not None:
+            os.utime(self.filename, (mtime, mtime))
+
+    def get_config(self):
+        with patch.dict(os.environ, {'ALIAS_YAML_FILENAME': self.filename, 'SQL_GETSTATS_USERNAME': 'user', 'SQL_GETSTATS_PASSWORD': 'password'}):
+            return get_config()
+
+    def test_validates_aliases_once(self):
+        config = self.get_config()
+        self.assertEqual(list(config['queries']), ['getstats'])
+        self.assertEqual(config['invalid'], {'broken': 'missing mysql_host, mysql_database'})
+        with patch('ruamel.yaml.safe_load') as safe_load:
+            self.assertIs(self.get_config(), config)
+            self.assertFalse(safe_load.called)
+
+    def test_reloads_when_file_changes(self):
+        self.get_config()
+        self.write("queries:\n  getstats:\n    sql: SELECT 2\n    mysql_host: db\n    mysql_database: sakila\n", mtime=time.time() + 10)
+        self.assertEqual(self.get_config()['queries']['getstats']['sql'], 'SELECT 2')
+
+    def test_uses_compiled_config(self):
+        self.write("queries:\n  getstats:\n    sql: SELECT 1\n    mysql_host: db\n    mysql_database: sakila\n")
+        compile_config(self.filename)
+        with patch('ruamel.yaml.safe_load') as safe_load:
+            self.assertIn('getstats', self.get_config()['queries'])
+            self.assertFalse(safe_load.called)
+
+    def write_date_default(self):
+        self.write("queries:\n  getstats:\n    sql: SELECT %s\n    mysql_host: db\n    mysql_database: sakila\n    params:\n      - name: since\n        type: date\n        default: 2020-01-31\n")
+
+    def test_compiles_date_defaults(self):
+        self.write_date_default()
+        compile_config(self.filename)
+        with patch('ruamel.yaml.safe_load') as safe_load:
+            self.assertEqual(self.get_config()['queries']['getstats']['params'][0]['default'], '2020-01-31')
+            self.assertFalse(safe_load.called)
+
+    def test_dispatches_date_defaults_loaded_from_yaml(self):
+        self.write_date_default()
+        query = self.get_config()['queries']['getstats']
+        with patch.dict(os.environ, {'QUERY_HANDLER': 'slack-curated-sql-query'}), patch('dispatcher.get_lambda_client') as client:
+            client.return_value.invoke.return_value = {'StatusCode': 202}
+            dispatch(make_job(query, 'C704EFSF7', 'AliasConfigTest'))
+        job = json.loads(client.return_value.invoke.call_args[1]['Payload'])
+        self.assertEqual(job['query']['params'][0]['default'], '2020-01-31')
+
+    def test_compile_rejects_invalid_alias(self):
+        with self.assertRaises(ValueError):
+            compile_config(self.filename)
+
+
+class RefreshIntervalTest(unittest.TestCase):
+    def test_parses_durations(self):
+        self.assertEqual([parse_duration(duration) for duration in ('30s', '5m', '1h', 90, '0m', 'soon')], [30, 300, 3600, 90, None, None])
+        self.assertEqual(validate_alias('getstats', {'sql': 'SELECT 1', 'mysql_host': 'db', 'mysql_database': 'sakila', 'refresh': 'daily'}), "refresh must be a duration such as 30s, 5m or 1h")
+
+
+class ParamsTest(unittest.TestCase):
+    def setUp(self):
+        self.params = [{'name': 'customer_id', 'type': 'int'}, {'name': 'since', 'type': 'date', 'default': '2018-01-01'}]
+
+    def test_binds_typed_arguments(self):
+        self.assertEqual(bind_params('getorders', self.params, ['1234']), ([1234, '2018-01-01'], None))
+        self.assertEqual(bind_params('getorders', self.params, ['1234', '2018-06-30']), ([1234, '2018-06-30'], None))
+        self.assertEqual(bind_params('getorders', self.params, ['abc']), (None, "The parameter customer_id of getorders must be of type int, not `abc`, usage: `/sql getorders <customer_id:int> [since:date]`"))
+        self.assertEqual(bind_params('getorders', self.params, [])[1], "The alias getorders takes 1 to 2 parameters, usage: `/sql getorders <customer_id:int> [since:date]`")
+
+    def test_validates_declarations(self):
+        query = {'sql': 'SELECT * FROM orders WHERE customer_id = %s AND created >= %s', 'mysql_host': 'db', 'mysql_database': 'sakila', 'params': self.params}
+        self.assertIsNone(validate_alias('getorders', query))
+        self.assertEqual(validate_alias('getorders', dict(query, sql='SELECT * FROM orders WHERE customer_id = %s')), "sql must have one %s placeholder per parameter")
+        self.assertEqual(validate_alias('getorders', dict(query, params=list(reversed(self.params)))), "parameter customer_id without a default follows one with a default")
+        self.assertEqual(validate_alias('getorders', dict(query, params=[{'name': 'customer_id', 'type': 'uuid'}, self.params[1]])), "the type of parameter customer_id must be one of int, float, str, date")
@@ -0,0 +1,396 @@
+import json
+import logging
+import os
+import socket
+import threading
+import time
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+from timeit import default_timer as timer
+from unittest.mock import patch
+
+import mysql.connector
+from mysql.connector.constants import FieldType
+
+import database
+from database import CircuitOpenError, ResultBuffer, connect, connection_pool, get_circuit_breaker, get_connection, get_pool_key, release_connection, run_query
+
+
+class MysqlConnectivityTest(unittest.TestCase):
+    def test_connectivity(self):
+        logging.debug(json.dumps({"action": "starting new test MysqlConnectivityTest"}))
+        start = timer()
+        attempts = 0
+        connected = False
+        while not connected:
+            try:
+                logging.debug(json.dumps({"action": "trying to connect to MySQL"}))
+                cnx = mysql.connector.connect(
+                    connect_timeout=20,
+                    user=os.environ['MYSQL_USER'],
+                    password=os.environ['MYSQL_PASSWORD'],
+                    database=os.environ['MYSQL_DATABASE'],
+                    host="db"
+                )
+                connected = True
+            except mysql.connector.errors.InterfaceError:
+                elapsed = timer() - start
+                logging.info(json.dumps({"action": "connect to mysql", "status": "failed", "attempts": attempts, "elapsed": elapsed}))
+                if elapsed > 10 or attempts > 5:
+                    logging.exception("Failed to connect to MySQL database")
+                    raise
+                attempts += 1
+            finally:
+                cnx.close()
+            logging.debug(json.dumps({"action": "sleeping"}))
+            time.sleep(1)
+
+
+class FakeCursor(object):
+    def __init__(self, rows, description):
+        self.rows = list(rows)
+        self.description = description
+        self.column_names = [column[0] for column in description]
+        self.with_rows = True
+
+    def execute(self, operation, multi=False):
+        return iter([self])
+
+    def fetchmany(self, size):
+        batch, self.rows = self.rows[:size], self.rows[size:]
+        return batch
+
+    def fetchone(self):
+        batch = self.fetchmany(1)
+        return batch[0] if batch else None
+
+    def fetchall(self):
+        rows, self.rows = self.rows, []
+        return rows
+
+    def close(self):
+        pass
+
+
+class FakeConnection(object):
+    def __init__(self, broken=False, rows=(), description=()):
+        self.broken = broken
+        self.closed = False
+        self.rows = rows
+        self.description = description
+
+    def cursor(self, **kwargs):
+        return FakeCursor(self.rows, self.description)
+
+    def ping(self):
+        if self.broken:
+            raise mysql.connector.errors.InterfaceError("Lost connection")
+
+    def close(self):
+        self.closed = True
+
+
+class ConnectionPoolTest(unittest.TestCase):
+    def setUp(self):
+        connection_pool.clear()
+        self.query = {'mysql_host': 'db', 'mysql_database': 'sakila', 'mysql_username': 'user', 'mysql_password': 'password'}
+
+    def tearDown(self):
+        connection_pool.clear()
+
+    @patch('mysql.connector.connect', side_effect=lambda **kwargs: FakeConnection())
+    def test_reuses_warm_connection(self, connect):
+        cnx = get_connection(self.query)
+        release_connection(self.query, cnx)
+        self.assertIs(get_connection(self.query), cnx)
+        self.assertEqual(connect.call_count, 1)
+
+    @patch('mysql.connector.connect', side_effect=lambda **kwargs: FakeConnection())
+    def test_replaces_broken_connection(self, connect):
+        broken = FakeConnection(broken=True)
+        connection_pool[get_pool_key(self.query)] = [(broken, time.time())]
+        self.assertIsNot(get_connection(self.query), broken)
+        self.assertTrue(broken.closed)
+        self.assertEqual(connect.call_count, 1)
+
+    @patch.dict(os.environ, {'MYSQL_POOL_TTL': '60'})
+    @patch('mysql.connector.connect', side_effect=lambda **kwargs: FakeConnection())
+    def test_evicts_idle_connection(self, connect):
+        stale = FakeConnection()
+        connection_pool[get_pool_key(self.query)] = [(stale, time.time() - 120)]
+        self.assertIsNot(get_connection(self.query), stale)
+        self.assertTrue(stale.closed)
+
+    @patch.dict(os.environ, {'MYSQL_POOL_SIZE': '1'})
+    def test_caps_pool_size_per_host(self):
+        first, second = FakeConnection(), FakeConnection()
+        release_connection(self.query, first)
+        release_connection(dict(self.query, mysql_database='other'), second)
+        self.assertTrue(second.closed)
+        self.assertEqual(sum(len(idle) for idle in connection_pool.values()), 1)
+
+    @patch.dict(os.environ, {'MYSQL_POOL_SIZE': '8'})
+    @patch('mysql.connector.connect', side_effect=lambda **kwargs: FakeConnection())
+    def test_shared_between_threads(self, connect):
+        def borrow(i):
+            cnx = get_connection(self.query)
+            time.sleep(0.01)
+            release_connection(self.query, cnx)
+            return cnx
+
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            borrowed = list(executor.map(borrow, range(40)))
+        self.assertLessEqual(connect.call_count, 4)
+        self.assertEqual(len(set(map(id, borrowed))), connect.call_count)
+        self.assertEqual(len(connection_pool[get_pool_key(self.query)]), connect.call_count)
+
+
+def refused_port():
+    """Returns a local port nothing listens on, so connections to it are refused straight away"""
+
+    server = socket.socket()
+    server.bind(('127.0.0.1', 0))
+    port = server.getsockname()[1]
+    server.close()
+    return port
+
+
+class CircuitBreakerTest(unittest.TestCase):
+    def setUp(self):
+        database.circuit_breakers.clear()
+        self.environ = patch.dict(os.environ, {'MYSQL_CONNECT_BACKOFF_BASE': '0.05', 'MYSQL_BREAKER_RESET': '30'})
+        self.environ.start()
+        self.query = {'alias': 'getstats', 'sql': 'SELECT 1', 'mysql_host': '127.0.0.1', 'mysql_port': refused_port(), 'mysql_database': 'sakila', 'mysql_username': 'user', 'mysql_password': 'password'}
+
+    def tearDown(self):
+        self.environ.stop()
+        database.circuit_breakers.clear()
+
+    @patch.dict(os.environ, {'MYSQL_BREAKER_FAILURES': '100'})
+    def test_retries_until_deadline(self):
+        start = time.time()
+        with patch('mysql.connector.connect', wraps=mysql.connector.connect) as connected:
+            with self.assertRaises(mysql.connector.errors.InterfaceError):
+                connect(dict(self.query, deadline=time.time() + 1))
+        self.assertLess(time.time() - start, 1.1)
+        self.assertGreater(connected.call_count, 1)
+
+    @patch.dict(os.environ, {'MYSQL_BREAKER_FAILURES': '100', 'MYSQL_CONNECT_BUDGET': '0.5', 'MYSQL_CONNECT_TIMEOUT': '2'})
+    def test_retries_within_budget(self):
+        start = time.time()
+        with patch('mysql.connector.connect', wraps=mysql.connector.connect) as connected:
+            with self.assertRaises(mysql.connector.errors.InterfaceError):
+                connect(dict(self.query, deadline=time.time() + 290))
+        self.assertLess(time.time() - start, 0.6)
+        self.assertTrue(all(call[1]['connect_timeout'] == 1 for call in connected.call_args_list))
+
+    @patch.dict(os.environ, {'MYSQL_BREAKER_FAILURES': '3'})
+    def test_fails_fast_when_open(self):
+        with self.assertRaises(CircuitOpenError):
+            connect(dict(self.query, deadline=time.time() + 30))
+        self.assertEqual(get_circuit_breaker('127.0.0.1').state, 'open')
+        with patch('mysql.connector.connect') as connected:
+            self.assertEqual(run_query(self.query), 'Not connecting to 127.0.0.1 after repeated connection failures, trying again in 30 seconds.')
+        self.assertFalse(connected.called)
+
+    @patch.dict(os.environ, {'MYSQL_BREAKER_FAILURES': '1', 'MYSQL_BREAKER_RESET': '0.1'})
+    def test_half_open_probe(self):
+        with self.assertRaises(CircuitOpenError):
+            connect(self.query)
+        time.sleep(0.1)
+        with self.assertRaises(CircuitOpenError):
+            connect(self.query)
+        self.assertEqual(get_circuit_breaker('127.0.0.1').state, 'open')
+        time.sleep(0.1)
+        with patch('mysql.connector.connect', side_effect=lambda **kwargs: FakeConnection()):
+            connect(self.query)
+        self.assertEqual(get_circuit_breaker('127.0.0.1').state, 'closed')
+
+    @patch.dict(os.environ, {'MYSQL_BREAKER_FAILURES': '1', 'MYSQL_BREAKER_RESET': '0.1'})
+    def test_half_open_probe_refused(self):
+        with self.assertRaises(CircuitOpenError):
+            connect(self.query)
+        time.sleep(0.1)
+        too_many = mysql.connector.errors.OperationalError(msg="Too many connections", errno=1040)
+        with patch('mysql.connector.connect', side_effect=too_many):
+            self.assertEqual(run_query(self.query), 'Not connecting to 127.0.0.1 after repeated connection failures, trying again in 0 seconds.')
+        self.assertEqual(get_circuit_breaker('127.0.0.1').state, 'open')
+        time.sleep(0.1)
+        with patch('mysql.connector.connect', side_effect=lambda **kwargs: FakeConnection()):
+            connect(self.query)
+        self.assertEqual(get_circuit_breaker('127.0.0.1').state, 'closed')
+
+
+class KillableCursor(FakeCursor):
+    """Streams its rows, then hangs like a long running statement until KILL QUERY is run"""
+
+    def __init__(self, connection):
+        super(KillableCursor, self).__init__(connection.rows, connection.description)
+        self.connection = connection
+
+    def execute(self, operation, multi=False):
+        self.connection.executed.append(operation)
+        if operation.startswith('KILL QUERY'):
+            self.connection.killed.set()
+        return iter([self])
+
+    def fetchmany(self, size):
+        batch = super(KillableCursor, self).fetchmany(size)
+        if not batch and self.connection.hangs:
+            self.connection.killed.wait(5)
+            raise mysql.connector.errors.DatabaseError(msg='Query execution was interrupted', errno=1317)
+        return batch
+
+
+class KillableConnection(FakeConnection):
+    def __init__(self, rows=(), description=(), server='5.7.22-log', killed=None, hangs=False):
+        super(KillableConnection, self).__init__(rows=rows, description=description)
+        self.server = server
+        self.connection_id = 7
+        self.executed = []
+        self.killed = killed or threading.Event()
+        self.hangs = hangs
+
+    def cursor(self, **kwargs):
+        return KillableCursor(self)
+
+    def get_server_info(self):
+        return self.server
+
+
+class QueryTimeoutTest(unittest.TestCase):
+    def setUp(self):
+        connection_pool.clear()
+        self.query = {'alias': 'getstats', 'sql': 'SELECT id FROM stats', 'mysql_host': 'db', 'mysql_database': 'sakila', 'mysql_username': 'user', 'mysql_password': 'password'}
+        self.description = [('id', FieldType.LONG)]
+
+    def tearDown(self):
+        connection_pool.clear()
+
+    def test_sets_and_resets_server_limit(self):
+        cnx = KillableConnection(rows=[(1,)], description=self.description)
+        with patch('database.connect', return_value=cnx):
+            run_query(dict(self.query, max_execution_time=2)).close()
+            run_query(self.query).close()
+        self.assertEqual([operation for operation in cnx.executed if operation.startswith('SET')], ['SET SESSION MAX_EXECUTION_TIME = 2000', 'SET SESSION MAX_EXECUTION_TIME = 0'])
+        self.assertEqual(cnx.execution_time_limit, 0)
+
+    def test_sets_mariadb_limit(self):
+        cnx = KillableConnection(rows=[(1,)], description=self.description, server='10.3.8-MariaDB')
+        with patch('database.connect', return_value=cnx):
+            run_query(dict(self.query, max_execution_time=2.5)).close()
+        self.assertIn('SET SESSION max_statement_time = 2.500000', cnx.executed)
+
+    @patch.dict(os.environ, {'FETCH_BATCH_SIZE': '2'})
+    def test_kills_query_at_deadline(self):
+        cnx = KillableConnection(rows=[(1,), (2,)], description=self.description, hangs=True)
+        side = KillableConnection(killed=cnx.killed)
+        with patch('database.connect', side_effect=[cnx, side]):
+            snippet = run_query(dict(self.query, deadline=time.time() + 0.2))
+        with snippet:
+            self.assertEqual(snippet.read(), b'id\n--\n1 \n2 \n\nResult truncated after 2 rows because the query ran past its time limit.\n')
+        self.assertEqual(side.executed, ['KILL QUERY 7'])
+        self.assertTrue(cnx.closed)
+        self.assertTrue(side.closed)
+
+
+class PreparedCursor(FakeCursor):
+    """Prepares its statement again unless it's passed the same string object, like the connector"""
+
+    def __init__(self, cnx):
+        super(PreparedCursor, self).__init__(cnx.rows, cnx.description)
+        self.cnx = cnx
+        self.statement = None
+        self.closed = False
+
+    def execute(self, operation, params=()):
+        if operation is not self.statement:
+            self.cnx.prepared.append(operation)
+            self.statement = operation
+        self.cnx.arguments.append(params)
+        self.rows = list(self.cnx.rows)
+
+    def close(self):
+        self.closed = True
+
+
+class PreparingConnection(FakeConnection):
+    def __init__(self, **kwargs):
+        super(PreparingConnection, self).__init__(**kwargs)
+        self.prepared = []
+        self.arguments = []
+        self.cursors = []
+
+    def cursor(self, prepared=False):
+        if not prepared:
+            return super(PreparingConnection, self).cursor()
+        self.cursors.append(PreparedCursor(self))
+        return self.cursors[-1]
+
+
+class PreparedStatementTest(unittest.TestCase):
+    def setUp(self):
+        connection_pool.clear()
+        self.query = {'alias': 'getorders', 'mysql_host': 'db', 'mysql_database': 'sakila', 'mysql_username': 'user', 'mysql_password': 'password', 'params': [{'name': 'customer_id', 'type': 'int'}]}
+
+    def tearDown(self):
+        connection_pool.clear()
+
+    def run_with(self, sql, arguments):
+        # Every invocation decodes its own copy of the statement from the event
+        with run_query(dict(self.query, sql=json.loads(json.dumps(sql)), arguments=arguments)) as snippet:
+            return snippet.read()
+
+    @patch.dict(os.environ, {'PREPARED_STATEMENT_CACHE_SIZE': '1'})
+    def test_reuses_statement_of_pooled_connection(self):
+        cnx = PreparingConnection(rows=[(1,)], description=[('id', FieldType.LONG)])
+        sql = 'SELECT id FROM orders WHERE customer_id = %s'
+        with patch('database.connect', return_value=cnx) as connected:
+            self.assertEqual(self.run_with(sql, [1234]), b'id\n--\n1 \n')
+            self.run_with(sql, [5678])
+            self.run_with('SELECT id FROM orders WHERE id = %s', [1])
+        self.assertEqual(connected.call_count, 1)
+        self.assertEqual(cnx.prepared, [sql, 'SELECT id FROM orders WHERE id = %s'])
+        self.assertEqual(cnx.arguments, [(1234,), (5678,), (1,)])
+        self.assertEqual([cursor.closed for cursor in cnx.cursors], [True, False])
+
+
+class StreamingResultTest(unittest.TestCase):
+    def setUp(self):
+        connection_pool.clear()
+        self.query = {'alias': 'getstats', 'sql': 'SELECT * FROM stats', 'mysql_host': 'db', 'mysql_database': 'sakila', 'mysql_username': 'user', 'mysql_password': 'password'}
+        self.rows = [(i, 'row{}'.format(i)) for i in range(10)]
+        self.description = [('id', FieldType.LONG), ('name', FieldType.VAR_STRING)]
+
+    def tearDown(self):
+        connection_pool.clear()
+
+    def test_spills_to_disk(self):
+        rows = [[str(i), name] for i, name in self.rows]
+        result = ResultBuffer(spill_bytes=20)
+        for row in rows:
+            result.append(row, 10)
+        self.assertIsNotNone(result.spill)
+        self.assertEqual(result.rows, [])
+        self.assertEqual(list(result), rows)
+        self.assertEqual(list(result), rows)
+        result.close()
+
+    @patch.dict(os.environ, {'FETCH_BATCH_SIZE': '3'})
+    def test_streams_all_rows(self):
+        cnx = FakeConnection(rows=self.rows, description=self.description)
+        with patch('database.get_connection', return_value=cnx):
+            snippet = run_query(self.query)
+        lines = snippet.read().decode('utf-8').splitlines()
+        self.assertEqual(len(lines), 12)
+        self.assertEqual(lines[0].split(), ['id', '|', 'name'])
+        self.assertEqual(connection_pool[get_pool_key(self.query)][0][0], cnx)
+
+    def test_caps_rows_per_alias(self):
+        cnx = FakeConnection(rows=self.rows, description=self.description)
+        with patch('database.get_connection', return_value=cnx):
+            snippet = run_query(dict(self.query, max_rows=4))
+        lines = snippet.read().decode('utf-8').splitlines()
+        self.assertEqual(len(lines), 8)
+        self.assertIn('Result truncated after 4 rows', lines[-1])
+        self.assertTrue(cnx.closed)
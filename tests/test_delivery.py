@@ -0,0 +1,93 @@
+import io
+import os
+import unittest
+from unittest.mock import patch
+
+import slack
+from delivery import DeliveryQueue
+from slack import SlackError
+from tests.stubs import StubServer
+from tests.test_slack import parse_multipart
+
+
+class FakeContext(object):
+    def __init__(self, remaining):
+        self.remaining = remaining
+
+    def get_remaining_time_in_millis(self):
+        return self.remaining
+
+
+def rate_limited(times, retry_after='0'):
+    """Returns a Slack stub that rate limits the first uploads"""
+
+    calls = []
+
+    def respond(path, headers, body):
+        calls.append(path)
+        if len(calls) <= times:
+            return 429, {'Retry-After': retry_after}, {'ok': False, 'error': 'ratelimited'}
+        return 200, {}, {'ok': True}
+    return respond
+
+
+class DeliveryQueueTest(unittest.TestCase):
+    def setUp(self):
+        slack.session = None
+        self.environ = patch.dict(os.environ, {'SLACK_TOKEN': 'xoxb-test', 'DELIVERY_MARGIN': '0', 'DELIVERY_BACKOFF_BASE': '0.01'})
+        self.environ.start()
+
+    def tearDown(self):
+        self.environ.stop()
+        slack.session = None
+
+    def test_retries_after_rate_limit(self):
+        with StubServer(rate_limited(2)) as stub:
+            with patch.dict(os.environ, {'SLACK_API_URL': stub.url}):
+                queue = DeliveryQueue(FakeContext(10000), 'DeliveryQueueTest')
+                queue.put(io.BytesIO(b'id\n--\n1\n'), 'C704EFSF7', 'getstats')
+                reports = queue.flush()
+        self.assertEqual(len(stub.requests), 3)
+        self.assertEqual(reports[0]['retries'], 2)
+        self.assertEqual(reports[0]['status'], 'success')
+        self.assertEqual(parse_multipart(stub.requests[2][1], stub.requests[2][2])['file'][1], b'id\n--\n1\n')
+
+    def test_gives_up_when_out_of_time(self):
+        with StubServer(rate_limited(5, retry_after='30')) as stub:
+            with patch.dict(os.environ, {'SLACK_API_URL': stub.url}):
+                queue = DeliveryQueue(FakeContext(2000))
+                queue.put('result', 'C704EFSF7')
+                with self.assertRaises(SlackError):
+                    queue.flush()
+        self.assertEqual(len(stub.requests), 1)
+
+    def test_does_not_retry_permanent_failures(self):
+        with StubServer(lambda path, headers, body: (200, {}, {'ok': False, 'error': 'not_in_channel'})) as stub:
+            with patch.dict(os.environ, {'SLACK_API_URL': stub.url}):
+                queue = DeliveryQueue(FakeContext(10000))
+                queue.put('result', 'C704EFSF7')
+                with self.assertRaises(SlackError):
+                    queue.flush()
+        self.assertEqual(len(stub.requests), 1)
+
+    def test_retries_server_errors(self):
+        responses = [(503, {}, {}), (200, {}, {'ok': True})]
+        with StubServer(lambda path, headers, body: responses.pop(0)) as stub:
+            with patch.dict(os.environ, {'SLACK_API_URL': stub.url}):
+                queue = DeliveryQueue(FakeContext(10000))
+                queue.put('result', 'C704EFSF7')
+                reports = queue.flush()
+        self.assertEqual(reports[0]['retries'], 1)
+
+    def test_coalesces_posts_to_same_channel(self):
+        with StubServer(lambda path, headers, body: (200, {}, {'ok': True})) as stub:
+            with patch.dict(os.environ, {'SLACK_API_URL': stub.url}):
+                queue = DeliveryQueue(FakeContext(10000))
+                queue.put(io.BytesIO(b'id\n--\n1\n'), 'C704EFSF7', 'getstats')
+                queue.put('Could not connect to db.', 'C704EFSF7', 'getemployees')
+                queue.put('result', 'C0000000')
+                reports = queue.flush()
+        self.assertEqual(len(stub.requests), 2)
+        fields = parse_multipart(stub.requests[0][1], stub.requests[0][2])
+        self.assertEqual(fields['file'][1], b'getstats\nid\n--\n1\n\ngetemployees\nCould not connect to db.\n')
+        self.assertEqual([report['coalesced'] for report in reports], [2, 2, 1])
@@ -0,0 +1,52 @@
+import json
+import os
+import unittest
+from unittest.mock import patch
+
+import dispatcher
+from dispatcher import dispatch, get_lambda_client, invoke_query_handler_inline, make_job
+from tests.stubs import StubServer
+
+
+def lambda_invoke(path, headers, body):
+    """Answers like the Lambda Invoke API, echoing the job back for synchronous invocations"""
+
+    if headers.get('X-Amz-Invocation-Type') == 'Event':
+        return 202, {}, b''
+    job = json.loads(body.decode('utf-8'))
+    return 200, {'Content-Type': 'application/json'}, {'statusCode': 200, 'snippet': job['query']['alias']}
+
+
+class DispatcherTest(unittest.TestCase):
+    def setUp(self):
+        dispatcher.lambda_clients.clear()
+        self.stub = StubServer(lambda_invoke).__enter__()
+        self.environ = patch.dict(os.environ, {
+            'LAMBDA_ENDPOINT_URL': self.stub.url,
+            'QUERY_HANDLER': 'slack-curated-sql-query',
+            'AWS_DEFAULT_REGION': 'ap-southeast-2',
+            'AWS_ACCESS_KEY_ID': 'testing',
+            'AWS_SECRET_ACCESS_KEY': 'testing'
+        })
+        self.environ.start()
+
+    def tearDown(self):
+        self.environ.stop()
+        self.stub.__exit__()
+        dispatcher.lambda_clients.clear()
+
+    def test_reuses_client(self):
+        self.assertIs(get_lambda_client(300), get_lambda_client(300))
+
+    def test_dispatches_aliases_as_one_job(self):
+        job = make_job([{'alias': alias} for alias in ('getstats', 'getbilling', 'getemployees')], 'C704EFSF7', 'DispatcherTest')
+        self.assertEqual(dispatch(job)['StatusCode'], 202)
+        (path, headers, body), = self.stub.requests
+        self.assertEqual(path, '/2015-03-31/functions/slack-curated-sql-query/invocations')
+        self.assertEqual(headers['X-Amz-Invocation-Type'], 'Event')
+        self.assertEqual([query['alias'] for query in json.loads(body.decode('utf-8'))['queries']], ['getstats', 'getbilling', 'getemployees'])
+
+    def test_invokes_inline(self):
+        self.assertEqual(invoke_query_handler_inline({'alias': 'getstats'}, 'C704EFSF7', 'DispatcherTest'), 'getstats')
+        job = json.loads(self.stub.requests[0][2].decode('utf-8'))
+        self.assertIn('respond_by', job)
@@ -0,0 +1,24 @@
+import datetime
+import decimal
+import unittest
+
+from mysql.connector.constants import FieldType
+
+from formatting import convert_batch, format_table, get_converters
+
+
+class ConverterTest(unittest.TestCase):
+    def test_converts_columns_by_type(self):
+        description = [('amount', FieldType.NEWDECIMAL), ('created', FieldType.DATETIME), ('data', FieldType.BLOB), ('location', FieldType.GEOMETRY), ('active', FieldType.TINY)]
+        batch = [
+            (decimal.Decimal('1E-7'), datetime.datetime(2017, 9, 10, 8, 0), b'caf\xc3\xa9', b'\x01\x02', 0),
+            (None, None, None, None, None)
+        ]
+        widths = [len(column[0]) for column in description]
+        rows = convert_batch(get_converters(description), batch, widths)
+        self.assertEqual(rows, [('0.0000001', '2017-09-10 08:00:00', 'caf\u00e9', '0x0102', '0'), ('', '', '', '', '')])
+        self.assertEqual(widths, [9, 19, 4, 8, 6])
+
+    def test_format_table_keeps_falsy_values(self):
+        table = format_table([{'id': 0, 'name': None}], ['id', 'name'])
+        self.assertEqual(table.splitlines(), ['id | name', '-- | ----', '0  |     '])
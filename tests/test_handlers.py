@@ -0,0 +1,490 @@
+import importlib
+import io
+import json
+import logging
+import os
+import time
+import unittest
+from unittest.mock import patch
+from urllib.parse import urlencode
+
+import botocore.exceptions
+
+from dispatcher import QueryHandlerError
+
+handlers = importlib.import_module('lambda')
+handler = handlers.handler
+query_handler = handlers.query_handler
+lookup_alias_and_invoke_query_handler = handlers.lookup_alias_and_invoke_query_handler
+missing_alias_message = handlers.missing_alias_message
+
+
+class MissingAliasTest(unittest.TestCase):
+    def setUp(self):
+        logging.debug(json.dumps({"action": "setting up new test MissingAliasTest"}))
+        event = {
+            'resource': '/command',
+            'path': '/command',
+            'httpMethod': 'POST',
+            'headers': {
+                'Accept': 'application/json,*/*',
+                'Accept-Encoding': 'gzip,deflate',
+                'CloudFront-Forwarded-Proto': 'https',
+                'CloudFront-Is-Desktop-Viewer': 'true',
+                'CloudFront-Is-Mobile-Viewer': 'false',
+                'CloudFront-Is-SmartTV-Viewer': 'false',
+                'CloudFront-Is-Tablet-Viewer': 'false',
+                'CloudFront-Viewer-Country': 'US',
+                'Content-Type': 'application/x-www-form-urlencoded',
+                'Host': '8bixd3am45.execute-api.ap-southeast-2.amazonaws.com',
+                'User-Agent': 'Slackbot 1.0 (+https://api.slack.com/robots)',
+                'Via': '1.1 a0dce0e49d06dce2c392604440772209.cloudfront.net (CloudFront)',
+                'X-Amz-Cf-Id': 'TL3kJqaV6y7kXC6hkru8zOJZzGXBX13rQ-0tc34hlabd-K18qKLVFg==',
+                'X-Amzn-Trace-Id': 'Root=1-59b4e895-024869162e9972bf6b358970',
+                'X-Forwarded-For': '54.209.231.248, 54.182.230.57',
+                'X-Forwarded-Port': '443',
+                'X-Forwarded-Proto': 'https'},
+            'queryStringParameters': None,
+            'pathParameters': None,
+            'stageVariables': None,
+            'requestContext': {
+                'path': '/Devaaron/command',
+                'accountId': '979598289034',
+                'resourceId': 'i5luku',
+                'stage': 'Devaaron',
+                'requestId': '071aeddc-95f9-11e7-8cd9-7ff34cfce32b',
+                'identity': {
+                    'cognitoIdentityPoolId': None,
+                    'accountId': None,
+                    'cognitoIdentityId': None,
+                    'caller': None,
+                    'apiKey': '',
+                    'sourceIp': '54.209.231.248',
+                    'accessKey': None,
+                    'cognitoAuthenticationType': None,
+                    'cognitoAuthenticationProvider': None,
+                    'userArn': None,
+                    'userAgent': 'Slackbot 1.0 (+https://api.slack.com/robots)',
+                    'user': None},
+                'resourcePath': '/command',
+                'httpMethod': 'POST',
+                'apiId': '8bixd3am45'},
+            'body': urlencode({
+                'token': 'UKN4Z6UE5',
+                'team_id': 'T704EFPPF',
+                'team_domain': 'aarongorka',
+                'channel_id': 'C704EFSF7',
+                'channel_name': 'general',
+                'user_id': 'U6ZAMUH7S',
+                'user_name': 'aarongorka',
+                'command': '/sql',
+                'text': 'missingalias',
+                'response_url': 'https://hooks.slack.com/commands/T704EFPPF/239872535367/4ERft7zrhxf5c0YtZpWSXeqk',
+                'trigger_id': 'MissingAliasTest'}),
+            'isBase64Encoded': False}
+        self.response = handler(event, {})
+        self.body = json.loads(self.response['body'])
+
+    def test_response(self):
+        self.assertEqual(self.response['statusCode'], 200)
+
+    def test_text(self):
+        self.assertEqual(self.body['text'], 'The alias `missingalias` doesn\'t exist. Here are the available aliases you may call:')
+
+    def test_field_0(self):
+        attachments = self.body['attachments']
+        fields = [x["fields"] for x in attachments]
+        logging.debug(json.dumps({'fields': fields}))
+        titles = [x[0]["title"] for x in fields]
+        logging.debug(json.dumps({'titles': titles}))
+        values = [x[0]["value"] for x in fields]
+        logging.debug(json.dumps({'values': values}))
+
+        self.assertTrue("Alias" in titles)
+        self.assertTrue("getemployees" in values)
+
+
+class InvalidMessageTest(unittest.TestCase):
+    def setUp(self):
+        event = {
+            'resource': '/command',
+            'path': '/command',
+            'httpMethod': 'POST',
+            'headers': {
+                'Accept': 'application/json,*/*',
+                'Accept-Encoding': 'gzip,deflate',
+                'CloudFront-Forwarded-Proto': 'https',
+                'CloudFront-Is-Desktop-Viewer': 'true',
+                'CloudFront-Is-Mobile-Viewer': 'false',
+                'CloudFront-Is-SmartTV-Viewer': 'false',
+                'CloudFront-Is-Tablet-Viewer': 'false',
+                'CloudFront-Viewer-Country': 'US',
+                'Content-Type': 'application/x-www-form-urlencoded',
+                'Host': '8bixd3am45.execute-api.ap-southeast-2.amazonaws.com',
+                'User-Agent': 'Slackbot 1.0 (+https://api.slack.com/robots)',
+                'Via': '1.1 a0dce0e49d06dce2c392604440772209.cloudfront.net (CloudFront)',
+                'X-Amz-Cf-Id': 'TL3kJqaV6y7kXC6hkru8zOJZzGXBX13rQ-0tc34hlabd-K18qKLVFg==',
+                'X-Amzn-Trace-Id': 'Root=1-59b4e895-024869162e9972bf6b358970',
+                'X-Forwarded-For': '54.209.231.248, 54.182.230.57',
+                'X-Forwarded-Port': '443',
+                'X-Forwarded-Proto': 'https'},
+            'queryStringParameters': None,
+            'pathParameters': None,
+            'stageVariables': None,
+            'requestContext': {
+                'path': '/Devaaron/command',
+                'accountId': '979598289034',
+                'resourceId': 'i5luku',
+                'stage': 'Devaaron',
+                'requestId': '071aeddc-95f9-11e7-8cd9-7ff34cfce32b',
+                'identity': {
+                    'cognitoIdentityPoolId': None,
+                    'accountId': None,
+                    'cognitoIdentityId': None,
+                    'caller': None,
+                    'apiKey': '',
+                    'sourceIp': '54.209.231.248',
+                    'accessKey': None,
+                    'cognitoAuthenticationType': None,
+                    'cognitoAuthenticationProvider': None,
+                    'userArn': None,
+                    'userAgent': 'Slackbot 1.0 (+https://api.slack.com/robots)',
+                    'user': None},
+                'resourcePath': '/command',
+                'httpMethod': 'POST',
+                'apiId': '8bixd3am45'},
+            'body': 'Invaild body',
+            'isBase64Encoded': False}
+        logging.debug(json.dumps({"action": "setting up new test InvalidMessageTest"}))
+        self.response = handler(event, {})
+
+    def test_response(self):
+        self.assertEqual(self.response['statusCode'], 503)
+
+
+class ValidAliasTest(unittest.TestCase):
+    def setUp(self):
+        event = {
+            'resource': '/command',
+            'path': '/command',
+            'httpMethod': 'POST',
+            'headers': {
+                'Accept': 'application/json,*/*',
+                'Accept-Encoding': 'gzip,deflate',
+                'CloudFront-Forwarded-Proto': 'https',
+                'CloudFront-Is-Desktop-Viewer': 'true',
+                'CloudFront-Is-Mobile-Viewer': 'false',
+                'CloudFront-Is-SmartTV-Viewer': 'false',
+                'CloudFront-Is-Tablet-Viewer': 'false',
+                'CloudFront-Viewer-Country': 'US',
+                'Content-Type': 'application/x-www-form-urlencoded',
+                'Host': '8bixd3am45.execute-api.ap-southeast-2.amazonaws.com',
+                'User-Agent': 'Slackbot 1.0 (+https://api.slack.com/robots)',
+                'Via': '1.1 a0dce0e49d06dce2c392604440772209.cloudfront.net (CloudFront)',
+                'X-Amz-Cf-Id': 'TL3kJqaV6y7kXC6hkru8zOJZzGXBX13rQ-0tc34hlabd-K18qKLVFg==',
+                'X-Amzn-Trace-Id': 'Root=1-59b4e895-024869162e9972bf6b358970',
+                'X-Forwarded-For': '54.209.231.248, 54.182.230.57',
+                'X-Forwarded-Port': '443',
+                'X-Forwarded-Proto': 'https'},
+            'queryStringParameters': None,
+            'pathParameters': None,
+            'stageVariables': None,
+            'requestContext': {
+                'path': '/Devaaron/command',
+                'accountId': '979598289034',
+                'resourceId': 'i5luku',
+                'stage': 'Devaaron',
+                'requestId': '071aeddc-95f9-11e7-8cd9-7ff34cfce32b',
+                'identity': {
+                    'cognitoIdentityPoolId': None,
+                    'accountId': None,
+                    'cognitoIdentityId': None,
+                    'caller': None,
+                    'apiKey': '',
+                    'sourceIp': '54.209.231.248',
+                    'accessKey': None,
+                    'cognitoAuthenticationType': None,
+                    'cognitoAuthenticationProvider': None,
+                    'userArn': None,
+                    'userAgent': 'Slackbot 1.0 (+https://api.slack.com/robots)',
+                    'user': None},
+                'resourcePath': '/command',
+                'httpMethod': 'POST',
+                'apiId': '8bixd3am45'},
+            'body': urlencode({
+                'token': 'UKN4Z6UE5',
+                'team_id': 'T704EFPPF',
+                'team_domain': 'aarongorka',
+                'channel_id': 'C704EFSF7',
+                'channel_name': 'general',
+                'user_id': 'U6ZAMUH7S',
+                'user_name': 'aarongorka',
+                'command': '/sql',
+                'text': 'getemployees',
+                'response_url': 'https://hooks.slack.com/commands/T704EFPPF/239872535367/4ERft7zrhxf5c0YtZpWSXeqk',
+                'trigger_id': 'ValidAliasTest'}),
+            'isBase64Encoded': False}
+        logging.debug(json.dumps({"action": "setting up new test ValidAliasTest"}))
+        self.response = handler(event, {})
+        self.body = json.loads(self.response['body'])
+        self.attachments = self.body['attachments']
+
+    def test_response(self):
+        self.assertEqual(self.response['statusCode'], 200)
+
+    def test_attachments(self):
+        self.assertNotEqual(self.attachments, [])
+
+    def test_fields(self):
+        fields = [x["fields"] for x in self.attachments]
+        logging.debug(json.dumps({'fields': fields, 'action': 'logging fields'}))
+        titles = [x["title"] for x in fields[0]]
+        logging.debug(json.dumps({'titles': titles, 'action': 'logging titles'}))
+        values = [x["value"] for x in fields[0]]
+        logging.debug(json.dumps({'values': values, 'action': 'logging values'}))
+        self.assertTrue("Result" in titles)
+        self.assertTrue("Nagasaki" in str(values))
+
+    def test_valid_text(self):
+        selected_alias = 'getemployees'
+        self.assertNotEqual(self.body.get('text'), "The SQL query (alias: {}) failed, please check the logs for more information".format(selected_alias))
+        self.assertNotEqual(self.body.get('text'), "The alias `{}` doesn't exist. Here are the available aliases you may call:".format(selected_alias))
+
+
+class ValidAliasInvalidQueryTest(unittest.TestCase):
+    def setUp(self):
+        event = {
+            'resource': '/command',
+            'path': '/command',
+            'httpMethod': 'POST',
+            'headers': {
+                'Accept': 'application/json,*/*',
+                'Accept-Encoding': 'gzip,deflate',
+                'CloudFront-Forwarded-Proto': 'https',
+                'CloudFront-Is-Desktop-Viewer': 'true',
+                'CloudFront-Is-Mobile-Viewer': 'false',
+                'CloudFront-Is-SmartTV-Viewer': 'false',
+                'CloudFront-Is-Tablet-Viewer': 'false',
+                'CloudFront-Viewer-Country': 'US',
+                'Content-Type': 'application/x-www-form-urlencoded',
+                'Host': '8bixd3am45.execute-api.ap-southeast-2.amazonaws.com',
+                'User-Agent': 'Slackbot 1.0 (+https://api.slack.com/robots)',
+                'Via': '1.1 a0dce0e49d06dce2c392604440772209.cloudfront.net (CloudFront)',
+                'X-Amz-Cf-Id': 'TL3kJqaV6y7kXC6hkru8zOJZzGXBX13rQ-0tc34hlabd-K18qKLVFg==',
+                'X-Amzn-Trace-Id': 'Root=1-59b4e895-024869162e9972bf6b358970',
+                'X-Forwarded-For': '54.209.231.248, 54.182.230.57',
+                'X-Forwarded-Port': '443',
+                'X-Forwarded-Proto': 'https'},
+            'queryStringParameters': None,
+            'pathParameters': None,
+            'stageVariables': None,
+            'requestContext': {
+                'path': '/Devaaron/command',
+                'accountId': '979598289034',
+                'resourceId': 'i5luku',
+                'stage': 'Devaaron',
+                'requestId': '071aeddc-95f9-11e7-8cd9-7ff34cfce32b',
+                'identity': {
+                    'cognitoIdentityPoolId': None,
+                    'accountId': None,
+                    'cognitoIdentityId': None,
+                    'caller': None,
+                    'apiKey': '',
+                    'sourceIp': '54.209.231.248',
+                    'accessKey': None,
+                    'cognitoAuthenticationType': None,
+                    'cognitoAuthenticationProvider': None,
+                    'userArn': None,
+                    'userAgent': 'Slackbot 1.0 (+https://api.slack.com/robots)',
+                    'user': None},
+                'resourcePath': '/command',
+                'httpMethod': 'POST',
+                'apiId': '8bixd3am45'},
+            'body': urlencode({
+                'token': 'UKN4Z6UE5',
+                'team_id': 'T704EFPPF',
+                'team_domain': 'aarongorka',
+                'channel_id': 'C704EFSF7',
+                'channel_name': 'general',
+                'user_id': 'U6ZAMUH7S',
+                'user_name': 'aarongorka',
+                'command': '/sql',
+                'text': 'invalidquery',
+                'response_url': 'https://hooks.slack.com/commands/T704EFPPF/239872535367/4ERft7zrhxf5c0YtZpWSXeqk',
+                'trigger_id': 'ValidAliasInvalidQueryTest'}),
+            'isBase64Encoded': False}
+        logging.debug(json.dumps({"action": "setting up new test ValidAliasInvalidQueryTest"}))
+        self.response = handler(event, {})
+        self.body = json.loads(self.response['body'])
+
+    def test_response(self):
+        self.assertEqual(self.response['statusCode'], 200)
+
+    def test_text(self):
+        self.assertEqual(self.body['text'], "The SQL query (alias: {}) failed, please check the logs for more information".format('invalidquery'))
+
+
+class FunctionTests(unittest.TestCase):
+    @patch('lambda.get_correlation_id', return_value='asdfasdfasdf')
+    @patch('lambda.get_config', return_value={'queries': []})
+    def test_lookup_alias_and_execute(self, get_config, get_correlation_id):
+        self.assertEqual(get_correlation_id(), 'asdfasdfasdf')
+        self.assertNotEqual(get_correlation_id(), 'asdfasdfasdfx')
+        selected_alias = '23452345'
+        response = lookup_alias_and_execute(selected_alias)
+        self.assertEqual(json.loads(response['body'])['text'], "The alias `{}` doesn't exist. Here are the available aliases you may call:".format(selected_alias))
+        self.assertEqual(response['statusCode'], 200)
+
+    def test_missing_alias_message(self):
+        queries = {'testalias1': {'alias': 'testalias1', 'sql': 'select * from testsql', 'mysql_host': 'test.com.au', 'mysql_database': 'testdb'}, 'testalias': {'alias': 'testalias', 'sql': 'select * from testsql', 'mysql_host': 'test.com.au', 'mysql_database': 'testdb'}, 'anotheralias': {'alias': 'anotheralias', 'sql': 'select * from testsql', 'mysql_host': 'test.com.au', 'mysql_database': 'testdb'}}
+        selected_alias = 'testalias'
+        response = missing_alias_message(queries, selected_alias)
+        self.assertEqual(json.loads(response['body'])['text'], "The alias `{}` doesn't exist. Here are the available aliases you may call:".format(selected_alias))
+
+        attachments = json.loads(response['body'])['attachments']
+
+        self.assertTrue(attachments)
+
+        fields = [x["fields"] for x in attachments]
+        logging.debug(json.dumps({'fields': fields, 'action': 'logging fields'}))
+        titles = [x["title"] for x in fields[0]]
+        logging.debug(json.dumps({'titles': titles, 'action': 'logging titles'}))
+        values = [x["value"] for x in fields[0]]
+        logging.debug(json.dumps({'values': values, 'action': 'logging values'}))
+
+        self.assertTrue("Alias" in titles)
+        self.assertTrue("test.com.au" in str(values))
+
+
+class FastPathTest(unittest.TestCase):
+    def setUp(self):
+        self.environ = patch.dict(os.environ, {'SQL_GETSTATS_USERNAME': 'user', 'SQL_GETSTATS_PASSWORD': 'password'})
+        self.environ.start()
+        self.config = {'queries': {'getstats': {'sql': 'SELECT 1', 'mysql_host': 'db', 'mysql_database': 'sakila', 'fast': True}}, 'invalid': {}}
+
+    def tearDown(self):
+        self.environ.stop()
+
+    def lookup(self, **kwargs):
+        with patch('lambda.get_config', return_value=self.config), patch('dispatcher.invoke_query_handler') as invoke, patch('dispatcher.invoke_query_handler_inline', **kwargs):
+            response = lookup_alias_and_invoke_query_handler('getstats', 'aarongorka', 'C704EFSF7', 'FastPathTest')
+        return json.loads(response['body'])['text'], invoke
+
+    def test_responds_inline(self):
+        text, invoke = self.lookup(return_value='id\n--\n1\n')
+        self.assertEqual(text, 'aarongorka executed getstats:\n```id\n--\n1\n```')
+        self.assertFalse(invoke.called)
+
+    def test_deferred_when_budget_exceeded(self):
+        text, invoke = self.lookup(side_effect=botocore.exceptions.ReadTimeoutError(endpoint_url='lambda'))
+        self.assertEqual(text, 'aarongorka has requested execution of getstats, executing now...')
+        self.assertFalse(invoke.called)
+
+    def test_falls_back_to_async_invoke(self):
+        text, invoke = self.lookup(side_effect=botocore.exceptions.EndpointConnectionError(endpoint_url='lambda'))
+        self.assertEqual(text, 'aarongorka has requested execution of getstats, executing now...')
+        self.assertTrue(invoke.called)
+
+    def test_failed_query_handler_is_not_invoked_again(self):
+        text, invoke = self.lookup(side_effect=QueryHandlerError("Query handler failed"))
+        self.assertEqual(text, 'Running getstats failed, please check the logs for more information.')
+        self.assertFalse(invoke.called)
+
+    def test_query_handler_answers_inline(self):
+        event = {'query': {'mysql_password': 'password'}, 'location': 'C704EFSF7', 'correlation_id': 'FastPathTest', 'respond_by': time.time() + 5}
+        with patch('result_cache.run_cached_query', return_value=io.BytesIO(b'id\n--\n1\n')), patch('slack.post_snippet') as post:
+            self.assertEqual(query_handler(event, {}), {'statusCode': 200, 'snippet': 'id\n--\n1\n'})
+            self.assertFalse(post.called)
+
+    def test_query_handler_posts_when_late(self):
+        event = {'query': {'mysql_password': 'password'}, 'location': 'C704EFSF7', 'correlation_id': 'FastPathTest', 'respond_by': time.time() - 1}
+        with patch('result_cache.run_cached_query', return_value=io.BytesIO(b'id\n--\n1\n')), patch('slack.post_snippet') as post:
+            self.assertEqual(query_handler(event, {}), {'statusCode': 200})
+            self.assertTrue(post.called)
+
+    def test_query_handler_posts_when_answer_is_ready_late(self):
+        event = {'query': {'mysql_password': 'password'}, 'location': 'C704EFSF7', 'correlation_id': 'FastPathTest', 'respond_by': time.time() + 0.1}
+
+        def read_slowly(snippet, max_bytes):
+            time.sleep(0.2)
+            return 'id\n--\n1\n'
+
+        with patch('result_cache.run_cached_query', return_value=io.BytesIO(b'id\n--\n1\n')), patch('lambda.read_small_snippet', side_effect=read_slowly), patch('slack.post_snippet') as post:
+            self.assertEqual(query_handler(event, {}), {'statusCode': 200})
+            self.assertTrue(post.called)
+
+
+class MultiAliasTest(unittest.TestCase):
+    def setUp(self):
+        self.environ = patch.dict(os.environ, {'SQL_GETSTATS_USERNAME': 'user', 'SQL_GETSTATS_PASSWORD': 'password', 'SQL_GETEMPLOYEES_USERNAME': 'user', 'SQL_GETEMPLOYEES_PASSWORD': 'password', 'SLACK_TOKEN': 'xoxb-test'})
+        self.environ.start()
+        query = {'sql': 'SELECT 1', 'mysql_host': 'db', 'mysql_database': 'sakila'}
+        self.config = {'queries': {'getstats': query, 'getemployees': query}, 'invalid': {}}
+
+    def tearDown(self):
+        self.environ.stop()
+
+    def test_dispatches_one_job(self):
+        with patch('lambda.get_config', return_value=self.config), patch('dispatcher.dispatch') as dispatch:
+            response = lookup_alias_and_invoke_query_handler('getstats getemployees', 'aarongorka', 'C704EFSF7', 'MultiAliasTest')
+        self.assertEqual(json.loads(response['body'])['text'], 'aarongorka has requested execution of getstats, getemployees, executing now...')
+        self.assertEqual(dispatch.call_count, 1)
+        self.assertEqual([query['alias'] for query in dispatch.call_args[0][0]['queries']], ['getstats', 'getemployees'])
+
+    def test_rejects_unknown_alias(self):
+        with patch('lambda.get_config', return_value=self.config), patch('dispatcher.dispatch') as dispatch:
+            response = lookup_alias_and_invoke_query_handler('getstats getnothing', 'aarongorka', 'C704EFSF7', 'MultiAliasTest')
+        self.assertIn("The alias `getnothing` doesn't exist", json.loads(response['body'])['text'])
+        self.assertFalse(dispatch.called)
+
+    def test_button_multi_select(self):
+        menu = json.loads(missing_alias_message(self.config['queries'], 'getnothing')['body'])['blocks'][1]['elements'][0]
+        self.assertEqual(menu['type'], 'multi_static_select')
+        self.assertEqual([option['value'] for option in menu['options']], ['getemployees', 'getstats'])
+        payload = {'trigger_id': 'MultiAliasTest', 'user': {'name': 'aarongorka'}, 'channel': {'id': 'C704EFSF7'}, 'actions': [{'selected_options': [menu['options'][1], menu['options'][0]]}]}
+        with patch('lambda.lookup_alias_and_invoke_query_handler', return_value={}) as lookup:
+            handlers.button_handler({'body': urlencode({'payload': json.dumps(payload)})}, {})
+        self.assertEqual(lookup.call_args[0][0], 'getstats getemployees')
+
+    def test_query_handler_posts_one_upload(self):
+        queries = [{'alias': alias, 'mysql_password': 'password'} for alias in ('getstats', 'getemployees')]
+        event = {'queries': queries, 'location': 'C704EFSF7', 'correlation_id': 'MultiAliasTest'}
+        uploads = []
+        with patch('result_cache.run_cached_query', side_effect=lambda query, on_queued=None: io.BytesIO(query['alias'].encode('utf-8'))), patch('slack.post_snippet', side_effect=lambda snippet, *args: uploads.append(snippet.read())):
+            self.assertEqual(query_handler(event, {}), {'statusCode': 200})
+        self.assertEqual(len(uploads), 1)
+        content = uploads[0].decode('utf-8')
+        self.assertRegex(content, r'^getstats \(\d+\.\d\ds\)\ngetstats\ngetemployees \(\d+\.\d\ds\)\ngetemployees\nRan 2 aliases in \d+\.\d\ds\n$')
+
+
+class ParamsTest(unittest.TestCase):
+    def setUp(self):
+        self.environ = patch.dict(os.environ, {'SQL_GETORDERS_USERNAME': 'user', 'SQL_GETORDERS_PASSWORD': 'password', 'SQL_GETSTATS_USERNAME': 'user', 'SQL_GETSTATS_PASSWORD': 'password'})
+        self.environ.start()
+        self.config = {'queries': {
+            'getorders': {'sql': 'SELECT * FROM orders WHERE customer_id = %s', 'mysql_host': 'db', 'mysql_database': 'sakila', 'params': [{'name': 'customer_id', 'type': 'int'}]},
+            'getstats': {'sql': 'SELECT 1', 'mysql_host': 'db', 'mysql_database': 'sakila'}
+        }, 'invalid': {}}
+
+    def tearDown(self):
+        self.environ.stop()
+
+    def lookup(self, selected_alias):
+        with patch('lambda.get_config', return_value=self.config), patch('dispatcher.dispatch') as dispatch:
+            response = lookup_alias_and_invoke_query_handler(selected_alias, 'aarongorka', 'C704EFSF7', 'ParamsTest')
+        return json.loads(response['body'])['text'], dispatch
+
+    def test_dispatches_bound_arguments(self):
+        text, dispatch = self.lookup('getorders 1234')
+        self.assertEqual(text, 'aarongorka has requested execution of getorders 1234, executing now...')
+        self.assertEqual(dispatch.call_args[0][0]['query']['arguments'], [1234])
+
+    def test_rejects_invalid_arguments_before_dispatch(self):
+        text, dispatch = self.lookup('getorders bob')
+        self.assertEqual(text, "The parameter customer_id of getorders must be of type int, not `bob`, usage: `/sql getorders <customer_id:int>`")
+        self.assertFalse(dispatch.called)
+
+    def test_rejects_parameterized_alias_among_others(self):
+        text, dispatch = self.lookup('getstats getorders')
+        self.assertEqual(text, "The alias getorders takes parameters, so it can't be run together with other aliases.")
+        self.assertFalse(dispatch.called)
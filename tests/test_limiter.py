@@ -0,0 +1,129 @@
+import io
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+from unittest.mock import patch
+
+import limiter
+from limiter import HostSlot, acquire_slot, new_state, release_slot
+from result_cache import run_limited_query
+from state_store import DynamoDBStateStore, SqliteStateStore
+from tests.stubs import DynamoDBTable, StubServer
+
+
+class SemaphoreStateTest(unittest.TestCase):
+    def test_queues_in_arrival_order(self):
+        state = new_state()
+        self.assertEqual([acquire_slot(state, token, 2, 60, 0)[0] for token in 'abcd'], [0, 0, 1, 2])
+        release_slot(state, 'a', 10)
+        # The free slot is kept for c, which is ahead of d
+        self.assertEqual(acquire_slot(state, 'd', 2, 60, 1)[0], 1)
+        self.assertEqual(acquire_slot(state, 'c', 2, 60, 1), (0, 10))
+        self.assertEqual(acquire_slot(state, 'd', 2, 60, 1)[0], 1)
+
+    def test_expires_abandoned_slots(self):
+        state = new_state()
+        acquire_slot(state, 'a', 1, 60, 0)
+        self.assertEqual(acquire_slot(state, 'b', 1, 60, 30)[0], 1)
+        self.assertEqual(acquire_slot(state, 'b', 1, 60, 61)[0], 0)
+
+
+class HostSlotTest(unittest.TestCase):
+    def setUp(self):
+        limiter.semaphore_backend = None
+        self.directory = tempfile.mkdtemp()
+        self.environ = patch.dict(os.environ, {'HOST_CONCURRENCY_BACKEND': 'sqlite', 'HOST_CONCURRENCY_PATH': os.path.join(self.directory, 'semaphores.sqlite3'), 'QUEUE_POLL_INTERVAL': '0.01'})
+        self.environ.start()
+        self.query = {'alias': 'getstats', 'sql': 'SELECT 1', 'mysql_host': 'db', 'mysql_database': 'sakila', 'mysql_username': 'user', 'host_concurrency': 2}
+
+    def tearDown(self):
+        self.environ.stop()
+        limiter.semaphore_backend = None
+        shutil.rmtree(self.directory)
+
+    def test_caps_concurrent_queries(self):
+        running, peak, lock = [0], [0], threading.Lock()
+
+        def query(query, raw, slot, on_queued):
+            with lock:
+                running[0] += 1
+                peak[0] = max(peak[0], running[0])
+            time.sleep(0.05)
+            with lock:
+                running[0] -= 1
+            return io.BytesIO(b'result')
+
+        with patch('database.run_on_host', side_effect=query):
+            with ThreadPoolExecutor(max_workers=6) as executor:
+                results = list(executor.map(lambda i: run_limited_query(self.query), range(6)))
+        self.assertEqual(peak[0], 2)
+        self.assertTrue(all(result.read() == b'result' and complete for result, complete in results))
+
+    def test_takes_slots_on_the_hosts_queries_run_on(self):
+        hosts = []
+        replicated = dict(self.query, replicas=['replica-1'])
+        sharded = dict(self.query, targets=[{'mysql_host': 'shard-1', 'mysql_database': 'a'}, {'mysql_host': 'shard-2', 'mysql_database': 'b'}])
+        with patch.object(HostSlot, 'acquire', autospec=True, side_effect=lambda slot: hosts.append(slot.host)):
+            with patch('router.get_candidates', return_value=(['replica-1'], {})), patch('router.get_connection'), patch('router.release_connection'), \
+                    patch('database.run_on_host', return_value=io.BytesIO(b'result')):
+                run_limited_query(replicated)
+            self.assertEqual(hosts, ['replica-1'])
+            with patch('shards.fetch_shard_rows', side_effect=RuntimeError('down')):
+                run_limited_query(sharded)
+        self.assertEqual(sorted(hosts[1:]), ['shard-1', 'shard-2'])
+
+    def test_shared_between_backends(self):
+        # Two functions sharing the semaphore file
+        other = SqliteStateStore(os.environ['HOST_CONCURRENCY_PATH'], 'semaphores')
+        other.update('db', new_state, lambda state: acquire_slot(state, 'other-1', 2, 60, time.time()))
+        other.update('db', new_state, lambda state: acquire_slot(state, 'other-2', 2, 60, time.time()))
+        messages = []
+        slot = HostSlot(dict(self.query, queue_wait=0.1), messages.append)
+        self.assertEqual(slot.acquire(), "db is busy with other queries, getstats wasn't run after waiting 0 seconds. Please try again later.")
+        self.assertEqual(messages, ['getstats is queued behind other queries on db, at position 1.'])
+        other.update('db', new_state, lambda state: release_slot(state, 'other-1', 20))
+        slot = HostSlot(self.query, messages.append)
+        self.assertIsNone(slot.acquire())
+        slot.release()
+
+    def test_estimates_wait(self):
+        backend = limiter.get_semaphore_backend()
+        for token in ('first', 'second'):
+            backend.update('db', new_state, lambda state: acquire_slot(state, token, 2, 60, time.time()))
+        backend.update('db', new_state, lambda state: release_slot(state, 'first', 30))
+        backend.update('db', new_state, lambda state: acquire_slot(state, 'third', 2, 60, time.time()))
+        messages = []
+        HostSlot(dict(self.query, queue_wait=0.01), messages.append).acquire()
+        self.assertEqual(messages, ['getstats is queued behind other queries on db, at position 1, expect to wait about 15 seconds.'])
+
+    def test_unlimited_without_backend(self):
+        with patch.dict(os.environ, {'HOST_CONCURRENCY_BACKEND': ''}):
+            self.assertIsNone(HostSlot(dict(self.query, host_concurrency=0)).acquire())
+
+
+class DynamoDBStateStoreTest(unittest.TestCase):
+    def setUp(self):
+        self.table = DynamoDBTable('pk')
+        self.stub = StubServer(self.table).__enter__()
+        self.environ = patch.dict(os.environ, {
+            'DYNAMODB_ENDPOINT_URL': self.stub.url,
+            'AWS_DEFAULT_REGION': 'ap-southeast-2',
+            'AWS_ACCESS_KEY_ID': 'testing',
+            'AWS_SECRET_ACCESS_KEY': 'testing'
+        })
+        self.environ.start()
+
+    def tearDown(self):
+        self.environ.stop()
+        self.stub.__exit__()
+
+    def test_updates_are_atomic(self):
+        backends = [DynamoDBStateStore('semaphores') for i in range(4)]
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            positions = list(executor.map(lambda i: backends[i % 4].update('db', new_state, lambda state: acquire_slot(state, str(i), 3, 60, time.time()))[0], range(8)))
+        self.assertEqual(sorted(positions), [0, 0, 0, 1, 2, 3, 4, 5])
+        self.assertEqual(self.table.items['db']['version'], {'N': '8'})
@@ -0,0 +1,63 @@
+import io
+import json
+import logging
+import os
+import unittest
+from unittest.mock import patch
+
+import logs
+from logs import Formatter, prepare
+
+
+class Unprintable(object):
+    def __str__(self):
+        raise AssertionError("Records below the level must not be encoded")
+
+
+class LogsTest(unittest.TestCase):
+    def setUp(self):
+        self.stream = io.StringIO()
+        self.handler = logging.StreamHandler(self.stream)
+        with patch.dict(os.environ, {'LOG_VALUE_BYTES': '16', 'LOG_MAX_ITEMS': '3'}):
+            self.handler.setFormatter(Formatter(correlation_id='LogsTest'))
+        self.logger = logging.getLogger('tests.test_logs')
+        self.logger.propagate = False
+        self.logger.setLevel(logging.INFO)
+        self.logger.addHandler(self.handler)
+
+    def tearDown(self):
+        self.logger.removeHandler(self.handler)
+
+    def records(self):
+        return [json.loads(line) for line in self.stream.getvalue().splitlines()]
+
+    def test_redacts_and_cuts_without_copying(self):
+        event = {'query': {'alias': 'getstats', 'mysql_password': 'hunter2', 'sql': 'SELECT * FROM orders WHERE id > 1'}, 'token': 'xoxb', 'rows': list(range(5))}
+        self.logger.info({'action': 'logging event', 'event': event})
+        message = self.records()[0]['message']
+        self.assertEqual(message['event']['query'], {'alias': 'getstats', 'mysql_password': '********', 'sql': 'SELECT * FROM or... (33 characters)'})
+        self.assertEqual(message['event']['token'], '********')
+        self.assertEqual(message['event']['rows'], [0, 1, 2, '... 2 more items'])
+        self.assertEqual(event['query']['mysql_password'], 'hunter2')
+
+    def test_skips_records_below_level(self):
+        self.logger.debug({'action': 'dump', 'value': Unprintable()})
+        self.assertEqual(self.stream.getvalue(), '')
+
+    def test_tags_records_with_correlation_id(self):
+        self.logger.info({'action': 'run query'})
+        self.assertEqual(self.records()[0]['correlation_id'], 'LogsTest')
+
+    def test_sets_up_once_per_container(self):
+        with patch('logs.formatter', None), patch('logs.Formatter', wraps=Formatter) as created:
+            logs.set_correlation_id('first')
+            logs.set_correlation_id('second')
+            self.assertEqual(created.call_count, 1)
+            self.assertEqual(logs.formatter.fields['correlation_id'], 'second')
+
+    def test_encodes_other_messages_as_text(self):
+        self.logger.info("Failed on %s", 'db')
+        self.assertEqual(self.records()[0]['message'], 'Failed on db')
+
+    def test_samples_large_dicts(self):
+        self.assertEqual(prepare({'a': 1, 'b': 2, 'c': 3, 'd': 4}, 16, 2), {'a': 1, 'b': 2, '...': '2 more keys'})
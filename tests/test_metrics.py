@@ -0,0 +1,72 @@
+import io
+import json
+import os
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+from unittest.mock import patch
+
+from mysql.connector.constants import FieldType
+
+import metrics
+from database import connection_pool, run_query
+from metrics import phase, tag, traced
+from tests.test_database import FakeConnection
+
+
+class MetricsTest(unittest.TestCase):
+    def setUp(self):
+        connection_pool.clear()
+        self.query = {'alias': 'getstats', 'sql': 'SELECT id FROM orders', 'mysql_host': 'db', 'mysql_database': 'shop', 'mysql_username': 'user', 'mysql_password': 'password'}
+
+    def tearDown(self):
+        connection_pool.clear()
+
+    def invoke(self, handler, **environ):
+        stdout = io.StringIO()
+        with patch.dict(os.environ, environ), patch('sys.stdout', stdout):
+            result = handler({}, {})
+        return result, [json.loads(line) for line in stdout.getvalue().splitlines()]
+
+    def test_emits_phases_per_alias_and_host(self):
+        @traced('query')
+        def handler(event, context):
+            tag(correlation_id='MetricsTest')
+            with phase('parse'):
+                pass
+            tag(alias='getstats', host='db')
+            with patch('database.connect', side_effect=lambda query: FakeConnection(rows=[(1,), (2,)], description=[('id', FieldType.LONG)])):
+                with ThreadPoolExecutor(max_workers=2) as executor:
+                    snippets = list(executor.map(run_query, [self.query, dict(self.query, alias='getother', mysql_host='replica')]))
+            for snippet in snippets:
+                snippet.close()
+            return 'done'
+
+        with patch('metrics.cold_start', True):
+            result, records = self.invoke(handler)
+        self.assertEqual(result, 'done')
+        unlabelled, other, stats = records
+        self.assertEqual((unlabelled['function'], unlabelled['start'], unlabelled['correlation_id']), ('query', 'cold', 'MetricsTest'))
+        self.assertEqual(unlabelled['_aws']['CloudWatchMetrics'][0]['Dimensions'], [['function', 'start']])
+        self.assertEqual(sorted(name for name in unlabelled if name in ('init', 'parse', 'total')), ['init', 'parse'])
+        self.assertEqual((other['alias'], other['host']), ('getother', 'replica'))
+        self.assertEqual(stats['_aws']['CloudWatchMetrics'][0]['Dimensions'], [['function', 'start'], ['function', 'alias'], ['function', 'alias', 'host']])
+        self.assertEqual([metric['Name'] for metric in stats['_aws']['CloudWatchMetrics'][0]['Metrics']], ['connect', 'execute', 'fetch', 'format', 'total'])
+        self.assertTrue(all(isinstance(stats[name], float) for name in ('connect', 'execute', 'fetch', 'format', 'total')))
+
+    def test_later_invocations_are_warm(self):
+        handler = traced('command')(lambda event, context: None)
+        with patch('metrics.cold_start', True):
+            self.invoke(handler)
+            result, records = self.invoke(handler)
+        self.assertEqual(records[0]['start'], 'warm')
+        self.assertNotIn('init', records[0])
+        self.assertIsNone(metrics.current)
+
+    def test_disabled_without_namespace(self):
+        result, records = self.invoke(traced('command')(lambda event, context: None), METRICS_NAMESPACE='')
+        self.assertEqual(records, [])
+
+    def test_phases_outside_invocations_are_ignored(self):
+        with phase('connect', self.query):
+            pass
+        self.assertIsNone(metrics.current)
@@ -0,0 +1,61 @@
+import time
+import unittest
+from unittest.mock import patch
+
+from mysql.connector.constants import FieldType
+
+from aliases import validate_alias
+from database import connection_pool, run_query
+from tests.test_database import FakeConnection, FakeCursor
+
+
+class SlowCursor(FakeCursor):
+    """Answers each statement with its own text after a delay, failing statements mentioning missing tables"""
+
+    def execute(self, operation, multi=False):
+        time.sleep(0.3)
+        if 'missing' in operation:
+            raise RuntimeError("Table 'missing' doesn't exist")
+        self.rows = [(operation.split()[-1],)]
+        return iter([self])
+
+
+class SlowConnection(FakeConnection):
+    def cursor(self, **kwargs):
+        return SlowCursor([], [('source', FieldType.VAR_STRING)])
+
+
+class ParallelQueryTest(unittest.TestCase):
+    def setUp(self):
+        connection_pool.clear()
+        self.query = {
+            'alias': 'getreports',
+            'sql': ['SELECT source FROM orders', 'SELECT source FROM refunds', 'SELECT source FROM missing'],
+            'parallel': True,
+            'mysql_host': 'db',
+            'mysql_database': 'shop',
+            'mysql_username': 'user',
+            'mysql_password': 'password'
+        }
+
+    def tearDown(self):
+        connection_pool.clear()
+
+    def test_runs_statements_concurrently_as_sections(self):
+        start = time.time()
+        with patch('database.connect', side_effect=lambda query: SlowConnection()) as connected:
+            with run_query(self.query) as snippet:
+                content = snippet.read().decode('utf-8')
+        self.assertLess(time.time() - start, 0.8)
+        self.assertEqual(connected.call_count, 3)
+        self.assertRegex(content, (
+            r'^Statement 1 \(0\.\d\ds\): SELECT source FROM orders\nsource\n------\norders\n\n'
+            r'Statement 2 \(0\.\d\ds\): SELECT source FROM refunds\nsource \n-------\nrefunds\n\n'
+            r'Statement 3 \(0\.\d\ds\): SELECT source FROM missing\nThe SQL query \(alias: getreports\) failed, please check the logs for more information\n\n'
+            r'Ran 3 statements in 0\.\d\ds, the slowest took 0\.\d\ds\n$'
+        ))
+
+    def test_validates_statements(self):
+        self.assertIsNone(validate_alias('getreports', self.query))
+        self.assertEqual(validate_alias('getreports', dict(self.query, sql='SELECT 1; SELECT 2')), "parallel aliases need sql to be a list of at least two statements")
+        self.assertEqual(validate_alias('getreports', dict(self.query, parallel=False)), "sql must be a statement, a list of statements needs parallel")
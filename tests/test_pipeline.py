@@ -0,0 +1,163 @@
+import importlib
+import io
+import os
+import time
+import unittest
+from unittest.mock import patch
+
+from mysql.connector.constants import FieldType
+
+import slack
+from aliases import validate_alias
+from database import connection_pool, get_pool_key
+from pipeline import run_pipelined_query
+from tests.stubs import StubServer
+from tests.test_database import FakeConnection, FakeCursor
+from tests.test_slack import parse_multipart
+
+handlers = importlib.import_module('lambda')
+
+DESCRIPTION = [('id', FieldType.LONG), ('name', FieldType.VAR_STRING)]
+ROWS = [(i, 'customer {}'.format(i)) for i in range(1, 41)]
+
+
+class StreamingCursor(FakeCursor):
+    """Returns each batch after a delay like a slow query, recording when it was fetched, and fails after fail_after rows"""
+
+    def __init__(self, rows, description, delay=0, fail_after=None):
+        super(StreamingCursor, self).__init__(rows, description)
+        self.delay = delay
+        self.fail_after = fail_after
+        self.fetched = 0
+        self.fetch_times = []
+
+    def fetchmany(self, size):
+        time.sleep(self.delay)
+        if self.fail_after is not None and self.fetched >= self.fail_after:
+            raise RuntimeError("Lost connection to MySQL server during query")
+        batch = super(StreamingCursor, self).fetchmany(size)
+        self.fetched += len(batch)
+        self.fetch_times.append(time.time())
+        return batch
+
+
+class StreamingConnection(FakeConnection):
+    def __init__(self, cursor):
+        super(StreamingConnection, self).__init__()
+        self.streaming_cursor = cursor
+
+    def cursor(self, **kwargs):
+        return self.streaming_cursor
+
+
+def files_upload(path, headers, body):
+    return 200, {'Content-Type': 'application/json'}, {'ok': True}
+
+
+class PipelineTest(unittest.TestCase):
+    def setUp(self):
+        slack.session = None
+        connection_pool.clear()
+        self.environ = patch.dict(os.environ, {'SLACK_TOKEN': 'xoxb-test', 'FETCH_BATCH_SIZE': '4'})
+        self.environ.start()
+        self.query = {'alias': 'exportcustomers', 'sql': 'SELECT id, name FROM customers', 'pipeline': True, 'mysql_host': 'db', 'mysql_database': 'shop', 'mysql_username': 'user', 'mysql_password': 'password'}
+
+    def tearDown(self):
+        self.environ.stop()
+        connection_pool.clear()
+        slack.session = None
+
+    def run_pipeline(self, cursor, respond=files_upload, chunk_delay=0):
+        with StubServer(respond, chunk_delay) as stub, patch.dict(os.environ, {'SLACK_API_URL': stub.url}):
+            with patch('database.get_connection', return_value=StreamingConnection(cursor)):
+                start = time.time()
+                snippet, uploaded = run_pipelined_query(self.query, ['C704EFSF7', 'C0FOLLOWER'], 'PipelineTest')
+                elapsed = time.time() - start
+        with snippet:
+            return snippet.read().decode('utf-8'), uploaded, elapsed, stub
+
+    def test_overlaps_query_and_upload(self):
+        # Ten batches taking 0.05s each to fetch and to upload, sequentially about a second
+        cursor = StreamingCursor(ROWS, DESCRIPTION, delay=0.05)
+        content, uploaded, elapsed, stub = self.run_pipeline(cursor, chunk_delay=0.05)
+        self.assertTrue(uploaded)
+        self.assertLess(elapsed, 0.85)
+        self.assertLess(stub.chunk_times[1], cursor.fetch_times[-1])
+
+        path, headers, body = stub.requests[0]
+        self.assertEqual(headers['Transfer-Encoding'], 'chunked')
+        fields = parse_multipart(headers, body)
+        self.assertEqual(fields['channels'], (None, b'C704EFSF7,C0FOLLOWER'))
+        self.assertEqual(fields['file'][1].decode('utf-8'), content)
+        lines = content.splitlines()
+        self.assertEqual(lines[:3], ['id | name      ', '-- | ----------', '1  | customer 1'])
+        self.assertEqual(lines[-1], '40 | customer 40')
+        self.assertEqual(len(lines), 42)
+        self.assertEqual(len(connection_pool[get_pool_key(self.query)]), 1)
+
+    def test_slow_upload_holds_back_fetch(self):
+        consumed = []
+
+        def post_stream(chunks, locations, correlation_id=None):
+            for chunk in chunks:
+                time.sleep(0.02)
+                consumed.append(time.time())
+
+        cursor = StreamingCursor(ROWS, DESCRIPTION)
+        with patch.dict(os.environ, {'PIPELINE_QUEUE_BATCHES': '1'}), patch('slack.post_stream', side_effect=post_stream):
+            with patch('database.get_connection', return_value=StreamingConnection(cursor)):
+                snippet, uploaded = run_pipelined_query(self.query, ['C704EFSF7'])
+        snippet.close()
+        # At most a batch and a chunk wait in the queues, and one of each is being formatted and uploaded
+        consumed_before_last_fetch = len([at for at in consumed if at < cursor.fetch_times[-1]])
+        self.assertGreaterEqual(consumed_before_last_fetch, len(cursor.fetch_times) - 5)
+
+    def test_failed_upload_returns_whole_result(self):
+        cursor = StreamingCursor(ROWS, DESCRIPTION)
+        content, uploaded, elapsed, stub = self.run_pipeline(cursor, respond=lambda path, headers, body: (200, {}, {'ok': False, 'error': 'not_in_channel'}))
+        self.assertFalse(uploaded)
+        self.assertEqual(len(content.splitlines()), 42)
+
+    def test_failed_formatting_stops_fetch_and_upload(self):
+        streamed = []
+
+        def post_stream(chunks, locations, correlation_id=None):
+            streamed.extend(chunks)
+
+        cursor = StreamingCursor(ROWS, DESCRIPTION)
+        with patch.dict(os.environ, {'PIPELINE_QUEUE_BATCHES': '1'}), patch('slack.post_stream', side_effect=post_stream):
+            with patch('database.get_connection', return_value=StreamingConnection(cursor)), patch('pipeline.start_table', side_effect=ValueError("Unformattable")):
+                start = time.time()
+                with self.assertRaises(ValueError):
+                    run_pipelined_query(self.query, ['C704EFSF7'])
+        self.assertLess(time.time() - start, 1)
+        self.assertLess(cursor.fetched, len(ROWS))
+        self.assertEqual(streamed, [])
+        self.assertNotIn(get_pool_key(self.query), connection_pool)
+
+    def test_query_failure_is_noted_after_streamed_rows(self):
+        cursor = StreamingCursor(ROWS, DESCRIPTION, fail_after=8)
+        content, uploaded, elapsed, stub = self.run_pipeline(cursor)
+        self.assertTrue(uploaded)
+        self.assertTrue(content.endswith('8  | customer 8\n\nThe SQL query (alias: exportcustomers) failed after 8 rows, please check the logs for more information\n'))
+        self.assertNotIn(get_pool_key(self.query), connection_pool)
+
+    def test_truncates_at_max_rows(self):
+        self.query['max_rows'] = 10
+        content, uploaded, elapsed, stub = self.run_pipeline(StreamingCursor(ROWS, DESCRIPTION))
+        self.assertTrue(content.endswith('10 | customer 10\n\nResult truncated after 10 rows, raise max_rows or max_bytes for alias exportcustomers to see more.\n'))
+
+    def test_handler_posts_result_only_when_upload_failed(self):
+        event = {'query': self.query, 'location': 'C704EFSF7', 'correlation_id': 'PipelineTest'}
+        for result, posted in (((b'streamed', True), []), ((b'not streamed', False), ['not streamed'])):
+            snippets = []
+            with patch('pipeline.run_pipelined_query', return_value=(io.BytesIO(result[0]), result[1])), patch('result_cache.run_query') as run:
+                with patch('slack.post_snippet', side_effect=lambda snippet, *args: snippets.append(snippet.read().decode('utf-8'))):
+                    self.assertEqual(handlers.query_handler(event, {}), {'statusCode': 200})
+            self.assertFalse(run.called)
+            self.assertEqual(snippets, posted)
+
+    def test_validates_pipeline_option(self):
+        self.assertIsNone(validate_alias('exportcustomers', self.query))
+        self.assertEqual(validate_alias('exportcustomers', dict(self.query, pipeline='yes')), "pipeline must be true or false")
+        self.assertEqual(validate_alias('exportcustomers', dict(self.query, cache_ttl=60)), "pipeline can't be combined with parallel, targets, replicas, cache_ttl, refresh, max_rows_examined")
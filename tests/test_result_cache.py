@@ -0,0 +1,79 @@
+import io
+import os
+import shutil
+import tempfile
+import time
+import unittest
+from unittest.mock import patch
+
+from mysql.connector.constants import FieldType
+
+import database
+import result_cache
+from result_cache import MemoryResultCache, SqliteResultCache, run_cached_queries, run_cached_query
+from tests.test_database import FakeConnection
+
+
+class ResultCacheTest(unittest.TestCase):
+    def setUp(self):
+        result_cache.result_cache = None
+        database.connection_pool.clear()
+        self.directory = tempfile.mkdtemp()
+        self.query = {'alias': 'getstats', 'sql': 'SELECT 1', 'mysql_host': 'db', 'mysql_database': 'sakila', 'mysql_username': 'user', 'cache_ttl': 60}
+
+    def tearDown(self):
+        result_cache.result_cache = None
+        shutil.rmtree(self.directory)
+
+    def check_eviction(self, cache):
+        cache.set('first', 1, 'a' * 4)
+        cache.set('second', 2, 'b' * 4)
+        self.assertEqual(cache.get('first'), (1, 'aaaa'))
+        cache.set('third', 3, 'c' * 4)
+        self.assertIsNone(cache.get('second'))
+        self.assertEqual(cache.get('first'), (1, 'aaaa'))
+        self.assertEqual(cache.get('third'), (3, 'cccc'))
+
+    def test_memory_eviction(self):
+        self.check_eviction(MemoryResultCache(max_bytes=10))
+
+    def test_sqlite_eviction(self):
+        self.check_eviction(SqliteResultCache(max_bytes=10, path=os.path.join(self.directory, 'cache.sqlite3')))
+
+    def test_serves_fresh_result(self):
+        with patch('result_cache.run_query', side_effect=lambda query, raw=None, on_queued=None: io.BytesIO(b'result\n')) as run:
+            self.assertEqual(run_cached_query(self.query).read(), b'result\n')
+            self.assertEqual(run_cached_query(self.query), 'Cached result from 0 seconds ago\nresult\n')
+            self.assertEqual(run.call_count, 1)
+
+    def test_skips_truncated_result(self):
+        def connection(query):
+            return FakeConnection(rows=[(1,), (2,)], description=[('id', FieldType.LONG)])
+
+        with patch('database.connect', side_effect=connection) as connect:
+            first = run_cached_query(dict(self.query, max_rows=1, mysql_password='password'))
+            second = run_cached_query(dict(self.query, max_rows=1, mysql_password='password'))
+        self.assertIn(b"Result truncated after 1 rows", first.read())
+        self.assertIn(b"Result truncated after 1 rows", second.read())
+        self.assertEqual(connect.call_count, 2)
+
+    def test_skips_cache_without_ttl(self):
+        query = dict(self.query)
+        del query['cache_ttl']
+        with patch('result_cache.run_query', side_effect=lambda query, raw=None, on_queued=None: io.BytesIO(b'result\n')) as run:
+            run_cached_query(query)
+            run_cached_query(query)
+            self.assertEqual(run.call_count, 2)
+
+    def test_runs_queries_concurrently(self):
+        def slow_query(query, raw=None, on_queued=None):
+            time.sleep(0.3)
+            return io.BytesIO(query['alias'].encode('utf-8'))
+
+        queries = [dict(self.query, alias=alias, cache_ttl=None) for alias in ('first', 'second', 'third')]
+        start = time.time()
+        with patch('result_cache.run_query', side_effect=slow_query):
+            results = run_cached_queries(queries)
+        self.assertLess(time.time() - start, 0.6)
+        self.assertEqual([snippet.read() for snippet, elapsed in results], [b'first', b'second', b'third'])
+        self.assertTrue(all(elapsed >= 0.3 for snippet, elapsed in results))
@@ -0,0 +1,115 @@
+import importlib
+import json
+import os
+import shutil
+import tempfile
+import time
+import threading
+import unittest
+from unittest.mock import patch
+
+import result_store
+from database import write_snippet
+from result_cache import run_cached_query
+from result_store import get_materialization_key, get_result_store
+from snapshot import Snapshot
+
+handlers = importlib.import_module('lambda')
+
+
+def run_query(query, raw=None, on_queued=None):
+    return write_snippet([('2026-10-17', '42')], ['day', 'orders'], [10, 6], (), raw)
+
+
+class RefreshTest(unittest.TestCase):
+    def setUp(self):
+        result_store.result_store = None
+        result_store.lease_store = None
+        self.directory = tempfile.mkdtemp()
+        self.environ = patch.dict(os.environ, {
+            'RESULT_STORE_BACKEND': 'sqlite',
+            'RESULT_STORE_PATH': os.path.join(self.directory, 'result-store.sqlite3'),
+            'REFRESH_LEASE_BACKEND': 'sqlite',
+            'REFRESH_LEASE_PATH': os.path.join(self.directory, 'leases.sqlite3'),
+            'SQL_GETDAILYTOTALS_USERNAME': 'user',
+            'SQL_GETDAILYTOTALS_PASSWORD': 'password'
+        })
+        self.environ.start()
+        self.config = {'queries': {
+            'getdailytotals': {'sql': 'SELECT 1', 'mysql_host': 'db', 'mysql_database': 'sakila', 'refresh': '5m'},
+            'getstats': {'sql': 'SELECT 2', 'mysql_host': 'db', 'mysql_database': 'sakila'}
+        }, 'invalid': {}}
+        self.query = dict(self.config['queries']['getdailytotals'], alias='getdailytotals', mysql_username='user', mysql_password='password')
+
+    def tearDown(self):
+        self.environ.stop()
+        result_store.result_store = None
+        result_store.lease_store = None
+        shutil.rmtree(self.directory)
+
+    def refresh(self, **kwargs):
+        with patch('lambda.get_config', return_value=self.config), patch('result_cache.run_query', **kwargs) as run:
+            handlers.refresh_handler({}, {})
+        return run
+
+    def lookup(self):
+        with patch('lambda.get_config', return_value=self.config), patch('dispatcher.invoke_query_handler') as invoke:
+            response = handlers.lookup_alias_and_invoke_query_handler('getdailytotals', 'aarongorka', 'C704EFSF7', 'RefreshTest')
+        return json.loads(response['body'])['text'], invoke
+
+    def test_refreshes_due_aliases_once(self):
+        run = self.refresh(side_effect=run_query)
+        self.assertEqual([call[0][0]['alias'] for call in run.call_args_list], ['getdailytotals'])
+        key = get_materialization_key(self.query)
+        with tempfile.TemporaryFile() as stream:
+            stream.write(get_result_store().open(key, '.snapshot').read())
+            stream.flush()
+            rows = Snapshot(stream)
+        self.assertEqual((rows.columns, rows.read_rows(0, 10)), (['day', 'orders'], [('2026-10-17', '42')]))
+        rows.close()
+        self.assertFalse(self.refresh(side_effect=run_query).called)
+
+    def test_overlapping_runs_refresh_once(self):
+        started, finish = threading.Event(), threading.Event()
+
+        def slow_query(query, raw=None, on_queued=None):
+            started.set()
+            finish.wait(5)
+            return run_query(query, raw)
+
+        first = threading.Thread(target=self.refresh, kwargs={'side_effect': slow_query})
+        first.start()
+        self.assertTrue(started.wait(5))
+        # The next scheduled run starts while the first is still materializing
+        self.assertFalse(self.refresh(side_effect=run_query).called)
+        finish.set()
+        first.join()
+        with patch('result_store.time.time', return_value=time.time() + 300):
+            self.assertTrue(self.refresh(side_effect=run_query).called)
+
+    def test_command_answers_from_materialization(self):
+        self.refresh(side_effect=run_query)
+        text, invoke = self.lookup()
+        self.assertRegex(text, r'^aarongorka executed getdailytotals:\n```Materialized at \d{4}-\d\d-\d\d \d\d:\d\d:\d\d UTC, 0 seconds ago\nday')
+        self.assertIn('2026-10-17', text)
+        self.assertFalse(invoke.called)
+
+    def test_stale_materialization_runs_query(self):
+        with open(os.devnull, 'rb') as empty:
+            get_result_store().put(get_materialization_key(self.query), time.time() - 601, empty, empty)
+        text, invoke = self.lookup()
+        self.assertEqual(text, 'aarongorka has requested execution of getdailytotals, executing now...')
+        self.assertTrue(invoke.called)
+
+    def test_failed_refresh_keeps_previous_materialization(self):
+        self.refresh(side_effect=run_query)
+        with patch('result_store.time.time', return_value=time.time() + 300):
+            self.refresh(return_value="Could not connect to db.")
+        self.assertIsNotNone(get_result_store().stat(get_materialization_key(self.query)))
+
+    def test_query_function_serves_materialization(self):
+        self.refresh(side_effect=run_query)
+        with patch('result_cache.run_query') as run:
+            snippet = run_cached_query(self.query)
+        self.assertFalse(run.called)
+        self.assertTrue(snippet.read().decode('utf-8').startswith('Materialized at '))
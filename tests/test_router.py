@@ -0,0 +1,73 @@
+import time
+import unittest
+from unittest.mock import patch
+
+import mysql.connector
+from mysql.connector.constants import FieldType
+
+import router
+from database import connection_pool, run_query
+from router import get_candidates, record_latency
+from tests.test_database import FakeConnection
+
+LAG = {'replica-1': 2, 'replica-2': 600}
+
+
+def connect(query):
+    if query['mysql_host'] == 'replica-down':
+        raise mysql.connector.errors.InterfaceError("Can't connect to MySQL server")
+    return FakeConnection(rows=[(LAG.get(query['mysql_host'], 0),)], description=[('lag', FieldType.LONGLONG)])
+
+
+class RouterTest(unittest.TestCase):
+    def setUp(self):
+        connection_pool.clear()
+        router.host_stats.clear()
+        self.query = {'alias': 'getstats', 'sql': 'SELECT 1', 'mysql_host': 'writer', 'mysql_database': 'sakila', 'mysql_username': 'user', 'mysql_password': 'password', 'replicas': ['replica-1', 'replica-2']}
+
+    def tearDown(self):
+        connection_pool.clear()
+        router.host_stats.clear()
+
+    def route(self, **settings):
+        with patch('database.connect', side_effect=connect) as connected, patch('router.run_query', side_effect=lambda query, raw=None, on_queued=None: query['mysql_host']):
+            host = run_query(dict(self.query, **settings))
+        return host, connected
+
+    def test_prefers_lowest_latency_replica(self):
+        record_latency('replica-1', 'connect', 0.5)
+        record_latency('replica-2', 'connect', 0.1)
+        self.assertEqual(self.route()[0], 'replica-2')
+        self.assertIsNotNone(router.host_stats['replica-2']['query'])
+
+    def test_skips_failed_replica(self):
+        self.query['replicas'] = ['replica-down', 'replica-1']
+        record_latency('replica-down', 'connect', 0.1)
+        record_latency('replica-1', 'connect', 0.5)
+        self.assertEqual(self.route()[0], 'replica-1')
+        self.assertIsNotNone(router.host_stats['replica-down']['failed_at'])
+        candidates, skipped = get_candidates(self.query)
+        self.assertEqual(candidates, ['replica-1', 'writer'])
+        self.assertIn('replica-down', skipped)
+
+    @patch.dict('os.environ', {'ROUTER_COOLDOWN': '30'})
+    def test_retries_replica_after_cooldown(self):
+        router.host_stats['replica-1'] = {'connect': 0.1, 'query': 0.1, 'failed_at': time.time() - 60}
+        self.assertEqual(get_candidates(self.query)[0][0], 'replica-2')
+        self.assertEqual(self.route()[0], 'replica-2')
+
+    def test_skips_lagging_replica(self):
+        record_latency('replica-2', 'connect', 0.1)
+        record_latency('replica-1', 'connect', 0.5)
+        self.assertEqual(self.route(lag_check='SELECT lag FROM heartbeat', max_lag=60)[0], 'replica-1')
+
+    def test_falls_back_to_writer(self):
+        self.query['replicas'] = ['replica-down']
+        self.assertEqual(self.route()[0], 'writer')
+
+    def test_reuses_connection_of_routing(self):
+        with patch('database.connect', side_effect=connect) as connected:
+            snippet = run_query(dict(self.query, replicas=['replica-1']))
+        with snippet:
+            self.assertEqual(snippet.read(), b'lag\n---\n2  \n')
+        self.assertEqual(connected.call_count, 1)
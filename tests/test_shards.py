@@ -0,0 +1,133 @@
+import decimal
+import time
+import unittest
+from unittest.mock import patch
+
+import mysql.connector
+from mysql.connector.constants import FieldType
+
+from aliases import validate_alias
+from database import connection_pool, run_query
+from tests.test_database import FakeConnection, KillableConnection
+
+DESCRIPTION = [('region', FieldType.VAR_STRING), ('orders', FieldType.LONGLONG), ('revenue', FieldType.NEWDECIMAL)]
+
+SHARDS = {
+    'db-1': [('apac', 10, decimal.Decimal('100.50')), ('emea', 5, decimal.Decimal('20.00'))],
+    'db-2': [('apac', 3, decimal.Decimal('9.50')), ('amer', 7, None)],
+}
+
+
+def connect(query):
+    if query['mysql_host'] == 'db-down':
+        raise mysql.connector.errors.InterfaceError("Can't connect to MySQL server")
+    if query['mysql_host'] == 'db-slow':
+        time.sleep(0.5)
+    return FakeConnection(rows=SHARDS.get(query['mysql_host'], []), description=DESCRIPTION)
+
+
+class ShardedQueryTest(unittest.TestCase):
+    def setUp(self):
+        connection_pool.clear()
+        self.query = {
+            'alias': 'getorders',
+            'sql': 'SELECT region, orders, revenue FROM totals',
+            'targets': [{'mysql_host': 'db-1', 'mysql_database': 'shop', 'name': 'one'}, {'mysql_host': 'db-2', 'mysql_database': 'shop', 'name': 'two'}],
+            'mysql_username': 'user',
+            'mysql_password': 'password'
+        }
+
+    def tearDown(self):
+        connection_pool.clear()
+
+    def run_query(self, **settings):
+        with patch('database.connect', side_effect=connect):
+            snippet = run_query(dict(self.query, **settings))
+        if isinstance(snippet, str):
+            return snippet
+        with snippet:
+            return snippet.read().decode('utf-8')
+
+    def test_concatenates_with_shard_column(self):
+        self.assertEqual(self.run_query(shard_column='shard'), (
+            'shard | region | orders | revenue\n'
+            '----- | ------ | ------ | -------\n'
+            'one   | apac   | 10     | 100.50 \n'
+            'one   | emea   | 5      | 20.00  \n'
+            'two   | apac   | 3      | 9.50   \n'
+            'two   | amer   | 7      |        \n'
+        ))
+
+    def test_sums_by_group(self):
+        self.assertEqual(self.run_query(merge='sum', group_by=['region']), (
+            'region | orders | revenue\n'
+            '------ | ------ | -------\n'
+            'apac   | 13     | 110.00 \n'
+            'emea   | 5      | 20.00  \n'
+            'amer   | 7      |        \n'
+        ))
+
+    def test_top_rows(self):
+        self.assertEqual(self.run_query(merge='top', order_by='orders', limit=2), (
+            'region | orders | revenue\n'
+            '------ | ------ | -------\n'
+            'apac   | 10     | 100.50 \n'
+            'amer   | 7      |        \n'
+        ))
+
+    def test_resets_select_limit_of_pooled_connections(self):
+        connections = []
+
+        def capped(query):
+            # As left in the pool by an alias with on_expensive: limit
+            cnx = connect(query)
+            cnx.select_limit = 1
+            connections.append(cnx)
+            return cnx
+
+        with patch('database.connect', side_effect=capped):
+            snippet = run_query(self.query)
+        with snippet:
+            self.assertEqual(snippet.read().decode('utf-8').count('\n'), 6)
+        self.assertEqual([cnx.select_limit for cnx in connections], [None, None])
+
+    def test_reports_failed_shard(self):
+        self.query['targets'].append({'mysql_host': 'db-down', 'mysql_database': 'shop'})
+        result = self.run_query()
+        self.assertIn('apac   | 3      | 9.50', result)
+        self.assertIn("Shard db-down/shop failed and was left out: Can't connect to MySQL server", result)
+
+    def test_reports_slow_shard(self):
+        self.query['targets'].append({'mysql_host': 'db-slow', 'mysql_database': 'shop'})
+        start = time.time()
+        result = self.run_query(shard_timeout=0.2)
+        self.assertLess(time.time() - start, 0.45)
+        self.assertIn('Shard db-slow/shop did not answer within 0.2s and was left out.', result)
+
+    def test_kills_abandoned_shard(self):
+        hanging = KillableConnection(rows=[('apac', 1, None)], description=DESCRIPTION, hangs=True)
+        side = KillableConnection(killed=hanging.killed)
+        connections = {'db-hang': [hanging, side]}
+
+        def connect_hanging(query):
+            if query['mysql_host'] in connections:
+                return connections[query['mysql_host']].pop(0)
+            return connect(query)
+
+        self.query['targets'].append({'mysql_host': 'db-hang', 'mysql_database': 'shop'})
+        with patch('database.connect', side_effect=connect_hanging):
+            with run_query(dict(self.query, shard_timeout=0.2)) as snippet:
+                result = snippet.read().decode('utf-8')
+        self.assertIn('Shard db-hang/shop did not answer within 0.2s and was left out.', result)
+        self.assertEqual(side.executed, ['KILL QUERY 7'])
+        self.assertTrue(side.closed)
+
+    def test_fails_when_every_shard_fails(self):
+        self.query['targets'] = [{'mysql_host': 'db-down', 'mysql_database': 'shop'}]
+        self.assertEqual(self.run_query(), 'The SQL query (alias: getorders) failed on every shard, please check the logs for more information')
+
+    def test_validates_targets(self):
+        self.assertIsNone(validate_alias('getorders', dict(self.query, merge='sum', group_by=['region'])))
+        self.assertEqual(validate_alias('getorders', dict(self.query, merge='top')), 'merge top needs an order_by column')
+        self.assertEqual(validate_alias('getorders', dict(self.query, targets=[{'mysql_host': 'db-1'}])), 'every target needs a mysql_host and mysql_database')
+        self.assertEqual(validate_alias('getorders', dict(self.query, replicas=['replica-1'])), "replicas can't be combined with targets")
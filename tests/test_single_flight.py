@@ -0,0 +1,101 @@
+import importlib
+import io
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+from unittest.mock import patch
+
+import single_flight
+from single_flight import board, land, new_flight
+
+query_handler = importlib.import_module('lambda').query_handler
+
+
+class FlightStateTest(unittest.TestCase):
+    def test_followers_join_running_flight(self):
+        state = new_flight()
+        self.assertTrue(board(state, 'leader', {'location': 'C1'}, 60, 0))
+        self.assertFalse(board(state, 'other', {'location': 'C2'}, 60, 1))
+        self.assertEqual(land(state, 'leader'), [{'location': 'C2'}])
+        self.assertTrue(board(state, 'next', {'location': 'C3'}, 60, 2))
+
+    def test_expired_flight_is_taken_over(self):
+        state = new_flight()
+        board(state, 'leader', {'location': 'C1'}, 60, 0)
+        self.assertTrue(board(state, 'other', {'location': 'C2'}, 60, 61))
+        self.assertFalse(board(state, 'late', {'location': 'C3'}, 60, 62))
+        self.assertEqual(land(state, 'leader'), [])
+        self.assertEqual(land(state, 'other'), [{'location': 'C3'}])
+
+
+class SingleFlightTest(unittest.TestCase):
+    def setUp(self):
+        single_flight.flight_store = None
+        self.directory = tempfile.mkdtemp()
+        self.environ = patch.dict(os.environ, {'SINGLE_FLIGHT_BACKEND': 'sqlite', 'SINGLE_FLIGHT_PATH': os.path.join(self.directory, 'flights.sqlite3')})
+        self.environ.start()
+        self.query = {'alias': 'getstats', 'sql': 'SELECT 1', 'mysql_host': 'db', 'mysql_database': 'sakila', 'mysql_username': 'user', 'mysql_password': 'password'}
+
+    def tearDown(self):
+        self.environ.stop()
+        single_flight.flight_store = None
+        shutil.rmtree(self.directory)
+
+    def test_delivers_one_result_to_every_channel(self):
+        started, finish = threading.Event(), threading.Event()
+        runs, posts = [], []
+
+        def post(snippet, location, correlation_id):
+            # Like post_snippet, every upload reads the file from the start
+            snippet.seek(0)
+            posts.append((location, snippet.read()))
+
+        def run(query, on_queued=None, raw=None):
+            runs.append(query['alias'])
+            started.set()
+            finish.wait(5)
+            return io.BytesIO(b'id\n--\n1\n')
+
+        with patch('result_cache.run_cached_query', side_effect=run), patch('slack.post_snippet', side_effect=post):
+            leader = threading.Thread(target=query_handler, args=({'query': self.query, 'location': 'C704EFSF7', 'correlation_id': 'leader'}, {}))
+            leader.start()
+            started.wait(5)
+            self.assertEqual(query_handler({'query': self.query, 'location': 'C0000000', 'correlation_id': 'follower'}, {}), {'statusCode': 200})
+            finish.set()
+            leader.join(5)
+            # The flight has landed, so the next request runs the query again
+            query_handler({'query': self.query, 'location': 'C704EFSF7', 'correlation_id': 'next'}, {})
+        self.assertEqual(runs, ['getstats', 'getstats'])
+        self.assertEqual(posts, [('C704EFSF7', b'id\n--\n1\n'), ('C0000000', b'id\n--\n1\n'), ('C704EFSF7', b'id\n--\n1\n')])
+
+    def test_tells_every_channel_when_the_query_fails(self):
+        started, finish = threading.Event(), threading.Event()
+        messages, failures = [], []
+
+        def run(query, on_queued=None, raw=None):
+            started.set()
+            finish.wait(5)
+            raise RuntimeError("Lost connection to MySQL server during query")
+
+        def lead():
+            try:
+                query_handler({'query': self.query, 'location': 'C704EFSF7', 'correlation_id': 'leader'}, {})
+            except RuntimeError as error:
+                failures.append(error)
+
+        with patch('result_cache.run_cached_query', side_effect=run), patch('slack.post_message', side_effect=lambda text, location, *args: messages.append(location)):
+            leader = threading.Thread(target=lead)
+            leader.start()
+            started.wait(5)
+            query_handler({'query': self.query, 'location': 'C0000000', 'correlation_id': 'follower'}, {})
+            finish.set()
+            leader.join(5)
+        self.assertEqual(len(failures), 1)
+        self.assertEqual(messages, ['C704EFSF7', 'C0000000'])
+
+    def test_different_queries_run_separately(self):
+        other = dict(self.query, sql='SELECT 2')
+        self.assertNotEqual(single_flight.get_flight_key(self.query), single_flight.get_flight_key(other))
+        self.assertEqual(single_flight.get_flight_key(self.query), single_flight.get_flight_key(dict(self.query, mysql_password='other')))
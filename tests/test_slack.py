@@ -0,0 +1,78 @@
+import email.parser
+import gzip
+import io
+import os
+import tempfile
+import unittest
+from unittest.mock import patch
+
+import slack
+from slack import MultipartStream, SlackError, post_snippet
+from tests.stubs import StubServer
+
+
+def parse_multipart(headers, body):
+    """Returns the fields of a multipart/form-data body, mapping names to (filename, content)"""
+
+    message = email.parser.BytesParser().parsebytes(b'Content-Type: ' + headers['Content-Type'].encode('utf-8') + b'\r\n\r\n' + body)
+    return {part.get_param('name', header='content-disposition'): (part.get_filename(), part.get_payload(decode=True)) for part in message.get_payload()}
+
+
+def files_upload(path, headers, body):
+    return 200, {'Content-Type': 'application/json'}, {'ok': True}
+
+
+class SlackClientTest(unittest.TestCase):
+    def setUp(self):
+        slack.session = None
+        self.stub = StubServer(files_upload).__enter__()
+        self.environ = patch.dict(os.environ, {'SLACK_API_URL': self.stub.url, 'SLACK_TOKEN': 'xoxb-test'})
+        self.environ.start()
+        self.snippet = tempfile.TemporaryFile()
+        self.snippet.write(b'id | name\n-- | ----\n' + b''.join('{:<2} | café\n'.format(i).encode('utf-8') for i in range(1000)))
+
+    def tearDown(self):
+        self.snippet.close()
+        self.environ.stop()
+        self.stub.__exit__()
+        slack.session = None
+
+    def test_streams_file_upload(self):
+        post_snippet(self.snippet, 'C704EFSF7', 'SlackClientTest')
+        path, headers, body = self.stub.requests[0]
+        self.assertEqual(path, '/files.upload')
+        self.assertEqual(int(headers['Content-Length']), len(body))
+        self.assertNotIn('Transfer-Encoding', headers)
+        fields = parse_multipart(headers, body)
+        self.snippet.seek(0)
+        self.assertEqual(fields['file'], ('result.txt', self.snippet.read()))
+        self.assertEqual(fields['channels'], (None, b'C704EFSF7'))
+        self.assertEqual(headers['Correlation-Id'], 'SlackClientTest')
+
+    def test_reuses_session(self):
+        post_snippet('Could not connect to db.', 'C704EFSF7')
+        session = slack.session
+        post_snippet('Could not connect to db.', 'C704EFSF7')
+        self.assertIs(slack.session, session)
+        self.assertEqual(len(self.stub.requests), 2)
+
+    @patch.dict(os.environ, {'SLACK_GZIP_MIN_BYTES': '1024'})
+    def test_gzips_large_files(self):
+        post_snippet(self.snippet, 'C704EFSF7')
+        path, headers, body = self.stub.requests[0]
+        fields = parse_multipart(headers, body)
+        self.snippet.seek(0)
+        self.assertEqual(fields['file'][0], 'result.txt.gz')
+        self.assertEqual(gzip.decompress(fields['file'][1]), self.snippet.read())
+        self.assertEqual(fields['filetype'], (None, b'gzip'))
+
+    def test_reads_multipart_in_chunks(self):
+        body = MultipartStream({'channels': 'C704EFSF7'}, 'result.txt', io.BytesIO(b'x' * 100))
+        chunks = iter(lambda: body.read(16), b'')
+        self.assertEqual(sum(len(chunk) for chunk in chunks), body.len)
+
+    def test_raises_when_slack_rejects(self):
+        with StubServer(lambda path, headers, body: (200, {}, {'ok': False, 'error': 'not_in_channel'})) as stub:
+            with patch.dict(os.environ, {'SLACK_API_URL': stub.url}):
+                with self.assertRaises(SlackError):
+                    post_snippet('result', 'C704EFSF7')
@@ -0,0 +1,133 @@
+import csv
+import importlib
+import io
+import json
+import os
+import shutil
+import tempfile
+import time
+import unittest
+from unittest.mock import patch
+from urllib.parse import urlencode
+
+import slack
+import snapshot
+from database import write_snippet
+from delivery import DeliveryQueue
+from paging import post_first_page
+from snapshot import Snapshot, SnapshotDirectory, write_snapshot
+
+handlers = importlib.import_module('lambda')
+
+ROWS = [('1', 'Ünïcode'), ('2', ''), ('3', 'three'), ('4', 'four'), ('5', 'five')]
+
+
+def run_query(query, raw=None, on_queued=None):
+    return write_snippet(ROWS, ['id', 'name'], [2, 7], ['Result truncated after 5 rows.'], raw)
+
+
+class SnapshotTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_reads_slices_of_rows(self):
+        with tempfile.TemporaryFile() as stream:
+            write_snapshot(iter(ROWS), ['id', 'name'], [2, 7], ['note'], stream)
+            stream.flush()
+            result = Snapshot(stream)
+        self.assertEqual((result.columns, result.rows, result.notes), (['id', 'name'], 5, ['note']))
+        self.assertEqual(result.read_rows(1, 3), ROWS[1:3])
+        self.assertEqual(result.read_rows(4, 10), ROWS[4:])
+        self.assertEqual(result.read_rows(5, 10), [])
+        result.close()
+
+    def test_evicts_expired_and_least_recently_read(self):
+        directory = SnapshotDirectory(self.directory, 2 * len(self.write()), 60)
+        for snapshot_id in ('old', 'unread', 'read'):
+            directory.add(snapshot_id, io.BytesIO(self.write()), time.time())
+        self.assertEqual(sorted(os.listdir(self.directory)), ['read.snapshot', 'unread.snapshot'])
+        os.utime(directory.get_path('unread'), (time.time() - 30, os.stat(directory.get_path('unread')).st_mtime))
+        directory.open('read').close()
+        directory.add('new', io.BytesIO(self.write()), time.time())
+        self.assertEqual(sorted(os.listdir(self.directory)), ['new.snapshot', 'read.snapshot'])
+        directory.add('expired', io.BytesIO(self.write()), time.time() - 61)
+        self.assertIsNone(directory.open('expired'))
+        self.assertEqual(sorted(os.listdir(self.directory)), ['new.snapshot', 'read.snapshot'])
+
+    def write(self):
+        stream = io.BytesIO()
+        write_snapshot(ROWS, ['id', 'name'], [2, 7], [], stream)
+        return stream.getvalue()
+
+
+class PagingTest(unittest.TestCase):
+    def setUp(self):
+        snapshot.snapshot_store = None
+        self.directory = tempfile.mkdtemp()
+        self.environ = patch.dict(os.environ, {'SNAPSHOT_BACKEND': 'local', 'SNAPSHOT_PATH': self.directory, 'PAGE_ROWS': '2'})
+        self.environ.start()
+        self.query = {'alias': 'getstats', 'sql': 'SELECT 1', 'mysql_host': 'db', 'mysql_database': 'sakila', 'mysql_username': 'user', 'mysql_password': 'password'}
+
+    def tearDown(self):
+        self.environ.stop()
+        snapshot.snapshot_store = None
+        shutil.rmtree(self.directory)
+
+    def press(self, button):
+        payload = {'callback_id': 'snapshot', 'trigger_id': 'PagingTest', 'user': {'name': 'aarongorka'}, 'channel': {'id': 'C704EFSF7'}, 'actions': [button]}
+        return handlers.button_handler({'body': urlencode({'payload': json.dumps(payload)})}, {})
+
+    def test_posts_first_page_and_browses_snapshot(self):
+        with patch('result_cache.run_query', side_effect=run_query), patch('slack.post_message') as message, patch('slack.post_snippet') as upload:
+            self.assertEqual(handlers.query_handler({'query': self.query, 'location': 'C704EFSF7', 'correlation_id': 'PagingTest'}, {}), {'statusCode': 200})
+        self.assertFalse(upload.called)
+        text, location, correlation_id, attachments = message.call_args[0]
+        self.assertEqual(text, 'getstats: rows 1-2 of 5\n```id | name   \n-- | -------\n1  | Ünïcode\n2  |        \n```\nResult truncated after 5 rows.')
+        self.assertEqual([button['text'] for button in attachments[0]['actions']], ['Next page', 'Download as CSV'])
+
+        with patch('result_cache.run_query') as run:
+            body = json.loads(self.press(attachments[0]['actions'][0])['body'])
+            self.assertFalse(run.called)
+        self.assertTrue(body['replace_original'])
+        self.assertTrue(body['text'].startswith('getstats: rows 3-4 of 5\n```id | name \n-- | -----\n3  | three\n4  | four \n```'))
+        self.assertEqual([button['text'] for button in body['attachments'][0]['actions']], ['Previous page', 'Next page', 'Download as CSV'])
+
+        with patch('dispatcher.dispatch') as dispatch, patch('slack.post_snippet') as upload:
+            body = json.loads(self.press(attachments[0]['actions'][1])['body'])
+        self.assertEqual(body['text'], 'Uploading 5 rows of getstats as CSV...')
+        self.assertFalse(upload.called)
+        job = dispatch.call_args[0][0]
+
+        uploads = []
+        with patch('slack.post_snippet', side_effect=lambda result, *args: uploads.append((result.read().decode('utf-8'), args))):
+            handlers.query_handler(job, {})
+        content, (location, correlation_id, filename) = uploads[0]
+        self.assertEqual((location, correlation_id), ('C704EFSF7', 'PagingTest'))
+        self.assertEqual(list(csv.reader(io.StringIO(content))), [['id', 'name']] + [list(row) for row in ROWS])
+        self.assertEqual(filename, 'getstats.csv')
+
+    def test_uploads_whole_result_where_first_page_failed(self):
+        def post(text, location, correlation_id, attachments):
+            if location == 'C2':
+                raise slack.SlackError('channel_not_found')
+
+        with tempfile.TemporaryFile() as raw:
+            run_query(self.query, raw).close()
+            self.assertEqual(post_first_page(raw, 'getstats', [], DeliveryQueue()), [])
+            self.assertEqual(os.listdir(self.directory), [])
+            with patch('slack.post_message', side_effect=post) as message:
+                self.assertEqual(post_first_page(raw, 'getstats', ['C1', 'C2'], DeliveryQueue()), ['C1'])
+        self.assertEqual(message.call_count, 2)
+
+    def test_expired_snapshot(self):
+        button = {'name': 'page', 'value': json.dumps({'snapshot': 'missing', 'page': 1, 'title': 'getstats'})}
+        self.assertEqual(json.loads(self.press(button)['body'])['text'], 'This result of getstats has expired, please run it again.')
+
+    def test_uploads_results_fitting_one_page(self):
+        with patch.dict(os.environ, {'PAGE_ROWS': '25'}), patch('result_cache.run_query', side_effect=run_query), patch('slack.post_message') as message, patch('slack.post_snippet') as upload:
+            handlers.query_handler({'query': self.query, 'location': 'C704EFSF7', 'correlation_id': 'PagingTest'}, {})
+        self.assertFalse(message.called)
+        self.assertTrue(upload.called)